@@ -1,21 +1,26 @@
 from time import sleep
 from httpx import Client, ReadTimeout, ConnectError
 from requests_toolbelt import MultipartEncoder
-import os, secrets, string, random, websocket, orjson, threading, queue, ssl, hashlib, re
+import os, secrets, string, random, websocket, orjson, threading, queue, ssl, hashlib, re, heapq
 from loguru import logger
 from typing import Generator
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from .utils import (
                     BASE_URL,
                     HEADERS,
                     SubscriptionsMutation,
-                    BOTS_LIST, 
-                    REVERSE_BOTS_LIST, 
-                    bot_map, 
+                    BotResolver, 
+                    RateLimiter, 
                     generate_nonce, 
-                    generate_file
+                    generate_file,
+                    MESSAGE_FIELDS
                     )
 from .queries import generate_payload
 from .bundles import PoeBundle
+from .archive import ChatArchive
+from .catalog import BotCatalog
+from .group import COMPACT_AFTER, MentionMatcher, encode_group_records, parse_group_history, compact_group_records, top_two, RollingContext
 from .proxies import PROXY
 if PROXY:
     from .proxies import fetch_proxy
@@ -29,7 +34,7 @@ class PoeApi:
     HEADERS = HEADERS
     MAX_CONCURRENT_MESSAGES = 3
 
-    def __init__(self, tokens: dict={}, proxy: list=[], auto_proxy: bool=False):
+    def __init__(self, tokens: dict={}, proxy: list=[], auto_proxy: bool=False, archive_path: str=None, catalog_path: str=None, catalog_ttl: int=600):
         self.client = None
         if not {'p-b', 'p-lat'}.issubset(tokens):
             raise ValueError("Please provide valid p-b and p-lat cookies")
@@ -45,8 +50,17 @@ class PoeApi:
         self.retry_attempts: int = 3
         self.ws_refresh: int = 3
         self.groups: dict = {}
+        self.group_files: dict = {}
+        self.group_matchers: dict = {}
+        self.group_contexts: dict = {}
+        self.group_limiter: RateLimiter = RateLimiter()
         self.proxies: dict = {}
         self.bundle: PoeBundle = None
+        self.archive: ChatArchive = ChatArchive(archive_path, tokens) if archive_path else None
+        self.categories: list = None
+        self.catalog: BotCatalog = BotCatalog(tokens, catalog_path, catalog_ttl)
+        self.resolver: BotResolver = BotResolver()
+        self.resolver.update_from_catalog(self.catalog.list())
         
         self.client = Client(headers=self.HEADERS, timeout=60, http2=True)
         self.client.cookies.update({
@@ -352,41 +366,70 @@ class PoeApi:
             "messagePointInfo": response_json["data"]["viewer"]["messagePointInfo"]
         }
     
-    def get_available_bots(self, count: int=25, get_all: bool=False):
-        self.bots = {}
+    def get_available_bots(self, count: int=25, get_all: bool=False, refresh: bool=False):
         if not (get_all or count):
             raise TypeError("Please provide at least one of the following parameters: get_all=<bool>, count=<int>")
-        response = self.send_request('gql_POST',"AvailableBotsSelectorModalPaginationQuery", {}) 
-        bots = [
-            each["node"]
-            for each in response["data"]["viewer"]["availableBotsConnection"]["edges"]
-            if each["node"]["deletionState"] == "not_deleted"
-        ]
-        cursor = response["data"]["viewer"]["availableBotsConnection"]["pageInfo"]["endCursor"]
-        if len(bots) >= count and not get_all:
-            self.bots.update({bot["handle"]: {"bot": bot} for bot in bots})
-            return self.bots
-        while len(bots) < count or get_all:
-            response = self.send_request("gql_POST", "AvailableBotsSelectorModalPaginationQuery", {"cursor": cursor})
-            new_bots = [
-                each["node"]
-                for each in response["data"]["viewer"]["availableBotsConnection"]["edges"]
-                if each["node"]["deletionState"] == "not_deleted"
-            ]
-            cursor = response["data"]["viewer"]["availableBotsConnection"]["pageInfo"]["endCursor"]
-            bots += new_bots
-            if len(new_bots) == 0:
-                if not get_all:
-                    logger.warning(f"Only {len(bots)} bots found on this account")
-                else:
-                    logger.info(f"Total {len(bots)} bots found on this account")
-                self.bots.update({bot["handle"]: {"bot": bot} for bot in bots})
-                return self.bots
-            
-        logger.info("Succeed to get available bots")
-        self.bots.update({bot["handle"]: {"bot": bot} for bot in bots})
+        catalog = self.catalog
+        if refresh or len(catalog) == 0 or (not catalog.complete and (get_all or len(catalog) < count)):
+            self.refresh_bots(full=refresh, count=None if get_all else count)
+        elif catalog.is_stale():
+            self._refresh_bots_in_background()
+        bots = catalog.list(None if get_all else count)
+        if not get_all and len(bots) < count:
+            logger.warning(f"Only {len(bots)} bots found on this account")
+        self.bots = {bot["handle"]: {"bot": bot} for bot in bots}
         return self.bots
     
+    def _get_bots_page(self, cursor: str=None):
+        response = self.send_request('gql_POST', "AvailableBotsSelectorModalPaginationQuery", {} if cursor == None else {"cursor": cursor})
+        connection = response["data"]["viewer"]["availableBotsConnection"]
+        return [each["node"] for each in connection["edges"]], connection["pageInfo"]["endCursor"], connection["pageInfo"].get("hasNextPage", True)
+    
+    def refresh_bots(self, full: bool=False, count: int=None):
+        # Walks the pages from the top and stops at the first page with known cursor and no new bots,
+        # a full refresh walks every page and also drops bots that are no longer listed
+        catalog = self.catalog
+        handles, cursor, added = set(), None, 0
+        while True:
+            nodes, endCursor, hasNextPage = self._get_bots_page(cursor)
+            known = endCursor in catalog.cursors
+            new = catalog.merge(nodes, endCursor)
+            added += new
+            handles.update(node["handle"] for node in nodes)
+            if not known and not catalog.complete:
+                catalog.endCursor = endCursor
+            if len(nodes) == 0 or not hasNextPage or endCursor == None:
+                catalog.complete = True
+                if full:
+                    catalog.prune(handles)
+                break
+            if not full:
+                if count != None and not catalog.complete and len(catalog) >= count:
+                    break
+                if known and new == 0:
+                    if catalog.complete or catalog.endCursor == None:
+                        break
+                    # The top of the list is unchanged, resume the walk where it stopped last time
+                    endCursor = catalog.endCursor
+            cursor = endCursor
+        self.resolver.update_from_catalog(catalog.list())
+        catalog.mark_refreshed()
+        logger.info(f"Bot catalog refreshed with {added} new bots, {len(catalog)} bots in total")
+        return added
+    
+    def _refresh_bots_in_background(self):
+        if self.catalog.refreshing:
+            return
+        self.catalog.refreshing = True
+        def refresh():
+            try:
+                self.refresh_bots()
+            except Exception as e:
+                logger.warning(f"Failed to refresh the bot catalog: {e}")
+            finally:
+                self.catalog.refreshing = False
+        threading.Thread(target=refresh, daemon=True).start()
+    
     def get_chat_history(self, bot: str=None, count: int=None, interval: int=50, cursor: str=None):
 
         chat_bots = {'data': {}, 'cursor': None}
@@ -405,7 +448,7 @@ class PoeApi:
        
             for edge in edges:
                 chat = edge['node']
-                model = bot_map(chat["defaultBotObject"]["displayName"])
+                model = self.resolver.resolve(chat["defaultBotObject"]["displayName"])
               
                 if model in chat_bots['data']:
                     chat_bots['data'][model].append({"chatId": chat["chatId"],"chatCode": chat["chatCode"], "id": chat["id"], "title": chat["title"]})
@@ -418,7 +461,7 @@ class PoeApi:
                     edges = response_json['data']['chats']['edges']
                     for edge in edges:
                         chat = edge['node']
-                        model = bot_map(chat["defaultBotObject"]["displayName"])
+                        model = self.resolver.resolve(chat["defaultBotObject"]["displayName"])
                       
                         if model in chat_bots['data']:
                             chat_bots['data'][model].append({"chatId": chat["chatId"],"chatCode": chat["chatCode"], "id": chat["id"], "title": chat["title"]})
@@ -429,12 +472,8 @@ class PoeApi:
                 if not response_json['data']['chats']['pageInfo']['hasNextPage']:
                     chat_bots['cursor'] = None  
         else:
-            model = bot.lower().replace(' ', '')
-            handle = model
-            for key, value in BOTS_LIST.items():
-                if model == value:
-                    handle = key
-                    break
+            model = self.resolver.resolve(bot)
+            handle = self.resolver.handle(bot)
             response_json = self.send_request('gql_POST', 'ChatHistoryFilteredListPaginationQuery', {'count': interval, 'handle': handle, 'cursor': cursor})
             if response_json['data'] == None and response_json["errors"]:
                 raise ValueError(
@@ -475,11 +514,18 @@ class PoeApi:
                     chat_bots['cursor'] = cursor  
                 if not response_json['data']['filteredChats']['pageInfo']['hasNextPage']:
                     chat_bots['cursor'] = None
+        if self.archive:
+            for model, threads in chat_bots['data'].items():
+                self.archive.save_threads(model, threads)
         return chat_bots
     
     def get_threadData(self, bot: str="", chatCode: str=None, chatId: int=None):
         id = None
         title = None
+        if self.archive:
+            thread = self.archive.get_thread(chatCode, chatId)
+            if thread:
+                return {'chatCode': thread['chatCode'], 'chatId': thread['chatId'], 'id': thread['id'], 'title': thread['title']}
         if bot not in self.current_thread or len(self.current_thread[bot]) <= 1:
             self.current_thread[bot] = self.get_chat_history(bot=bot)['data'][bot]
         if chatCode != None:
@@ -499,10 +545,7 @@ class PoeApi:
         return {'chatCode': chatCode, 'chatId': chatId, 'id': id, 'title': title}
     
     def get_botInfo(self, handle: str):
-        if handle in REVERSE_BOTS_LIST:
-            handle = REVERSE_BOTS_LIST[handle]
-        else:
-            handle = handle.lower().replace(' ', '')
+        handle = self.resolver.handle(handle)
         response_json = self.send_request('gql_POST', 'HandleBotLandingPageQuery', {'botHandle': handle})
         if response_json['data'] == None and response_json["errors"]:
             raise ValueError(
@@ -554,7 +597,7 @@ class PoeApi:
         if last_message['author'] == 'human':
             raise RuntimeError(f"Last message is not from bot. Raw response data: {response_json}")
         
-        bot = bot_map(last_message['author'])
+        bot = self.resolver.resolve(last_message['author'])
         
         status = last_message['state']
         if status == 'error_user_message_too_long':
@@ -651,6 +694,8 @@ class PoeApi:
                             sleep(1)
                             continue
                                    
+                    if self.archive:
+                        self.archive.save_messages(chatId, [response], bot)
                     yield response
                     break
                 
@@ -677,7 +722,7 @@ class PoeApi:
             sleep(0.01)
         self.connect_ws()
         
-        bot = bot_map(bot)
+        bot = self.resolver.resolve(bot)
         attachments = []
         
         if file_path == []:
@@ -754,6 +799,8 @@ class PoeApi:
                     self.current_thread[bot] = [{'chatId': chatId, 'chatCode': chatCode, 'id': message_data['id'], 'title': message_data['title']}]
                 else:
                     self.current_thread[bot].append({'chatId': chatId, 'chatCode': chatCode, 'id': message_data['id'], 'title': message_data['title']})
+                if self.archive:
+                    self.archive.save_threads(bot, [{'chatId': chatId, 'chatCode': chatCode, 'id': message_data['id'], 'title': message_data['title']}])
                 self.delete_pending_messages(prompt_md5)
             except Exception as e:
                 self.delete_pending_messages(prompt_md5)
@@ -877,6 +924,8 @@ class PoeApi:
                             sleep(1)
                             continue
 
+                    if self.archive:
+                        self.archive.save_messages(chatId, [response], bot)
                     yield response
                     break
                 
@@ -892,7 +941,7 @@ class PoeApi:
         self.send_request('gql_POST', 'StopMessage_messageCancel_Mutation', variables)
         
     def chat_break(self, bot: str, chatId: int=None, chatCode: str=None):
-        bot = bot_map(bot)
+        bot = self.resolver.resolve(bot)
         chatdata = self.get_threadData(bot, chatCode, chatId)
         chatId = chatdata['chatId']
         variables = {'chatId': chatId, 'clientNonce': generate_nonce()}
@@ -903,7 +952,7 @@ class PoeApi:
         self.send_request('gql_POST', 'DeleteMessageMutation', variables)
     
     def purge_conversation(self, bot: str, chatId: int=None, chatCode: str=None, count: int=50, del_all: bool=False):
-        bot = bot_map(bot)
+        bot = self.resolver.resolve(bot)
         if chatId != None and chatCode == None:
             chatdata = self.get_threadData(bot, chatCode, chatId)
             chatCode = chatdata['chatCode']
@@ -944,9 +993,11 @@ class PoeApi:
     def purge_all_conversations(self):
         self.current_thread = {}
         self.send_request('gql_POST', 'DeleteUserMessagesMutation', {})
+        if self.archive:
+            self.archive.clear()
     
     def delete_chat(self, bot: str, chatId: any=None, chatCode: any=None, del_all: bool=False):
-        bot = bot_map(bot)
+        bot = self.resolver.resolve(bot)
         try:
             chatdata = self.get_chat_history(bot=bot)['data'][bot]
         except:
@@ -958,12 +1009,16 @@ class PoeApi:
                         del self.current_thread[bot][thread]
                         break
             self.send_request('gql_POST', 'DeleteChat', {'chatId': chatId})
+            if self.archive:
+                self.archive.delete_thread(chatId)
             logger.info(f"Chat {chatId} deleted")
         if del_all == True:
             if bot in self.current_thread:
                 del self.current_thread[bot]
             for chat in chatdata:
                 self.send_request('gql_POST', 'DeleteChat', {'chatId': chat['chatId']})
+                if self.archive:
+                    self.archive.delete_thread(chat['chatId'])
                 logger.info(f"Chat {chat['chatId']} deleted")
         if chatCode != None:
                 for chat in chatdata:
@@ -976,6 +1031,8 @@ class PoeApi:
                                         del self.current_thread[bot][thread]
                                         break
                             self.send_request('gql_POST', 'DeleteChat', {'chatId': chatId})
+                            if self.archive:
+                                self.archive.delete_thread(chatId)
                             logger.info(f"Chat {chatId} deleted")
                     else:
                         if chat['chatCode'] == chatCode:
@@ -986,6 +1043,8 @@ class PoeApi:
                                         del self.current_thread[bot][thread]
                                         break
                             self.send_request('gql_POST', 'DeleteChat', {'chatId': chatId})
+                            if self.archive:
+                                self.archive.delete_thread(chatId)
                             logger.info(f"Chat {chatId} deleted")
                             break               
         elif chatId != None and isinstance(chatId, list):
@@ -997,46 +1056,157 @@ class PoeApi:
                                 del self.current_thread[bot][thread]
                                 break
                 self.send_request('gql_POST', 'DeleteChat', {'chatId': chat})
+                if self.archive:
+                    self.archive.delete_thread(chat)
                 logger.info(f"Chat {chat} deleted")  
                 
     def get_previous_messages(self, bot: str, chatId: int = None, chatCode: str = None, count: int = 50, get_all: bool = False):
-        bot = bot_map(bot)
+        bot = self.resolver.resolve(bot)
         try:
             getchatdata = self.get_threadData(bot, chatCode, chatId)
         except:
             raise RuntimeError(f"Thread not found. Make sure the thread exists before getting messages.")
         chatCode = getchatdata['chatCode']
-        id = getchatdata['id']
         messages = []
-        cursor = None
-        edges = True
 
-        if get_all:
-            while edges:
-                variables = {'count': 100, 'cursor': cursor, 'id': id}
-                response_json = self.send_request('gql_POST', 'ChatListPaginationQuery', variables)
-                chatdata = response_json['data']['node']
-                edges = chatdata['messagesConnection']['edges'][::-1]
-                for edge in edges:
-                    messages.append({'author': edge['node']['author'], 'text': edge['node']['text'], 'messageId': edge['node']['messageId'], 'contentType': edge['node']['contentType']})
-                cursor = chatdata['messagesConnection']['pageInfo']['startCursor']
-        else:
-            num = count
-            while edges and num > 0:
-                variables = {'count': 100, 'cursor': cursor, 'id': id}
-                response_json = self.send_request('gql_POST', 'ChatListPaginationQuery', variables)
-                chatdata = response_json['data']['node']
-                edges = chatdata['messagesConnection']['edges'][::-1]
-                for edge in edges:
-                    messages.append({'author': edge['node']['author'], 'text': edge['node']['text'], 'messageId': edge['node']['messageId'], 'contentType': edge['node']['contentType']})
-                    num -= 1
-                    if len(messages) == count:
-                        break
-                cursor = chatdata['messagesConnection']['pageInfo']['startCursor']
+        if self.archive:
+            self._sync_messages(getchatdata, bot)
+            messages = self.archive.get_messages(getchatdata['chatId'], None if get_all else count)
+            logger.info(f"Found {len(messages)} messages of {chatCode} in archive")
+            return messages
+
+        if get_all or count > 0:
+            for message in self._iter_messages(getchatdata['id']):
+                messages.append(message)
+                if not get_all and len(messages) == count:
+                    break
 
         logger.info(f"Found {len(messages)} messages of {chatCode}")
         return messages[::-1]
     
+    def sync_chat_history(self, bot: str=None, interval: int=50):
+        if not self.archive:
+            raise RuntimeError("Chat archive is disabled. Please provide archive_path when creating the client.")
+        total = self.archive.count_threads()
+        cursor = None
+        while True:
+            before = self.archive.count_threads()
+            chat_bots = self.get_chat_history(bot=bot, count=interval, cursor=cursor)
+            cursor = chat_bots['cursor']
+            # Threads come most recent first, so a page without unknown threads ends the sync
+            if cursor == None or self.archive.count_threads() == before:
+                break
+        new_threads = self.archive.count_threads() - total
+        logger.info(f"Synced {new_threads} new threads to archive")
+        return new_threads
+    
+    def sync_messages(self, bot: str, chatId: int = None, chatCode: str = None):
+        if not self.archive:
+            raise RuntimeError("Chat archive is disabled. Please provide archive_path when creating the client.")
+        bot = self.resolver.resolve(bot)
+        thread = self.get_threadData(bot, chatCode, chatId)
+        if thread['id'] == None:
+            raise RuntimeError(f"Thread not found. Make sure the thread exists before syncing messages.")
+        return self._sync_messages(thread, bot)
+    
+    def search_messages(self, query: str, bot: str=None, author: str=None, chatCode: str=None, since=None, until=None, limit: int=50, raw: bool=False):
+        if not self.archive:
+            raise RuntimeError("Chat archive is disabled. Please provide archive_path when creating the client.")
+        chatId = None
+        if chatCode != None:
+            thread = self.archive.get_thread(chatCode=chatCode)
+            if not thread:
+                return []
+            chatId = thread['chatId']
+        results = self.archive.search(query, bot=self.resolver.resolve(bot) if bot != None else None, author=author, chatId=chatId, since=since, until=until, limit=limit, raw=raw)
+        logger.info(f"Found {len(results)} messages matching '{query}'")
+        return results
+    
+    def _sync_messages(self, thread: dict, bot: str):
+        # Walk back from the newest page until the last synced message is reached
+        synced = self.archive.get_synced_through(thread['chatId'])
+        newest = None
+        new_messages = 0
+        for _, edges in self._iter_message_pages(thread['id'], prefetch=False):
+            if not edges:
+                break
+            nodes = [edge['node'] for edge in edges]
+            new_messages += self.archive.save_messages(thread['chatId'], nodes, bot)
+            if newest == None:
+                # Messages still being generated are fetched again on the next sync
+                newest = next((node['messageId'] for node in reversed(nodes) if node.get('state', 'complete') == 'complete'), None)
+            if synced != None and nodes[0]['messageId'] <= synced:
+                break
+        if newest != None:
+            self.archive.set_synced_through(thread['chatId'], newest)
+        return new_messages
+    
+    def iter_previous_messages(self, bot: str, chatId: int = None, chatCode: str = None, oldest_first: bool = False, fields: tuple = MESSAGE_FIELDS, page_size: int = 100, prefetch: bool = True) -> Generator[dict, None, None]:
+        bot = self.resolver.resolve(bot)
+        try:
+            getchatdata = self.get_threadData(bot, chatCode, chatId)
+        except:
+            raise RuntimeError(f"Thread not found. Make sure the thread exists before getting messages.")
+        yield from self._iter_messages(getchatdata['id'], oldest_first, fields, page_size, prefetch)
+    
+    def _get_message_page(self, id: str, cursor: str = None, page_size: int = 100):
+        variables = {'count': page_size, 'cursor': cursor, 'id': id}
+        response_json = self.send_request('gql_POST', 'ChatListPaginationQuery', variables)
+        connection = response_json['data']['node']['messagesConnection']
+        pageInfo = connection['pageInfo']
+        return connection['edges'], pageInfo['startCursor'], pageInfo.get('hasPreviousPage', True)
+    
+    def _iter_message_pages(self, id: str, cursors: list = None, page_size: int = 100, prefetch: bool = True):
+        # Pages are requested one ahead of the consumer. Without cursors the chain is followed
+        # from the newest page backwards, otherwise the given cursors are fetched in order.
+        replay = deque(cursors) if cursors != None else None
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            cursor = replay.popleft() if replay else None
+            pending = executor.submit(self._get_message_page, id, cursor, page_size)
+            while pending:
+                edges, start_cursor, has_previous = pending.result()
+                if replay == None:
+                    more, next_cursor = bool(edges) and has_previous, start_cursor
+                else:
+                    more = bool(replay)
+                    next_cursor = replay.popleft() if more else None
+                pending = executor.submit(self._get_message_page, id, next_cursor, page_size) if more and prefetch else None
+                yield cursor, edges
+                if more and not prefetch:
+                    pending = executor.submit(self._get_message_page, id, next_cursor, page_size)
+                cursor = next_cursor
+    
+    def _iter_messages(self, id: str, oldest_first: bool = False, fields: tuple = MESSAGE_FIELDS, page_size: int = 100, prefetch: bool = True):
+        project = (lambda node: node) if fields == None else (lambda node: {field: node.get(field) for field in fields})
+        if not oldest_first:
+            for _, edges in self._iter_message_pages(id, None, page_size, prefetch):
+                for edge in reversed(edges):
+                    yield project(edge['node'])
+            return
+        # Pages come newest first, so only the cursors are kept on the first pass.
+        # The newest and oldest pages stay in memory and the rest are fetched again from the oldest.
+        newest_edges, oldest_edges, cursors = None, None, []
+        for cursor, edges in self._iter_message_pages(id, None, page_size, prefetch):
+            if not edges:
+                break
+            if newest_edges == None:
+                newest_edges = edges
+            else:
+                cursors.append(cursor)
+            oldest_edges = edges
+        if newest_edges == None:
+            return
+        if cursors:
+            cursors.pop()
+            for edge in oldest_edges:
+                yield project(edge['node'])
+            if cursors:
+                for _, edges in self._iter_message_pages(id, cursors[::-1], page_size, prefetch):
+                    for edge in edges:
+                        yield project(edge['node'])
+        for edge in newest_edges:
+            yield project(edge['node'])
+    
     def get_user_bots(self, user: str):
         variables = {'handle': user}
         response_json = self.send_request('gql_POST', 'HandleProfilePageQuery', variables)
@@ -1354,7 +1524,10 @@ class PoeApi:
         else:
             logger.info(f"Bot deleted successfully | {handle}")
             
-    def get_available_categories(self):
+    def get_available_categories(self, refresh: bool=False):
+        # The category list rarely changes, so it is fetched once per client
+        if self.categories != None and not refresh:
+            return self.categories
         categories = []
         response_json = self.send_request('gql_POST', 'ExploreBotsIndexPageQuery', {"categoryName":"defaultCategory"})
         if response_json['data'] == None and response_json["errors"]:
@@ -1362,77 +1535,110 @@ class PoeApi:
         else:
             for category in response_json['data']['exploreBotsCategoryObjects']:
                 categories.append(category['categoryName'])
+        self.categories = categories
         return categories
-                
-    def explore(self, categoryName: str='defaultCategory', search: str=None, entity_type: str = "bot", count: int = 50, explore_all: bool = False):
+    
+    def _validate_explore(self, categoryName: str, entity_type: str):
         if entity_type not in ["bot", "user"]:
             raise ValueError(f"Entity type {entity_type} not found. Make sure the entity type is either bot or user.")
         if categoryName != 'defaultCategory' and categoryName not in self.get_available_categories():
             raise ValueError(f"Category {categoryName} not found. Make sure the category exists before exploring.")
-        bots = []
+    
+    def _iter_explore_pages(self, categoryName: str='defaultCategory', search: str=None, entity_type: str="bot", page_size: int=50):
         if search == None:
             query_name = "ExploreBotsListPaginationQuery"
-            variables = {"categoryName": categoryName, "count": count}
+            variables = {"categoryName": categoryName, "count": page_size}
             connectionType = "exploreBotsConnection"
         else:
             query_name = "SearchResultsListPaginationQuery"
             variables = {"query": search, "entityType": entity_type, "count": 50}
             connectionType = "searchEntityConnection"
-            
-        result = self.send_request("gql_POST", query_name, variables)
-        if search == None:
-            new_cursor = result["data"][connectionType]["edges"][-1]["cursor"]
-        else:
-            new_cursor = 60
-            
-        if entity_type == "bot":
-            bots += [
-                each["node"]['handle'] for each in result["data"][connectionType]["edges"]
-            ]
-        else:
-            bots += [
-                each["node"]['nullableHandle'] for each in result["data"][connectionType]["edges"]
-            ]
-        if len(bots) >= count and not explore_all:
-            if entity_type == "bot":
-                logger.info("Succeed to explore bots")
-            else:
-                logger.info("Succeed to explore users")
-            return bots[:count]
-        while len(bots) < count or explore_all:
+        key = 'handle' if entity_type == "bot" else 'nullableHandle'
+        cursor = None
+        while True:
+            result = self.send_request("gql_POST", query_name, variables if cursor == None else {**variables, "cursor": cursor})
+            edges = result["data"][connectionType]["edges"]
+            if len(edges) == 0:
+                return
+            yield [each["node"][key] for each in edges]
             if search == None:
-                result = self.send_request("gql_POST", query_name, {"categoryName": categoryName, "count": count, "cursor": new_cursor})
+                cursor = edges[-1]["cursor"]
             else:
-                result = self.send_request("gql_POST", query_name, {"query": search, "entityType": entity_type, "count": 50, "cursor": new_cursor})
-            if len(result["data"][connectionType]["edges"]) == 0:
-                if not explore_all:
-                    if entity_type == "bot":
-                        logger.info(f"No more bots could be explored, only {len(bots)} bots found.")
-                    else:
-                        logger.info(f"No more users could be explored, only {len(bots)} users found.")
+                cursor = 60 if cursor == None else cursor + 50
+                
+    def explore(self, categoryName: str='defaultCategory', search: str=None, entity_type: str = "bot", count: int = 50, explore_all: bool = False):
+        self._validate_explore(categoryName, entity_type)
+        bots, seen = [], set()
+        for handles in self._iter_explore_pages(categoryName, search, entity_type, page_size=count):
+            for handle in handles:
+                if handle not in seen:
+                    seen.add(handle)
+                    bots.append(handle)
+            if len(bots) >= count and not explore_all:
+                break
+        else:
+            if not explore_all:
+                logger.info(f"No more {entity_type}s could be explored, only {len(bots)} {entity_type}s found.")
                 return bots
-            if search == None:
-                new_cursor = result["data"][connectionType]["edges"][-1]["cursor"]
-            else:
-                new_cursor += 50
-            if entity_type == "bot":
-                new_bots = [
-                    each["node"]['handle'] for each in result["data"][connectionType]["edges"]
-                ]
-            else:
-                new_bots = [
-                    each["node"]['nullableHandle'] for each in result["data"][connectionType]["edges"]
-                ]
-            bots += new_bots
+        logger.info(f"Succeed to explore {entity_type}s")
+        return bots if explore_all else bots[:count]
+    
+    def crawl_explore(self, categories: list=None, searches: list=None, entity_type: str="bot", concurrency: int=4, page_size: int=50) -> Generator[str, None, None]:
+        # Crawls every source concurrently and streams each handle once, as soon as its page arrives
+        if categories == None and searches == None:
+            categories = self.get_available_categories()
+        categories, searches = categories or [], searches or []
+        for categoryName in categories or ['defaultCategory']:
+            self._validate_explore(categoryName, entity_type)
+        
+        # Bounded so the crawl never runs far ahead of the consumer, a caller that stops early stops the requests too
+        pages = queue.Queue(maxsize=concurrency * 2)
+        stopped = threading.Event()
+        
+        def put(handles):
+            while not stopped.is_set():
+                try:
+                    pages.put(handles, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
         
-        if entity_type == "bot":
-            logger.info("Succeed to explore bots")
-        else:
-            logger.info("Succeed to explore users")
-        return bots[:count]
+        def produce(categoryName, search):
+            try:
+                for handles in self._iter_explore_pages(categoryName, search, entity_type, page_size):
+                    if not put(handles):
+                        return
+            except Exception as e:
+                logger.error(f"Failed to crawl {search if search != None else categoryName}: {e}")
+            finally:
+                put(None)
+        
+        sources = [(categoryName, None) for categoryName in categories] + [('defaultCategory', search) for search in searches]
+        # The pool size is the shared limit on requests in flight
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+        futures = [executor.submit(produce, *source) for source in sources]
+        seen, pending = set(), len(sources)
+        try:
+            while pending:
+                handles = pages.get()
+                if handles == None:
+                    pending -= 1
+                    continue
+                for handle in handles:
+                    if handle not in seen:
+                        seen.add(handle)
+                        yield handle
+            logger.info(f"Succeed to crawl {len(seen)} {entity_type}s from {len(sources)} sources")
+        finally:
+            stopped.set()
+            # The sources that have not started yet are dropped
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
     
     def share_chat(self, bot: str, chatId: int=None, chatCode: str=None, count: int=None):
-        bot = bot_map(bot)
+        bot = self.resolver.resolve(bot)
         chatdata = self.get_threadData(bot, chatCode, chatId)
         chatCode = chatdata['chatCode']
         chatId = chatdata['chatId']
@@ -1455,7 +1661,7 @@ class PoeApi:
             return None
         
     def import_chat(self, bot:str="", shareCode: str=""):
-        bot = bot_map(bot)
+        bot = self.resolver.resolve(bot)
         variables = {'botName': bot, 'shareCode': shareCode, 'postId': None}
         response_json = self.send_request('gql_POST', 'ContinueChatCTAButton_continueChatFromPoeShare_Mutation', variables)
         if response_json['data']['continueChatFromPoeShare']['status'] == 'success':
@@ -1486,8 +1692,9 @@ class PoeApi:
                 bot['name'] = bot['bot']
             if 'talkativeness' not in bot:
                 bot['talkativeness'] = 0.5
-            bots_list.append({'bot': bot_map(bot['bot']), 'name': bot['name'].lower(), 'chatId': None, 'chatCode': None, 'priority': 0, 'bot_log': [], 'talkativeness': bot['talkativeness']})
+            bots_list.append({'bot': self.resolver.resolve(bot['bot']), 'name': bot['name'].lower(), 'chatId': None, 'chatCode': None, 'priority': 0, 'bot_log': [], 'talkativeness': bot['talkativeness']})
         self.groups[group_name] = {'bots': bots_list, 'conversation_log': [], 'previous_bot': '', 'dual_lock': ['','']}
+        self.get_mention_matcher(group_name)
         logger.info(f"Group {group_name} created with the following bots: {bots}")
         return group_name
     
@@ -1499,6 +1706,9 @@ class PoeApi:
                 if chatdata['chatId'] != None:
                     self.delete_chat(bot, chatdata['chatId'])
         del self.groups[group_name]
+        self.group_files.pop(group_name, None)
+        self.group_matchers.pop(group_name, None)
+        self.group_contexts.pop(group_name, None)
         logger.info(f"Group {group_name} deleted")
         
     def get_available_groups(self):
@@ -1510,35 +1720,46 @@ class PoeApi:
         return self.groups[group_name]
     
     def save_group_history(self, group_name: str, file_path: str=None):
-        try:
-            oldData = self.load_group_history(group_name, file_path=file_path)
-            oldData = oldData['group_data']['conversation_log']
-        except:
-            oldData = None
-        
-        groupData = self.groups[group_name]
-        if oldData != None:
-            new_conversation_log = oldData + groupData['conversation_log']
-        else:
-            new_conversation_log = groupData['conversation_log']
-        saveData = {
-            'bots' : groupData['bots'],
-            'conversation_log' : new_conversation_log,
-            'previous_bot' : groupData['previous_bot'],
-            'dual_lock' : groupData['dual_lock']
-        }
+        if group_name not in self.groups:
+            raise ValueError(f"Group {group_name} not found. Make sure the group exists before saving.")
         if file_path == None:
-            file_path = group_name + '.json'
-        else:
-            # check if file path is valid and is a json file
-            if not os.path.exists(file_path):
-                raise ValueError(f"File path {file_path} is invalid.")
-            if not file_path.endswith('.json'):
-                raise ValueError(f"File path {file_path} is not a json file.")
-        with open(file_path, 'w') as f:
-            f.write(orjson.dumps(saveData, option=orjson.OPT_INDENT_2))
+            file_path = group_name + '.jsonl'
+        elif not file_path.endswith('.jsonl'):
+            raise ValueError(f"File path {file_path} is not a jsonl file.")
+        
+        # Only the turns added since the last save are appended, followed by the current group state
+        saved = self.group_files.get(group_name)
+        if saved == None or saved['path'] != file_path:
+            saved = self.group_files[group_name] = {'path': file_path, 'saved': 0, 'states': 0}
+        groupData = self.groups[group_name]
+        turns = groupData['conversation_log'][saved['saved']:]
+        records = encode_group_records(groupData, turns)
+        if os.path.exists(file_path) and os.stat(file_path).st_size > 0:
+            with open(file_path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    records = b'\n' + records
+        with open(file_path, 'ab') as f:
+            f.write(records)
+        saved['saved'] = len(groupData['conversation_log'])
+        saved['states'] += 1
+        if saved['states'] >= COMPACT_AFTER:
+            self.compact_group_history(group_name)
         logger.info(f"Group {group_name} saved to {file_path}")
         return file_path
+    
+    def compact_group_history(self, group_name: str):
+        if group_name not in self.group_files:
+            raise ValueError(f"Group {group_name} has not been saved yet. Make sure the group is saved before compacting.")
+        file_path = self.group_files[group_name]['path']
+        with open(file_path, 'rb') as f:
+            records = compact_group_records(f.read())
+        with open(file_path + '.tmp', 'wb') as f:
+            f.write(records)
+        os.replace(file_path + '.tmp', file_path)
+        self.group_files[group_name]['states'] = 1
+        logger.info(f"Group {group_name} history compacted")
+        return file_path
         
     def load_group_history(self, file_path: str=None):
         if file_path == None:
@@ -1546,35 +1767,63 @@ class PoeApi:
         else:
             if not os.path.exists(file_path):
                 raise ValueError(f"File path {file_path} is invalid.")
-            if not file_path.endswith('.json'):
-                raise ValueError(f"File path {file_path} is not a json file.")
+            if not file_path.endswith(('.json', '.jsonl')):
+                raise ValueError(f"File path {file_path} is not a json or jsonl file.")
             if os.stat(file_path).st_size == 0:
                 raise ValueError(f"File path {file_path} is empty.")
         with open(file_path, 'rb') as f:
-            groupData = orjson.loads(f.read())
-        group_name = file_path.split('.')[0]
+            data = f.read()
+        group_name = os.path.splitext(os.path.basename(file_path))[0]
+        if file_path.endswith('.jsonl'):
+            groupData, states = parse_group_history(data)
+            self.group_files[group_name] = {'path': file_path, 'saved': len(groupData['conversation_log']), 'states': states}
+        else:
+            groupData = orjson.loads(data)
         self.groups[group_name] = groupData
+        self.group_contexts.pop(group_name, None)
+        self.get_mention_matcher(group_name)
         logger.info(f"Group {group_name} loaded from {file_path}")
         return {'group_name': group_name, 'group_data': groupData}
     
+    def get_group_context(self, group_name: str, max_tokens: int=3000):
+        # Seeded from the conversation log, then updated turn by turn. A log that was replaced or loaded seeds a new context
+        log = self.groups[group_name]['conversation_log']
+        if group_name not in self.group_contexts or self.group_contexts[group_name][0] is not log:
+            context = RollingContext(max_tokens)
+            context.extend(log)
+            self.group_contexts[group_name] = (log, context)
+        context = self.group_contexts[group_name][1]
+        context.max_tokens = max_tokens
+        return context
+    
+    def _reset_group_log(self, group_name: str, context_tokens: int) -> RollingContext:
+        # Every round starts a new conversation log, the prompts are built from the same turns as the log
+        self.groups[group_name]['conversation_log'] = []
+        if group_name in self.group_files:
+            self.group_files[group_name]['saved'] = 0
+        return self.get_group_context(group_name, context_tokens)
+    
+    def get_mention_matcher(self, group_name: str):
+        # Rebuilt only when the bots of the group change
+        bots = self.groups[group_name]['bots']
+        key = tuple((bot['bot'], bot['name']) for bot in bots)
+        if group_name not in self.group_matchers or self.group_matchers[group_name][0] != key:
+            self.group_matchers[group_name] = (key, MentionMatcher(bots))
+        return self.group_matchers[group_name][1]
+    
     def get_most_mentioned(self, group_name: str, message: str):
-        mod_message = message.lower()
         bots = self.groups[group_name]['bots']
         if len(bots) == 1:
             return bots[0]
-        if any(bot['name'] in mod_message for bot in bots):
-            for bot in bots:
-                bot['priority'] = 0
-            for bot in bots:
-                bot_model = bot['bot']
-                bot_name = bot['name']
-                bot['priority'] += mod_message.count(bot_model)
-                bot['priority'] += mod_message.count(bot_name)
-            sorted_bots = sorted(bots, key=lambda k: k['priority'], reverse=True)
-            if sorted_bots[0]['name'] != self.groups[group_name]['previous_bot']:
-                topBot = sorted_bots[0]
+        priorities, mentioned = self.get_mention_matcher(group_name).count(message.lower())
+        if mentioned:
+            for bot, priority in zip(bots, priorities):
+                bot['priority'] = priority
+            first, second = top_two(bots)
+            if first['name'] != self.groups[group_name]['previous_bot']:
+                topBot = first
             else:
-                topBot = sorted_bots[1]
+                topBot = second
         else:
             topBot = random.choice(bots)
             while topBot['name'] == self.groups[group_name]['previous_bot']:
@@ -1583,55 +1832,101 @@ class PoeApi:
         return topBot
         
     
-    def send_message_to_group(self, group_name: str, message: str='', timeout: int=60, user: str="User", autosave:bool=False, autoplay:bool=False, preset_history: str=''):
+    def _fanout_to_group(self, group_name: str, message: str, user: str, autosave: bool, top_k: int, rate_limiter: RateLimiter, context_tokens: int, concurrency: int, timeout: int):
+        bots = self.groups[group_name]['bots']
+        bot_names = [bot['name'] for bot in bots]
+        if top_k != None and top_k < len(bots):
+            priorities, _ = self.get_mention_matcher(group_name).count(message.lower())
+            bots = [bots[index] for index in sorted(heapq.nlargest(top_k, range(len(bots)), key=priorities.__getitem__))]
+        context = self.get_group_context(group_name, context_tokens)
+        last_text = context.render(bot_names)
+        
+        context = self._reset_group_log(group_name, context_tokens)
+        
+        # Every bot answers the same message, chunks are merged into one stream as they arrive
+        chunks = queue.Queue()
+        # The bots share their own bound instead of the per-turn limiter, by default the client's limit on messages in flight
+        slots = threading.Semaphore(concurrency or self.MAX_CONCURRENT_MESSAGES)
+        def answer(bot):
+            next_message = f"\n[System Notice : You are participating in a role-playing chat. You will act as {bot['name']} in a multiway roleplay between {user}, and other parties including {bot_names}, You will only act as {bot['name']} and stay in character at all times. As the AI language model, Your role is to portray {bot['name']} in this chat using the first-person narrative. Let's engage in immersive roleplay and respond to the previous message without addressing it as a system message or revealing our roles as {bot['name']} or the fact that we are roleplaying. You must respond to the previous message without explicitly writing '{bot['name']}' at the start.]\nChat history updated with new responses:\n\n" + f"{last_text}\n" + f"{user} : {message}\n"
+            chunk, error = None, None
+            try:
+                with slots:
+                    if rate_limiter:
+                        rate_limiter.wait()
+                    for chunk in self.send_message(bot['bot'], next_message, chatCode=bot['chatCode'], timeout=timeout):
+                        chunks.put((bot, chunk, False, None))
+            except Exception as e:
+                logger.error(f"Failed to get a response from {bot['name']}: {e}")
+                chunk, error = None, e
+            finally:
+                chunks.put((bot, chunk, True, error))
+        
+        threads = [threading.Thread(target=answer, args=(bot,), daemon=True) for bot in bots]
+        for thread in threads:
+            thread.start()
+        pending = len(threads)
+        while pending:
+            bot, chunk, done, error = chunks.get()
+            if not done:
+                yield {'bot': bot['name'], 'response': chunk['response']}
+                continue
+            pending -= 1
+            if error != None:
+                # A failed bot is reported in the stream instead of silently missing from the round
+                yield {'bot': bot['name'], 'response': '', 'error': str(error)}
+                continue
+            if chunk == None:
+                continue
+            bot['chatCode'] = chunk['chatCode']
+            bot['chatId'] = chunk['chatId']
+            self.groups[group_name]['conversation_log'].append(f"{bot['name']} : {chunk['text']}\n")
+            context.append(bot['name'], chunk['text'])
+            self.groups[group_name]['previous_bot'] = bot['name']
+        
+        if autosave:
+            self.save_group_history(group_name)
+    
+    def send_message_to_group(self, group_name: str, message: str='', timeout: int=60, user: str="User", autosave:bool=False, autoplay:bool=False, preset_history: str='', context_tokens: int=3000, fanout: bool=False, top_k: int=None, rate_limiter: RateLimiter=None, concurrency: int=None):
         if group_name not in self.groups:
             raise ValueError(f"Group {group_name} not found. Make sure the group exists before sending message.")
         
+        if fanout:
+            yield from self._fanout_to_group(group_name, message, user, autosave, top_k, rate_limiter, context_tokens, concurrency, timeout)
+            return
+        
+        rate_limiter = rate_limiter or self.group_limiter
         bots = self.groups[group_name]['bots']
         bot_names = [bot['name'] for bot in bots]
         
-        last_text = ""
-        preset_log = []
-        
+        context = self.get_group_context(group_name, context_tokens)
         if preset_history == '':
-            if self.groups[group_name]['conversation_log'] != []:
-                # load all the messages in the conversation log from oldest to newest
-                old_logs = self.groups[group_name]['conversation_log'][1:]
-                for text in old_logs:
-                    if text.split(":")[0].strip() in bot_names:
-                        last_text += text
-                        last_text += "\n"
+            history = context
         else:
-            preset_log = self.load_group_history(file_path=preset_history)['group_data']['conversation_log']
-            if preset_log != []:
-                for text in preset_log:
-                    if text.split(":")[0].strip() in bot_names:
-                        last_text += text
-                        last_text += "\n"
+            history = RollingContext(context_tokens)
+            history.extend(self.load_group_history(file_path=preset_history)['group_data']['conversation_log'])
+        last_text = history.render(bot_names)
         
         if autoplay == False:
             previous_text = ""
             current_bot = self.get_most_mentioned(group_name, message)
-            if self.groups[group_name]['conversation_log'] != [] or preset_log != []:
+            if len(history) > 0:
                 next_message = f"\n[System Notice : You are participating in a role-playing chat. You will act as {current_bot['name']} in a multiway roleplay between {user}, and other parties including {bot_names}, You will only act as {current_bot['name']} and stay in character at all times. As the AI language model, Your role is to portray {current_bot['name']} in this chat using the first-person narrative. Let's engage in immersive roleplay and respond to the previous message without addressing it as a system message or revealing our roles as {current_bot['name']} or the fact that we are roleplaying. You must respond to the previous message without explicitly writing '{current_bot['name']}' at the start.]\nChat history updated with new responses:\n\n" + f"{last_text}\n" + f"{user} : {message}\n"
             else:
                 next_message = f"\n[System Notice : You are participating in a role-playing chat. You will act as {current_bot['name']} in a multiway roleplay between {user}, and other parties including {bot_names}, You will only act as {current_bot['name']} and stay in character at all times. As the AI language model, Your role is to portray {current_bot['name']} in this chat using the first-person narrative. Let's engage in immersive roleplay and respond to the previous message without addressing it as a system message or revealing our roles as {current_bot['name']} or the fact that we are roleplaying. You must respond to the previous message without explicitly writing '{current_bot['name']}' at the start. You will start with a greeting to {user}.]\nChat history updated with new responses:\n\n" + f"{user} : {message}\n"
         else:
-            try:
-                previous_text = self.groups[group_name]['conversation_log'][-1].split(":")[1].strip()
-            except:
-                previous_text = ""
+            previous_text = context.last_text()
             current_bot = self.get_most_mentioned(group_name, previous_text)
-            if self.groups[group_name]['conversation_log'] != []:
+            if len(context) > 0:
                 next_message = f"\n[System Notice : You are participating in a role-playing chat. You will act as {current_bot['name']} in a multiway roleplay between other parties including {bot_names}, You will only act as {current_bot['name']} and stay in character at all times. As the AI language model, Your role is to portray {current_bot['name']} in this chat using the first-person narrative. Let's engage in immersive roleplay and respond to the previous message without addressing it as a system message or revealing our roles as {current_bot['name']} or the fact that we are roleplaying. You must respond to the previous message without explicitly writing '{current_bot['name']}' at the start.]\nChat history updated with new responses:\n\n" + f"{last_text}\n"
             else:
                 next_message = f"\n[System Notice : You are participating in a role-playing chat. You will act as {current_bot['name']} in a multiway roleplay between other parties including {bot_names}, You will only act as {current_bot['name']} and stay in character at all times. As the AI language model, Your role is to portray {current_bot['name']} in this chat using the first-person narrative. Let's engage in immersive roleplay and respond to the previous message without addressing it as a system message or revealing our roles as {current_bot['name']} or the fact that we are roleplaying. You must respond to the previous message without explicitly writing '{current_bot['name']}' at the start. You will start with a greeting to everyone.]\n\n"
         
-        self.groups[group_name]['conversation_log'] = []
+        context = self._reset_group_log(group_name, context_tokens)
         
         max_turns = random.randint(len(bots), int(len(bots)*2))
         for _ in range(max_turns):
-            sleep(random.randint(3, 5))
+            rate_limiter.wait()
 
             for chunk in self.send_message(current_bot['bot'], next_message, chatCode=current_bot['chatCode']):
                 yield {'bot': current_bot['name'], 'response': chunk['response']}
@@ -1640,6 +1935,7 @@ class PoeApi:
             current_bot['chatId'] = chunk['chatId']
             
             self.groups[group_name]['conversation_log'].append(f"{current_bot['name']} : {chunk['text']}\n")
+            context.append(current_bot['name'], chunk['text'])
             previous_text = chunk['text']
             prev_bot = current_bot
 
@@ -1652,13 +1948,10 @@ class PoeApi:
             # Append the second bot to dual lock  
             if current_bot['name'] in self.groups[group_name]['dual_lock']:
                 # The same dual lock
-                current_bot['bot_log'] = [self.groups[group_name]['conversation_log'][-1]]
+                current_bot['bot_log'] = context.window(bot_names, count=1)
             else:
                 # New dual lock
-                if len(self.groups[group_name]['conversation_log']) > 10:
-                    current_bot['bot_log'] = self.groups[group_name]['conversation_log'][-10:]
-                else:
-                    current_bot['bot_log'] = self.groups[group_name]['conversation_log']  
+                current_bot['bot_log'] = context.window(bot_names, count=10)
                     
                 for index in range(len(self.groups[group_name]['dual_lock'])):
                     if self.groups[group_name]['dual_lock'][index] != prev_bot['name']:
@@ -1670,10 +1963,7 @@ class PoeApi:
             else:
                 next_message = f"\n[System Notice : You are participating in a role-playing chat. You will act as {current_bot['name']} in a multiway roleplay between other parties including {bot_names}, You will only act as {current_bot['name']} and stay in character at all times. As the AI language model, Your role is to portray {current_bot['name']} in this chat using the first-person narrative. Let's engage in immersive roleplay and respond to the previous message without addressing it as a system message or revealing our roles as {current_bot['name']} or the fact that we are roleplaying. You must respond to the previous message without explicitly writing '{current_bot['name']}' at the start.]\nChat history updated with new responses:\n\n"
 
-            for text in current_bot['bot_log']:
-                if text.split(":")[0].strip() in bot_names:
-                    next_message += text
-                    next_message += "\n"
+            next_message += ''.join(f"{text}\n" for text in current_bot['bot_log'])
                     
         if autosave:
             self.save_group_history(group_name)
\ No newline at end of file
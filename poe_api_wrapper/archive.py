@@ -0,0 +1,224 @@
+import sqlite3, threading, hashlib, os, re
+from datetime import datetime
+from loguru import logger
+from .utils import MESSAGE_FIELDS
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS threads (
+    account TEXT NOT NULL,
+    chatId INTEGER NOT NULL,
+    chatCode TEXT NOT NULL,
+    id TEXT,
+    bot TEXT,
+    title TEXT,
+    PRIMARY KEY (account, chatId)
+);
+CREATE INDEX IF NOT EXISTS threads_code ON threads (account, chatCode);
+CREATE INDEX IF NOT EXISTS threads_bot ON threads (account, bot, chatId);
+
+CREATE TABLE IF NOT EXISTS messages (
+    account TEXT NOT NULL,
+    messageId INTEGER NOT NULL,
+    chatId INTEGER NOT NULL,
+    bot TEXT,
+    author TEXT,
+    text TEXT,
+    contentType TEXT,
+    state TEXT,
+    creationTime INTEGER,
+    PRIMARY KEY (account, messageId)
+);
+CREATE INDEX IF NOT EXISTS messages_chat ON messages (account, chatId, messageId);
+
+CREATE TABLE IF NOT EXISTS sync_state (
+    account TEXT NOT NULL,
+    chatId INTEGER NOT NULL,
+    syncedThrough INTEGER,
+    PRIMARY KEY (account, chatId)
+);
+"""
+
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE messages_fts USING fts5 (text, content='messages', content_rowid='rowid', tokenize='porter unicode61');
+CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts (rowid, text) VALUES (new.rowid, new.text);
+END;
+CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, text) VALUES ('delete', old.rowid, old.text);
+END;
+CREATE TRIGGER messages_fts_update AFTER UPDATE OF text ON messages BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, text) VALUES ('delete', old.rowid, old.text);
+    INSERT INTO messages_fts (rowid, text) VALUES (new.rowid, new.text);
+END;
+INSERT INTO messages_fts (messages_fts) VALUES ('rebuild');
+"""
+
+def to_microseconds(value):
+    # Poe stores creationTime in microseconds, accept datetimes and unix seconds as well
+    if value == None:
+        return None
+    if isinstance(value, datetime):
+        return int(value.timestamp() * 1e6)
+    return int(value * 1e6)
+
+class ChatArchive:
+    def __init__(self, path: str, tokens: dict):
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.path = path
+        # Rows are keyed by a digest of the p-b cookie so the cookie itself never lands on disk
+        self.account = hashlib.sha256(tokens['p-b'].encode()).hexdigest()[:16]
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+        self.fts = self.init_fts()
+        self.conn.commit()
+        logger.info(f"Chat archive opened at {path}")
+
+    def init_fts(self) -> bool:
+        # The index is kept in sync by triggers, so every archived message becomes searchable
+        if self.conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'").fetchone():
+            return True
+        try:
+            self.conn.executescript(FTS_SCHEMA)
+            return True
+        except sqlite3.OperationalError as e:
+            logger.warning(f"SQLite FTS5 is unavailable, falling back to plain text search. Reason: {e}")
+            return False
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def save_threads(self, bot: str, threads: list) -> int:
+        # Returns how many of the threads were not archived yet
+        if not threads:
+            return 0
+        chatIds = [thread['chatId'] for thread in threads]
+        with self.lock:
+            known = {row[0] for row in self.conn.execute(
+                f"SELECT chatId FROM threads WHERE account = ? AND chatId IN ({','.join('?' * len(chatIds))})",
+                [self.account] + chatIds
+            )}
+            self.conn.executemany(
+                "INSERT INTO threads (account, chatId, chatCode, id, bot, title) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (account, chatId) DO UPDATE SET chatCode = excluded.chatCode, id = excluded.id, bot = excluded.bot, title = excluded.title",
+                [(self.account, thread['chatId'], thread['chatCode'], thread['id'], bot, thread['title']) for thread in threads]
+            )
+            self.conn.commit()
+        return len(set(chatIds) - known)
+
+    def count_threads(self) -> int:
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM threads WHERE account = ?", (self.account,)).fetchone()[0]
+
+    def get_thread(self, chatCode: str=None, chatId: int=None):
+        with self.lock:
+            if chatCode != None:
+                row = self.conn.execute("SELECT chatId, chatCode, id, bot, title FROM threads WHERE account = ? AND chatCode = ?", (self.account, chatCode)).fetchone()
+            elif chatId != None:
+                row = self.conn.execute("SELECT chatId, chatCode, id, bot, title FROM threads WHERE account = ? AND chatId = ?", (self.account, chatId)).fetchone()
+            else:
+                return None
+        return dict(row) if row else None
+
+    def get_threads(self, bot: str=None) -> list:
+        with self.lock:
+            if bot == None:
+                rows = self.conn.execute("SELECT chatId, chatCode, id, bot, title FROM threads WHERE account = ? ORDER BY chatId DESC", (self.account,)).fetchall()
+            else:
+                rows = self.conn.execute("SELECT chatId, chatCode, id, bot, title FROM threads WHERE account = ? AND bot = ? ORDER BY chatId DESC", (self.account, bot)).fetchall()
+        return [dict(row) for row in rows]
+
+    def delete_thread(self, chatId: int):
+        with self.lock:
+            self.conn.execute("DELETE FROM messages WHERE account = ? AND chatId = ?", (self.account, chatId))
+            self.conn.execute("DELETE FROM sync_state WHERE account = ? AND chatId = ?", (self.account, chatId))
+            self.conn.execute("DELETE FROM threads WHERE account = ? AND chatId = ?", (self.account, chatId))
+            self.conn.commit()
+
+    def clear(self):
+        with self.lock:
+            for table in ("messages", "sync_state", "threads"):
+                self.conn.execute(f"DELETE FROM {table} WHERE account = ?", (self.account,))
+            self.conn.commit()
+
+    def save_messages(self, chatId: int, nodes: list, bot: str=None) -> int:
+        # Returns how many of the messages were not archived yet
+        if not nodes:
+            return 0
+        messageIds = [node['messageId'] for node in nodes]
+        with self.lock:
+            known = {row[0] for row in self.conn.execute(
+                f"SELECT messageId FROM messages WHERE account = ? AND messageId IN ({','.join('?' * len(messageIds))})",
+                [self.account] + messageIds
+            )}
+            self.conn.executemany(
+                "INSERT INTO messages (account, messageId, chatId, bot, author, text, contentType, state, creationTime) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (account, messageId) DO UPDATE SET text = excluded.text, state = excluded.state, "
+                "bot = COALESCE(excluded.bot, messages.bot), creationTime = COALESCE(excluded.creationTime, messages.creationTime)",
+                [(self.account, node['messageId'], chatId, bot, node.get('author'), node.get('text'), node.get('contentType'), node.get('state'), node.get('creationTime')) for node in nodes]
+            )
+            self.conn.commit()
+        return len(set(messageIds) - known)
+
+    def get_messages(self, chatId: int, count: int=None, fields: tuple=MESSAGE_FIELDS) -> list:
+        # Returned from the oldest to the newest, like get_previous_messages
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT * FROM messages WHERE account = ? AND chatId = ? ORDER BY messageId DESC LIMIT ?",
+                (self.account, chatId, -1 if count == None else count)
+            ).fetchall()
+        return [{field: row[field] for field in fields} for row in reversed(rows)]
+
+    def get_synced_through(self, chatId: int):
+        with self.lock:
+            row = self.conn.execute("SELECT syncedThrough FROM sync_state WHERE account = ? AND chatId = ?", (self.account, chatId)).fetchone()
+        return row[0] if row else None
+
+    def set_synced_through(self, chatId: int, messageId: int):
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO sync_state (account, chatId, syncedThrough) VALUES (?, ?, ?) "
+                "ON CONFLICT (account, chatId) DO UPDATE SET syncedThrough = MAX(excluded.syncedThrough, COALESCE(sync_state.syncedThrough, 0))",
+                (self.account, chatId, messageId)
+            )
+            self.conn.commit()
+
+    def search(self, query: str, bot: str=None, author: str=None, chatId: int=None, since=None, until=None, limit: int=50, raw: bool=False) -> list:
+        conditions, params = ["m.account = ?"], [self.account]
+        if bot != None:
+            conditions.append("m.bot = ?")
+            params.append(bot)
+        if author != None:
+            conditions.append("m.author = ?")
+            params.append(author)
+        if chatId != None:
+            conditions.append("m.chatId = ?")
+            params.append(chatId)
+        if since != None:
+            conditions.append("m.creationTime >= ?")
+            params.append(to_microseconds(since))
+        if until != None:
+            conditions.append("m.creationTime < ?")
+            params.append(to_microseconds(until))
+        columns = "m.messageId, m.chatId, t.chatCode, t.title, m.bot, m.author, m.text, m.creationTime"
+        if self.fts:
+            # Plain queries are matched word by word, raw queries use the FTS5 syntax as is
+            match = query if raw else ' '.join(f'"{word}"' for word in re.findall(r"\w+", query))
+            if not match:
+                return []
+            sql = (f"SELECT {columns}, snippet(messages_fts, 0, '[', ']', '...', 16) AS snippet FROM messages_fts "
+                   "JOIN messages m ON m.rowid = messages_fts.rowid LEFT JOIN threads t ON t.account = m.account AND t.chatId = m.chatId "
+                   f"WHERE messages_fts MATCH ? AND {' AND '.join(conditions)} ORDER BY rank LIMIT ?")
+            params = [match] + params
+        else:
+            sql = (f"SELECT {columns}, NULL AS snippet FROM messages m LEFT JOIN threads t ON t.account = m.account AND t.chatId = m.chatId "
+                   f"WHERE m.text LIKE ? AND {' AND '.join(conditions)} ORDER BY m.messageId DESC LIMIT ?")
+            params = [f"%{query}%"] + params
+        with self.lock:
+            rows = self.conn.execute(sql, params + [limit]).fetchall()
+        return [dict(row) for row in rows]
@@ -0,0 +1,112 @@
+import orjson, threading, hashlib, os
+from time import time
+from loguru import logger
+
+class BotCatalog:
+    def __init__(self, tokens: dict, path: str=None, ttl: int=600):
+        self.path = path
+        self.ttl = ttl
+        self.account = hashlib.sha256(tokens['p-b'].encode()).hexdigest()[:16]
+        self.lock = threading.Lock()
+        self.bots: dict[str, dict] = {}
+        self.names: dict[str, str] = {}
+        self.cursors: set = set()
+        # Where an unfinished walk over the pages resumes
+        self.endCursor: str = None
+        self.complete: bool = False
+        self.updatedAt: float = 0
+        self.refreshing: bool = False
+        if path:
+            self.load()
+
+    def __len__(self):
+        return len(self.bots)
+
+    def __contains__(self, name: str):
+        return self.get(name) != None
+
+    def is_stale(self) -> bool:
+        return time() - self.updatedAt > self.ttl
+
+    def get(self, name: str):
+        # Accepts either a handle or a display name
+        bot = self.bots.get(name)
+        if bot == None:
+            handle = self.names.get(name.lower())
+            bot = self.bots.get(handle) if handle != None else None
+        return bot
+
+    def list(self, count: int=None) -> list:
+        with self.lock:
+            bots = list(self.bots.values())
+        return bots if count == None else bots[:count]
+
+    def merge(self, nodes: list, cursor: str=None) -> int:
+        # Returns how many bots were not in the catalog yet, deleted bots are dropped
+        added = 0
+        with self.lock:
+            for node in nodes:
+                handle = node['handle']
+                if node.get('deletionState', 'not_deleted') != 'not_deleted':
+                    self._remove(handle)
+                    continue
+                if handle not in self.bots:
+                    added += 1
+                self.bots[handle] = node
+                if node.get('displayName'):
+                    self.names[node['displayName'].lower()] = handle
+            if cursor != None:
+                self.cursors.add(cursor)
+        return added
+
+    def prune(self, handles: set):
+        with self.lock:
+            for handle in [handle for handle in self.bots if handle not in handles]:
+                self._remove(handle)
+
+    def _remove(self, handle: str):
+        node = self.bots.pop(handle, None)
+        if node and node.get('displayName') and self.names.get(node['displayName'].lower()) == handle:
+            del self.names[node['displayName'].lower()]
+
+    def mark_refreshed(self):
+        self.updatedAt = time()
+        self.save()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'rb') as f:
+                data = orjson.loads(f.read())
+        except (OSError, orjson.JSONDecodeError) as e:
+            logger.warning(f"Failed to load bot catalog from {self.path}: {e}")
+            return
+        if data.get('account') != self.account:
+            return
+        self.merge(data['bots'])
+        self.cursors = set(data['cursors'])
+        self.endCursor = data['endCursor']
+        self.complete = data['complete']
+        self.updatedAt = data['updatedAt']
+        logger.info(f"Loaded {len(self.bots)} bots from {self.path}")
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            data = {
+                'account': self.account,
+                'updatedAt': self.updatedAt,
+                'complete': self.complete,
+                'endCursor': self.endCursor,
+                'cursors': list(self.cursors),
+                'bots': list(self.bots.values()),
+            }
+        directory = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        # Written to a temporary file first so a crash never leaves a truncated catalog
+        with open(f"{self.path}.tmp", 'wb') as f:
+            f.write(orjson.dumps(data))
+        os.replace(f"{self.path}.tmp", self.path)
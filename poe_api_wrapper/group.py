@@ -0,0 +1,170 @@
+import orjson
+from collections import deque
+from typing import Tuple
+from loguru import logger
+
+# Every save appends a state record, the file is rewritten once this many have piled up
+COMPACT_AFTER = 50
+
+def group_state(groupData: dict) -> dict:
+    return {
+        'type': 'state',
+        'bots': groupData['bots'],
+        'previous_bot': groupData['previous_bot'],
+        'dual_lock': groupData['dual_lock']
+    }
+
+def encode_group_records(groupData: dict, turns: list) -> bytes:
+    lines = [orjson.dumps({'type': 'turn', 'text': text}) for text in turns]
+    lines.append(orjson.dumps(group_state(groupData)))
+    return b'\n'.join(lines) + b'\n'
+
+def parse_group_history(data: bytes) -> Tuple[dict, int]:
+    # Returns the group data and the number of state records found in the file
+    groupData = {'bots': [], 'conversation_log': [], 'previous_bot': '', 'dual_lock': ['', '']}
+    states = 0
+    for line in data.splitlines():
+        if not line.strip():
+            continue
+        try:
+            record = orjson.loads(line)
+        except orjson.JSONDecodeError:
+            # A save interrupted halfway leaves a partial line behind
+            logger.warning(f"Skipped a corrupted group history record: {line[:50]}")
+            continue
+        if record['type'] == 'turn':
+            groupData['conversation_log'].append(record['text'])
+        elif record['type'] == 'state':
+            states += 1
+            groupData['bots'] = record['bots']
+            groupData['previous_bot'] = record['previous_bot']
+            groupData['dual_lock'] = record['dual_lock']
+    return groupData, states
+
+def compact_group_records(data: bytes) -> bytes:
+    groupData, _ = parse_group_history(data)
+    return encode_group_records(groupData, groupData['conversation_log'])
+
+class MentionMatcher:
+    # Aho-Corasick automaton over the bot models and names of a group, so one pass over a message scores every bot
+    def __init__(self, bots: list):
+        self.size = len(bots)
+        self.goto: list[dict] = [{}]
+        self.fail: list[int] = [0]
+        self.output: list[list] = [[]]
+        self.patterns: list[tuple] = []
+        targets = {}
+        for index, bot in enumerate(bots):
+            for pattern, is_name in ((bot['bot'].lower(), False), (bot['name'].lower(), True)):
+                if pattern:
+                    targets.setdefault(pattern, []).append((index, is_name))
+        for pattern, owners in targets.items():
+            self._add(pattern, owners)
+        self._link()
+
+    def _add(self, pattern: str, owners: list):
+        state = 0
+        for char in pattern:
+            if char not in self.goto[state]:
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+                self.goto[state][char] = len(self.goto) - 1
+            state = self.goto[state][char]
+        self.output[state].append(len(self.patterns))
+        self.patterns.append((len(pattern), owners))
+
+    def _link(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, child in self.goto[state].items():
+                queue.append(child)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(char, 0)
+                self.output[child] = self.output[child] + self.output[self.fail[child]]
+
+    def count(self, text: str) -> Tuple[list, bool]:
+        # Returns the priority of every bot and whether any bot name was mentioned.
+        # Occurrences of the same pattern never overlap, matching str.count
+        priorities = [0] * self.size
+        mentioned = False
+        last_end = [-1] * len(self.patterns)
+        state = 0
+        for position, char in enumerate(text):
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            for pattern_id in self.output[state]:
+                length, owners = self.patterns[pattern_id]
+                if position - length < last_end[pattern_id]:
+                    continue
+                last_end[pattern_id] = position
+                for index, is_name in owners:
+                    priorities[index] += 1
+                    mentioned = mentioned or is_name
+        return priorities, mentioned
+
+def top_two(bots: list) -> Tuple[dict, dict]:
+    # Same picks as a stable descending sort on priority, without sorting
+    first = second = None
+    for bot in bots:
+        if first == None or bot['priority'] > first['priority']:
+            first, second = bot, first
+        elif second == None or bot['priority'] > second['priority']:
+            second = bot
+    return first, second
+
+def approximate_tokens(text: str) -> int:
+    # Roughly 4 characters per token for English text, good enough to stay within context limits
+    return len(text) // 4 + 1
+
+class RollingContext:
+    # Most recent turns of a group as (speaker, text, tokens), kept within a token budget
+    def __init__(self, max_tokens: int=3000):
+        self.max_tokens = max_tokens
+        self.turns: deque = deque()
+        self.tokens = 0
+
+    def __len__(self):
+        return len(self.turns)
+
+    def append(self, speaker: str, text: str):
+        text = text.strip()
+        tokens = approximate_tokens(text)
+        if tokens > self.max_tokens:
+            # Keep the end of an oversized turn, it is what the next speaker answers to
+            text = text[-self.max_tokens * 4:]
+            tokens = approximate_tokens(text)
+        self.turns.append((speaker, text, tokens))
+        self.tokens += tokens
+        while self.tokens > self.max_tokens:
+            self.tokens -= self.turns.popleft()[2]
+
+    def extend(self, log: list):
+        # Accepts conversation_log entries formatted as "speaker : text"
+        for line in log:
+            speaker, _, text = line.partition(':')
+            self.append(speaker.strip(), text)
+
+    def last_text(self) -> str:
+        return self.turns[-1][1] if self.turns else ""
+
+    def window(self, speakers: list=None, count: int=None, max_tokens: int=None) -> list:
+        # Walks back from the newest turn, so the cost only depends on the size of the window
+        max_tokens = self.max_tokens if max_tokens == None else max_tokens
+        selected, tokens = [], 0
+        for index, (speaker, text, size) in enumerate(reversed(self.turns)):
+            if count != None and index >= count:
+                break
+            if tokens + size > max_tokens:
+                break
+            if speakers == None or speaker in speakers:
+                selected.append(f"{speaker} : {text}\n")
+                tokens += size
+        return selected[::-1]
+
+    def render(self, speakers: list=None, count: int=None, max_tokens: int=None) -> str:
+        return ''.join(f"{line}\n" for line in self.window(speakers, count, max_tokens))
@@ -8,9 +8,13 @@ except ImportError:
     LLM_PACKAGE = False
 
 class PoeServer:
-    def __init__(self, tokens: Dict[str, str], address: str="127.0.0.1", port: str="8000"):
+    def __init__(self, tokens: Dict[str, str], address: str="127.0.0.1", port: str="8000", response_cache: bool=False, cache_size: int=1000, cache_ttl: int=3600, cache_path: str=None,
+                 model_concurrency: int=16, account_concurrency: int=3, queue_size: int=64, queue_timeout: float=30, workers: int=1, token_store: str=None,
+                 batch_dir: str="batches", batch_concurrency: int=8, batch_rate: float=2.0, single_pass_tools: bool=False,
+                 stream_flush_bytes: int=64, stream_flush_ms: float=50, stream_flush_sentences: bool=True):
         try:
-            start_server(tokens, address, port)
+            start_server(tokens, address, port, response_cache, cache_size, cache_ttl, cache_path, model_concurrency, account_concurrency, queue_size, queue_timeout, workers, token_store,
+                         batch_dir, batch_concurrency, batch_rate, single_pass_tools, stream_flush_bytes, stream_flush_ms, stream_flush_sentences)
         except Exception as e:
             logger.error(f"Failed to start server: {e}")
             raise e
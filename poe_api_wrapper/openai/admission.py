@@ -0,0 +1,111 @@
+import asyncio
+from collections import Counter, deque
+
+class AdmissionRejected(Exception):
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class Ticket:
+    def __init__(self, controller: "AdmissionController", model: str, token: dict):
+        self.controller = controller
+        self.model = model
+        self.token = token
+        self.released = False
+
+    def release(self):
+        # Safe to call more than once, the streaming generator and the request handler may both try
+        if not self.released:
+            self.released = True
+            self.controller.release(self.model, self.token)
+
+    async def renew(self, tokens: list):
+        # Moves the ticket to another account, used when its account ran out of points.
+        # Stays released when no account is left
+        self.release()
+        ticket = await self.controller.acquire(self.model, tokens)
+        if ticket != None:
+            self.token, self.released = ticket.token, False
+
+class AdmissionController:
+    # Caps the requests in flight per model and per account, the rest wait in a bounded queue.
+    # A full queue or a wait longer than timeout is rejected so the caller can answer 429 right away
+    def __init__(self, model_limit: int=16, account_limit: int=3, queue_size: int=64, timeout: float=30, retry_after: int=5):
+        self.model_limit = model_limit
+        self.account_limit = account_limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.models: Counter = Counter()
+        self.accounts: Counter = Counter()
+        self.waiters: deque = deque()
+
+    def _pick(self, model: str, tokens: list, preferred: dict=None):
+        if self.models[model] >= self.model_limit:
+            return None
+        if preferred in tokens and self.accounts[preferred['p-b']] < self.account_limit:
+            return preferred
+        token = min(tokens, key=lambda token: self.accounts[token['p-b']], default=None)
+        if token == None or self.accounts[token['p-b']] >= self.account_limit:
+            return None
+        return token
+
+    def _grant(self, model: str, token: dict) -> Ticket:
+        self.models[model] += 1
+        self.accounts[token['p-b']] += 1
+        return Ticket(self, model, token)
+
+    def try_acquire(self, model: str, tokens: list, preferred: dict=None) -> Ticket:
+        # Never waits, returns None when no slot is free right away.
+        # Requests already waiting go first, but only those on the same model can hold this one back
+        self._dispatch()
+        if len(tokens) == 0 or any(waiter[1] == model for waiter in self.waiters):
+            return None
+        token = self._pick(model, tokens, preferred)
+        return self._grant(model, token) if token != None else None
+
+    async def acquire(self, model: str, tokens: list, preferred: dict=None) -> Ticket:
+        # Returns None right away when no account is left, waiting would not change that
+        if len(tokens) == 0:
+            return None
+        ticket = self.try_acquire(model, tokens, preferred)
+        if ticket != None:
+            return ticket
+        if len(self.waiters) >= self.queue_size:
+            raise AdmissionRejected("The server is overloaded. Please retry later.", self.retry_after)
+        future = asyncio.get_running_loop().create_future()
+        waiter = (future, model, tokens, preferred)
+        self.waiters.append(waiter)
+        try:
+            return await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            raise AdmissionRejected(f"Timed out after {self.timeout} seconds waiting for a free slot on {model}.", self.retry_after)
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled() and future.result() != None:
+                future.result().release()
+            raise
+        finally:
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+
+    def release(self, model: str, token: dict):
+        self.models[model] -= 1
+        self.accounts[token['p-b']] -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        # A waiter blocked on a busy model does not hold back the waiters of other models
+        for waiter in list(self.waiters):
+            future, model, tokens, preferred = waiter
+            if future.done():
+                self.waiters.remove(waiter)
+                continue
+            if len(tokens) == 0:
+                # Every account ran out while this request was waiting
+                self.waiters.remove(waiter)
+                future.set_result(None)
+                continue
+            token = self._pick(model, tokens, preferred)
+            if token != None:
+                self.waiters.remove(waiter)
+                future.set_result(self._grant(model, token))
@@ -1,43 +1,100 @@
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import StreamingResponse, ORJSONResponse
+from fastapi.responses import StreamingResponse, ORJSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from daphne.cli import CommandLineInterface
+from daphne.server import twisted_loop
 from typing import Any, Dict, Tuple, Union, AsyncGenerator
 from poe_api_wrapper import AsyncPoeApi
 from poe_api_wrapper.openai import helpers
 from poe_api_wrapper.openai.type import *
-import orjson, asyncio, random, os, uuid
-from httpx import AsyncClient
+from poe_api_wrapper.openai.cache import ConversationCache, ResponseCache, CachedReply, ImageCache
+from poe_api_wrapper.openai.admission import AdmissionController, AdmissionRejected, Ticket
+from poe_api_wrapper.openai.tokens import TokenStore
+from poe_api_wrapper.openai.batches import BatchStore, BatchRunner, BATCH_ENDPOINTS
+import orjson, asyncio, random, os, uuid, base64, hashlib, signal, socket, subprocess, sys, tempfile, time
+from loguru import logger
+from httpx import AsyncClient, Limits
+from requests_toolbelt.multipart.decoder import MultipartDecoder
 
 DIR = os.path.dirname(os.path.abspath(__file__))
+# Image generations running at once for a single request
+IMAGE_CONCURRENCY = 4
 
 app = FastAPI(title="Poe API Wrapper", description="OpenAI Proxy Server")
 
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
 
-with open(os.path.join(DIR, "secrets.json"), "rb") as f:
-    TOKENS = orjson.loads(f.read())
-    if "tokens" not in TOKENS:
-        raise Exception("Tokens not found in secrets.json")
-    app.state.tokens = TOKENS["tokens"]
+if "POE_TOKEN_STORE" in os.environ:
+    # Started as one of the worker processes of start_server, the encoder is loaded before the first request
+    app.state.tokens = TokenStore(path=os.environ["POE_TOKEN_STORE"], shard=int(os.environ["POE_WORKER"]), shards=int(os.environ["POE_WORKERS"]))
+    helpers.__get_encoder()
+else:
+    with open(os.path.join(DIR, "secrets.json"), "rb") as f:
+        TOKENS = orjson.loads(f.read())
+        if "tokens" not in TOKENS:
+            raise Exception("Tokens not found in secrets.json")
+        app.state.tokens = TokenStore(TOKENS["tokens"])
 
-with open(os.path.join(DIR, "models.json"), "rb") as f:
-    models = orjson.loads(f.read())
+def load_models():
+    # The model list and every model entry are serialized once per version of models.json, not per request
+    path = os.path.join(DIR, "models.json")
+    mtime = os.stat(path).st_mtime_ns
+    with open(path, "rb") as f:
+        models = orjson.loads(f.read())
+    created = int(time.time())
+    entries = {model: {"id": model, "object": "model", "created": created, "owned_by": values["owned_by"], "tokens": values["tokens"], "endpoints": values["endpoints"]} for model, values in models.items()}
+    serialized = {model: orjson.dumps(entry) for model, entry in entries.items()}
+    serialized[None] = orjson.dumps({"object": "list", "data": list(entries.values())})
     app.state.models = models
+    app.state.models_json = {model: (content, f'"{hashlib.sha256(content).hexdigest()[:32]}"') for model, content in serialized.items()}
+    app.state.models_mtime = mtime
+    app.state.models_checked = time.monotonic()
+
+
+def reload_models():
+    # models.json is checked at most once per second
+    if time.monotonic() - app.state.models_checked < 1:
+        return
+    app.state.models_checked = time.monotonic()
+    try:
+        if os.stat(os.path.join(DIR, "models.json")).st_mtime_ns != app.state.models_mtime:
+            load_models()
+    except (OSError, orjson.JSONDecodeError, KeyError) as e:
+        logger.warning(f"Failed to reload models.json, keeping the previous models: {e}")
+
+load_models()
+
+app.state.conversations = ConversationCache()
+app.state.images = ImageCache()
+app.state.fetcher = None
+
+
+def configure_server(response_cache: bool=False, cache_size: int=1000, cache_ttl: int=3600, cache_path: str=None,
+                     model_concurrency: int=16, account_concurrency: int=3, queue_size: int=64, queue_timeout: float=30,
+                     batch_dir: str="batches", batch_concurrency: int=8, batch_rate: float=2.0, single_pass_tools: bool=False,
+                     stream_flush_bytes: int=64, stream_flush_ms: float=50, stream_flush_sentences: bool=True):
+    app.state.single_pass_tools = single_pass_tools
+    app.state.stream_policy = {"max_bytes": stream_flush_bytes, "max_delay": stream_flush_ms / 1000, "sentences": stream_flush_sentences}
+    app.state.responses = ResponseCache(cache_size, cache_ttl, cache_path) if response_cache else None
+    app.state.admission = AdmissionController(model_concurrency, account_concurrency, queue_size, queue_timeout)
+    app.state.batches = BatchRunner(BatchStore(batch_dir), batch_request, batch_concurrency, batch_rate)
+
 
 
 async def call_tools(messages, tools, tool_choice):
     response = await message_handler("gpt4_o_mini", messages, 128000, tools, tool_choice)
     tool_calls = None
     client, _ = await rotate_token(app.state.tokens)
+    scanner = helpers.ToolCallScanner()
     async for chunk in client.send_message(bot="gpt4_o_mini", message=response["message"]):
-        try:
-            res_list = orjson.loads(chunk["text"].strip().replace("\n", "").replace("\\",""))
-            if res_list and type(res_list) == list:
-                tool_calls = res_list
-                break
-        except Exception as e:
-            pass
+        verdict = scanner.feed(chunk["text"])
+        if verdict == None:
+            continue
+        # The answer is known either way, the rest of the generation is not needed
+        if verdict == "tool_calls":
+            tool_calls = await helpers.__parse_tool_calls(scanner.array(chunk["text"]))
+        await client.cancel_message(chunk)
+        break
         
     return tool_calls
     
@@ -48,22 +105,24 @@ async def index() -> ORJSONResponse:
                             "docs": "See project docs @ https://github.com/snowby666/poe-api-wrapper"})
 
 
-@app.api_route("/models/{model}", methods=["GET", "POST", "PUT", "PATCH", "HEAD"], response_model=None)
+@app.api_route("/v1/models/{model}", methods=["GET", "POST", "PUT", "PATCH", "HEAD"], response_model=None)
 @app.api_route("/models/{model}", methods=["GET", "POST", "PUT", "PATCH", "HEAD"], response_model=None)
 @app.api_route("/models", methods=["GET", "POST", "PUT", "PATCH", "HEAD"], response_model=None)
 @app.api_route("/v1/models", methods=["GET", "POST", "PUT", "PATCH", "HEAD"], response_model=None)
-async def list_models(request: Request, model: str = None) -> ORJSONResponse:
-    if model:
-        if model not in app.state.models:
-            raise HTTPException(detail={"error": {"message": "Invalid model.", "type": "error", "param": None, "code": 400}}, status_code=400)
-        return ORJSONResponse({"id": model, "object": "model", "created": await helpers.__generate_timestamp(), "owned_by": app.state.models[model]["owned_by"], "tokens": app.state.models[model]["tokens"], "endpoints": app.state.models[model]["endpoints"]})
-    modelsData = [{"id": model, "object": "model", "created": await helpers.__generate_timestamp(), "owned_by": values["owned_by"], "tokens": values["tokens"], "endpoints": values["endpoints"]} for model, values in app.state.models.items()]
-    return ORJSONResponse({"object": "list", "data": modelsData})
+async def list_models(request: Request, model: str = None) -> Response:
+    reload_models()
+    if model and model not in app.state.models:
+        raise HTTPException(detail={"error": {"message": "Invalid model.", "type": "error", "param": None, "code": 400}}, status_code=400)
+    content, etag = app.state.models_json[model or None]
+    if etag in [tag.strip().removeprefix("W/") for tag in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(content=content, media_type="application/json", headers={"ETag": etag})
 
 
 @app.api_route("/chat/completions", methods=["POST", "OPTIONS"], response_model=None)
 @app.api_route("/v1/chat/completions", methods=["POST", "OPTIONS"], response_model=None)
 async def chat_completions(request: Request, data: ChatData) -> Union[StreamingResponse, ORJSONResponse]:
+    reload_models()
     messages, model, streaming, max_tokens, stream_options, tools, tool_choice = data.messages, data.model, data.stream, data.max_tokens, data.stream_options, data.tools, data.tool_choice
 
     # Validate messages format
@@ -84,47 +143,176 @@ async def chat_completions(request: Request, data: ChatData) -> Union[StreamingR
     if "/v1/chat/completions" not in endpoints:
         raise HTTPException(detail={"error": {"message": "This model does not support chat completions.", "type": "error", "param": None, "code": 400}}, status_code=400)
     
-    client, subscription = await rotate_token(app.state.tokens)
+    cache_key = app.state.responses.key(data) if app.state.responses else None
+    if cache_key:
+        cached_response = app.state.responses.get(cache_key)
+        if cached_response:
+            completion_id = await helpers.__generate_completion_id()
+            client, response = CachedReply(cached_response["text"]), {"bot": model, "message": ""}
+            return await streaming_response(client, response, model, completion_id, cached_response["prompt_tokens"], [], max_tokens, include_usage, cached_response["raw_tool_calls"]) \
+                if streaming else await non_streaming_response(client, response, model, completion_id, cached_response["prompt_tokens"], [], max_tokens, cached_response["raw_tool_calls"])
+    
+    # A history that continues a cached Poe chat only needs its newest message sent
+    conversation, cached = None, None
+    if not tools and app.state.conversations.cacheable(messages):
+        conversation = {"model": model, "messages": messages}
+        cached = app.state.conversations.lookup(model, messages)
+    
+    ticket = await admit_request(model, cached["token"] if cached else None)
+    try:
+        client, subscription = await rotate_token(app.state.tokens, cached["token"] if cached else None, ticket)
     
-    if premiumModel and not subscription:
-        raise HTTPException(detail={"error": {"message": "Premium model requires a subscription.", "type": "error", "param": None, "code": 402}}, status_code=402)
+        if premiumModel and not subscription:
+            raise HTTPException(detail={"error": {"message": "Premium model requires a subscription.", "type": "error", "param": None, "code": 402}}, status_code=402)
     
-    text_messages, image_urls = await helpers.__split_content(messages)
+        text_messages, image_urls = await helpers.__split_content(messages)
     
-    response = await message_handler(baseModel, text_messages, tokensLimit)
-    prompt_tokens = await helpers.__tokenize(''.join([str(message) for message in response["message"]]))
+        if cached and client.tokens == cached["token"]:
+            response = {"bot": cached["bot"], "message": messages[-1]["content"], "chatCode": cached["chatCode"], "chatId": cached["chatId"]}
+        else:
+            # In single pass mode the tool schema rides along with the real completion instead of a separate call
+            folded_tools = tools if tools and app.state.single_pass_tools else None
+            response = await message_handler(baseModel, text_messages, tokensLimit, folded_tools, tool_choice or "auto", fold=True)
+        prompt_tokens = await helpers.__tokenize(''.join([str(message) for message in response["message"]]))
     
-    if prompt_tokens > tokensLimit:
-        raise HTTPException(detail={"error": {"message": f"Your prompt exceeds the maximum context length of {tokensLimit} tokens.", "type": "error", "param": None, "code": 400}}, status_code=400)
+        if prompt_tokens > tokensLimit:
+            raise HTTPException(detail={"error": {"message": f"Your prompt exceeds the maximum context length of {tokensLimit} tokens.", "type": "error", "param": None, "code": 400}}, status_code=400)
         
-    if max_tokens and sum((max_tokens, prompt_tokens)) > tokensLimit:
-        raise HTTPException(detail={"error": {
-                                        "message": f"This model's maximum context length is {tokensLimit} tokens. However your request exceeds this limit ({max_tokens} in max_tokens, {prompt_tokens} in messages).", 
-                                        "type": "error", 
-                                        "param": None, 
-                                        "code": 400}
-                                    }, status_code=400)
-    
-    raw_tool_calls = None
-    if tools:
-        if not tool_choice:
-            tool_choice = "auto"
-        raw_tool_calls = await call_tools(messages, tools, tool_choice)
-    
-    if raw_tool_calls:
-        response = {"bot": "gpt4_o_mini", "message": ""}
-        prompt_tokens = await helpers.__tokenize(''.join([str(message["content"]) for message in text_messages]))
+        if max_tokens and sum((max_tokens, prompt_tokens)) > tokensLimit:
+            raise HTTPException(detail={"error": {
+                                            "message": f"This model's maximum context length is {tokensLimit} tokens. However your request exceeds this limit ({max_tokens} in max_tokens, {prompt_tokens} in messages).", 
+                                            "type": "error", 
+                                            "param": None, 
+                                            "code": 400}
+                                        }, status_code=400)
+    
+        raw_tool_calls = None
+        if tools and app.state.single_pass_tools:
+            response["tools"] = True
+        elif tools:
+            if not tool_choice:
+                tool_choice = "auto"
+            raw_tool_calls = await call_tools(messages, tools, tool_choice)
+    
+        if raw_tool_calls:
+            response = {"bot": "gpt4_o_mini", "message": ""}
+            prompt_tokens = await helpers.__tokenize(''.join([str(message["content"]) for message in text_messages]))
+            if cache_key:
+                app.state.responses.put(cache_key, {"text": "", "prompt_tokens": prompt_tokens, "raw_tool_calls": raw_tool_calls})
+    
+        if cache_key and not raw_tool_calls:
+            # Caching happens once the reply is complete, on a stop finish reason
+            response["cache_key"] = cache_key
         
-    completion_id = await helpers.__generate_completion_id()
+        completion_id = await helpers.__generate_completion_id()
+    
+        # From here on the response releases the ticket once the completion is done
+        return await streaming_response(client, response, model, completion_id, prompt_tokens, image_urls, max_tokens, include_usage, raw_tool_calls, conversation, ticket) \
+            if streaming else await non_streaming_response(client, response, model, completion_id, prompt_tokens, image_urls, max_tokens, raw_tool_calls, conversation, ticket)
+    except BaseException:
+        if ticket:
+            ticket.release()
+        raise
+
+
+@app.api_route("/files", methods=["POST", "OPTIONS"], response_model=None)
+@app.api_route("/v1/files", methods=["POST", "OPTIONS"], response_model=None)
+async def upload_file(request: Request) -> ORJSONResponse:
+    try:
+        decoder = MultipartDecoder(await request.body(), request.headers.get("content-type", ""))
+    except Exception as e:
+        raise HTTPException(detail={"error": {"message": "Invalid multipart form data.", "type": "error", "param": None, "code": 400}}, status_code=400) from e
+    
+    fields, content, filename = {}, None, "upload.jsonl"
+    for part in decoder.parts:
+        disposition = part.headers.get(b"Content-Disposition", b"").decode()
+        params = dict(param.strip().split("=", 1) for param in disposition.split(";")[1:] if "=" in param)
+        name = params.get("name", "").strip('"')
+        if name == "file":
+            content, filename = part.content, params.get("filename", f'"{filename}"').strip('"')
+        else:
+            fields[name] = part.text
+    
+    if content == None:
+        raise HTTPException(detail={"error": {"message": "Missing file.", "type": "error", "param": "file", "code": 400}}, status_code=400)
+    
+    if fields.get("purpose") != "batch":
+        raise HTTPException(detail={"error": {"message": "Only files with purpose batch are supported.", "type": "error", "param": "purpose", "code": 400}}, status_code=400)
+    
+    return ORJSONResponse(app.state.batches.store.create_file(content, filename, "batch"))
+
+
+@app.api_route("/files/{file_id}", methods=["GET"], response_model=None)
+@app.api_route("/v1/files/{file_id}", methods=["GET"], response_model=None)
+async def retrieve_file(request: Request, file_id: str) -> ORJSONResponse:
+    file = app.state.batches.store.get_file(file_id)
+    if file == None:
+        raise HTTPException(detail={"error": {"message": f"No such file: {file_id}", "type": "error", "param": "file_id", "code": 404}}, status_code=404)
+    return ORJSONResponse(file)
+
+
+@app.api_route("/files/{file_id}/content", methods=["GET"], response_model=None)
+@app.api_route("/v1/files/{file_id}/content", methods=["GET"], response_model=None)
+async def retrieve_file_content(request: Request, file_id: str) -> Response:
+    if app.state.batches.store.get_file(file_id) == None:
+        raise HTTPException(detail={"error": {"message": f"No such file: {file_id}", "type": "error", "param": "file_id", "code": 404}}, status_code=404)
+    with open(app.state.batches.store.file_path(file_id), "rb") as f:
+        return Response(content=f.read(), media_type="application/octet-stream")
+
+
+@app.api_route("/batches", methods=["POST", "OPTIONS"], response_model=None)
+@app.api_route("/v1/batches", methods=["POST", "OPTIONS"], response_model=None)
+async def create_batch(request: Request, data: BatchData) -> ORJSONResponse:
+    input_file_id, endpoint, completion_window, metadata = data.input_file_id, data.endpoint, data.completion_window, data.metadata
+    
+    if endpoint not in BATCH_ENDPOINTS:
+        raise HTTPException(detail={"error": {"message": f"Invalid endpoint. Supported endpoints: {', '.join(BATCH_ENDPOINTS)}", "type": "error", "param": "endpoint", "code": 400}}, status_code=400)
+    
+    if completion_window != "24h":
+        raise HTTPException(detail={"error": {"message": "Invalid completion_window. Only 24h is supported.", "type": "error", "param": "completion_window", "code": 400}}, status_code=400)
     
-    return await streaming_response(client, response, model, completion_id, prompt_tokens, image_urls, max_tokens, include_usage, raw_tool_calls) \
-        if streaming else await non_streaming_response(client, response, model, completion_id, prompt_tokens, image_urls, max_tokens, raw_tool_calls)
+    file = app.state.batches.store.get_file(input_file_id) if isinstance(input_file_id, str) else None
+    if file == None or file["purpose"] != "batch":
+        raise HTTPException(detail={"error": {"message": f"Invalid input_file_id: {input_file_id}", "type": "error", "param": "input_file_id", "code": 400}}, status_code=400)
+    
+    batch = app.state.batches.store.create_batch(input_file_id, endpoint, completion_window, metadata)
+    app.state.batches.start(batch["id"])
+    return ORJSONResponse(batch)
+
+
+@app.api_route("/batches", methods=["GET"], response_model=None)
+@app.api_route("/v1/batches", methods=["GET"], response_model=None)
+async def list_batches(request: Request, limit: int = 20, after: str = None) -> ORJSONResponse:
+    batches = app.state.batches.store.list_batches()
+    if after:
+        ids = [batch["id"] for batch in batches]
+        batches = batches[ids.index(after) + 1:] if after in ids else []
+    data = batches[:limit]
+    return ORJSONResponse({"object": "list", "data": data, "first_id": data[0]["id"] if data else None, "last_id": data[-1]["id"] if data else None, "has_more": len(batches) > limit})
+
+
+@app.api_route("/batches/{batch_id}", methods=["GET"], response_model=None)
+@app.api_route("/v1/batches/{batch_id}", methods=["GET"], response_model=None)
+async def retrieve_batch(request: Request, batch_id: str) -> ORJSONResponse:
+    batch = app.state.batches.store.get_batch(batch_id)
+    if batch == None:
+        raise HTTPException(detail={"error": {"message": f"No such batch: {batch_id}", "type": "error", "param": "batch_id", "code": 404}}, status_code=404)
+    return ORJSONResponse(batch)
+
+
+@app.api_route("/batches/{batch_id}/cancel", methods=["POST"], response_model=None)
+@app.api_route("/v1/batches/{batch_id}/cancel", methods=["POST"], response_model=None)
+async def cancel_batch(request: Request, batch_id: str) -> ORJSONResponse:
+    if app.state.batches.store.get_batch(batch_id) == None:
+        raise HTTPException(detail={"error": {"message": f"No such batch: {batch_id}", "type": "error", "param": "batch_id", "code": 404}}, status_code=404)
+    return ORJSONResponse(app.state.batches.cancel(batch_id))
 
 
 @app.api_route("/images/generations", methods=["POST", "OPTIONS"], response_model=None)
 @app.api_route("/v1/images/generations", methods=["POST", "OPTIONS"], response_model=None)
 async def create_images(request: Request, data: ImagesGenData) -> ORJSONResponse:
-    prompt, model, n, size = data.prompt, data.model, data.n, data.size
+    reload_models()
+    prompt, model, n, size, response_format = data.prompt, data.model, data.n, data.size, data.response_format
     
     if not isinstance(prompt, str):
         raise HTTPException(detail={"error": {"message": "Invalid prompt.", "type": "error", "param": None, "code": 400}}, status_code=400)
@@ -135,6 +323,9 @@ async def create_images(request: Request, data: ImagesGenData) -> ORJSONResponse
     if not isinstance(n, int) or n < 1:
         raise HTTPException(detail={"error": {"message": "Invalid n value.", "type": "error", "param": None, "code": 400}}, status_code=400)
     
+    if response_format not in ("url", "b64_json"):
+        raise HTTPException(detail={"error": {"message": "Invalid response_format. Available formats: url, b64_json", "type": "error", "param": None, "code": 400}}, status_code=400)
+    
     if size == "1024x1024":
         aspect_ratio = ""
     elif "sizes" in app.state.models[model] and size in app.state.models[model]["sizes"]:
@@ -148,38 +339,31 @@ async def create_images(request: Request, data: ImagesGenData) -> ORJSONResponse
     if "/v1/images/generations" not in endpoints:
         raise HTTPException(detail={"error": {"message": "This model does not support image generation.", "type": "error", "param": None, "code": 400}}, status_code=400)
     
-    client, subscription = await rotate_token(app.state.tokens)
-    
-    if premiumModel and not subscription:
-        raise HTTPException(detail={"error": {"message": "Premium model requires a subscription.", "type": "error", "param": None, "code": 402}}, status_code=402)
-    
-    response = await image_handler(baseModel, prompt, tokensLimit)
-    
-    urls = []
-    for _ in range(n):
-        image_generation = await generate_image(client, response, aspect_ratio)
-        urls.extend([url for url in image_generation.split() if url.startswith("https://")])
-        if len(urls) >= n:
-            break
-    urls = urls[-n:]
+    ticket = await admit_request(model)
+    try:
+        client, subscription = await rotate_token(app.state.tokens, ticket=ticket)
+        
+        if premiumModel and not subscription:
+            raise HTTPException(detail={"error": {"message": "Premium model requires a subscription.", "type": "error", "param": None, "code": 402}}, status_code=402)
+        
+        response = await image_handler(baseModel, prompt, tokensLimit)
+        
+        urls = await generate_images(client, response, model, aspect_ratio, n, premiumModel)
+    finally:
+        if ticket:
+            ticket.release()
     
     if len(urls) == 0:
         raise HTTPException(detail={"error": {"message": f"The provider for {model} sent an invalid response.", "type": "error", "param": None, "code": 500}}, status_code=500)
         
-    async with AsyncClient(http2=True) as fetcher:
-        for url in urls:
-            r = await fetcher.get(url)
-            content_type = r.headers.get("Content-Type", "")
-            if not content_type.startswith("image/"):
-                raise HTTPException(detail={"error": {"message": "The content returned was not an image.", "type": "error", "param": None, "code": 500}}, status_code=500)
-
-    return ORJSONResponse({"created": await helpers.__generate_timestamp(), "data": [{"url": url} for url in urls]})
+    return ORJSONResponse({"created": await helpers.__generate_timestamp(), "data": await validate_images(urls, response_format)})
 
 
 @app.api_route("/images/edits", methods=["POST", "OPTIONS"], response_model=None)
 @app.api_route("/v1/images/edits", methods=["POST", "OPTIONS"], response_model=None)
 async def edit_images(request: Request, data: ImagesEditData) -> ORJSONResponse:
-    image, prompt, model, n, size = data.image, data.prompt, data.model, data.n, data.size
+    reload_models()
+    image, prompt, model, n, size, response_format = data.image, data.prompt, data.model, data.n, data.size, data.response_format
     
     if not (isinstance(image, str) and (os.path.exists(image) or image.startswith("http"))):
         raise HTTPException(detail={"error": {"message": "Invalid image.", "type": "error", "param": None, "code": 400}}, status_code=400)
@@ -193,6 +377,9 @@ async def edit_images(request: Request, data: ImagesEditData) -> ORJSONResponse:
     if not isinstance(n, int) or n < 1:
         raise HTTPException(detail={"error": {"message": "Invalid n value.", "type": "error", "param": None, "code": 400}}, status_code=400)
     
+    if response_format not in ("url", "b64_json"):
+        raise HTTPException(detail={"error": {"message": "Invalid response_format. Available formats: url, b64_json", "type": "error", "param": None, "code": 400}}, status_code=400)
+    
     if size == "1024x1024":
         aspect_ratio = ""
     elif "sizes" in app.state.models[model] and size in app.state.models[model]["sizes"]:
@@ -206,44 +393,36 @@ async def edit_images(request: Request, data: ImagesEditData) -> ORJSONResponse:
     if "/v1/images/edits" not in endpoints:
         raise HTTPException(detail={"error": {"message": "This model does not support image editing.", "type": "error", "param": None, "code": 400}}, status_code=400)
     
-    client, subscription = await rotate_token(app.state.tokens)
-    
-    if premiumModel and not subscription:
-        raise HTTPException(detail={"error": {"message": "Premium model requires a subscription.", "type": "error", "param": None, "code": 402}}, status_code=402)
-    
-    response = await image_handler(baseModel, prompt, tokensLimit)
-    
-    urls = []
-    for _ in range(n):
-        image_generation = await generate_image(client, response, aspect_ratio, [image])
-        urls.extend([url for url in image_generation.split() if url.startswith("https://")])
-        if len(urls) >= n:
-            break
-    urls = urls[-n:]
+    ticket = await admit_request(model)
+    try:
+        client, subscription = await rotate_token(app.state.tokens, ticket=ticket)
+        
+        if premiumModel and not subscription:
+            raise HTTPException(detail={"error": {"message": "Premium model requires a subscription.", "type": "error", "param": None, "code": 402}}, status_code=402)
+        
+        response = await image_handler(baseModel, prompt, tokensLimit)
+        
+        urls = await generate_images(client, response, model, aspect_ratio, n, premiumModel, [image])
+    finally:
+        if ticket:
+            ticket.release()
         
     if len(urls) == 0:
         raise HTTPException(detail={"error": {"message": f"The provider for {model} sent an invalid response.", "type": "error", "param": None, "code": 500}}, status_code=500)
     
-    async with AsyncClient(http2=True) as fetcher:
-        for url in urls:
-            r = await fetcher.get(url)
-            content_type = r.headers.get("Content-Type", "")
-            if not content_type.startswith("image/"):
-                raise HTTPException(detail={"error": {"message": "The content returned was not an image.", "type": "error", "param": None, "code": 500}}, status_code=500)
-            
-    return ORJSONResponse({"created": await helpers.__generate_timestamp(), "data": [{"url": url} for url in urls]})
+    return ORJSONResponse({"created": await helpers.__generate_timestamp(), "data": await validate_images(urls, response_format)})
    
 
 async def image_handler(baseModel: str, prompt: str, tokensLimit: int) -> dict:
     try:
-        message = await helpers.__progressive_summarize_text(prompt, min(len(prompt), tokensLimit))
+        message = await helpers.__summarize_text(prompt, tokensLimit)
         return {"bot": baseModel, "message": message}
     except Exception as e:
         raise HTTPException(detail={"error": {"message": f"Failed to truncate prompt. Error: {e}", "type": "error", "param": None, "code": 400}}, status_code=400) from e
    
    
 async def message_handler(
-    baseModel: str, messages: List[Dict[str, str]], tokensLimit: int, tools: list[dict[str, str]] = None, tool_choice = None
+    baseModel: str, messages: List[Dict[str, str]], tokensLimit: int, tools: list[dict[str, str]] = None, tool_choice = None, fold: bool = False
 ) -> dict:
     
     try:
@@ -255,7 +434,7 @@ async def message_handler(
                 break
         
         if tools:
-            rest_tools = await helpers.__convert_functions_format(tools, tool_choice)
+            rest_tools = await helpers.__convert_functions_format(tools, tool_choice, fold)
             if messages[0]["role"] == "system":
                 messages[0]["content"] += rest_tools
             else:
@@ -268,7 +447,7 @@ async def message_handler(
         full_tokens = await helpers.__tokenize(full_string)
         
         if full_tokens > tokensLimit:
-            history_string = await helpers.__progressive_summarize_text(
+            history_string = await helpers.__summarize_text(
                 history_string, tokensLimit - await helpers.__tokenize(main_request) - 100
             )
         
@@ -279,14 +458,129 @@ async def message_handler(
 
 
 async def generate_image(client: AsyncPoeApi, response: dict, aspect_ratio: str, image: list = []) -> str:
+    chunk = None
     try:
         async for chunk in client.send_message(bot=response["bot"], message=f"{response['message']} {aspect_ratio}", file_path=image):
             pass
         return chunk["text"]
+    except asyncio.CancelledError:
+        # The generation is no longer needed, it is stopped on Poe as well so it spends no more points
+        if chunk != None:
+            try:
+                await client.cancel_message(chunk)
+            except Exception as e:
+                logger.warning(f"Failed to cancel an image generation: {e}")
+        raise
     except Exception as e:
         raise HTTPException(detail={"error": {"message": f"Failed to generate image. Error: {e}", "type": "error", "param": None, "code": 500}}, status_code=500) from e
     
     
+async def generate_images(client: AsyncPoeApi, response: dict, model: str, aspect_ratio: str, n: int, premiumModel: bool, image: list = []) -> list:
+    # The generations run concurrently, the first one on the request's account and the others on
+    # accounts with a free slot. They never wait for a slot while the request holds its own, image
+    # requests would wait on each other, so without one they run one by one on the request's client
+    semaphore, own = asyncio.Semaphore(IMAGE_CONCURRENCY), asyncio.Lock()
+    
+    async def generate_on_own_client() -> str:
+        async with own:
+            return await generate_image(client, response, aspect_ratio, image)
+    
+    async def generate(index: int) -> str:
+        async with semaphore:
+            if index == 0:
+                return await generate_on_own_client()
+            ticket, worker = None, None
+            if app.state.admission != None:
+                ticket = app.state.admission.try_acquire(model, app.state.tokens)
+                if ticket == None:
+                    return await generate_on_own_client()
+            try:
+                worker, subscription = await rotate_token(app.state.tokens, ticket=ticket)
+                if premiumModel and not subscription:
+                    return await generate_on_own_client()
+                return await generate_image(worker, response, aspect_ratio, image)
+            finally:
+                if ticket:
+                    ticket.release()
+                if worker:
+                    await close_client(worker)
+    
+    urls, error = {}, None
+    tasks = [asyncio.create_task(generate(index)) for index in range(n)]
+    try:
+        for task in asyncio.as_completed(tasks):
+            try:
+                image_generation = await task
+            except Exception as e:
+                error = error or e
+                continue
+            # Ordered dict keys drop the urls a bot repeats across generations
+            urls.update((url, None) for url in image_generation.split() if url.startswith("https://"))
+            if len(urls) >= n:
+                break
+    finally:
+        for task in tasks:
+            task.cancel()
+        # Waits for the cancelled generations to stop upstream and give their accounts back
+        await asyncio.gather(*tasks, return_exceptions=True)
+    
+    if not urls and error:
+        raise error
+    return list(urls)[:n]
+    
+    
+async def close_client(client: AsyncPoeApi):
+    # Closes a client made for a single generation, its websocket and connection pool are not reused
+    client.disconnect_ws()
+    if client.client:
+        await client.client.aclose()
+        client.client = None
+    
+    
+async def check_image(fetcher: AsyncClient, url: str, download: bool) -> bytes:
+    # Only the headers are needed to check a url, the body is downloaded when it is sent back as b64_json
+    content = app.state.images.get(url)
+    if content != None:
+        return content
+    if download:
+        r = await fetcher.get(url, follow_redirects=True)
+        content_type = r.headers.get("Content-Type", "")
+    else:
+        r = await fetcher.head(url, follow_redirects=True)
+        content_type = r.headers.get("Content-Type", "")
+        if r.status_code >= 400 or not content_type:
+            # Some hosts refuse HEAD, a ranged GET whose body is never read works everywhere
+            async with fetcher.stream("GET", url, headers={"Range": "bytes=0-0"}, follow_redirects=True) as r:
+                content_type = r.headers.get("Content-Type", "")
+    if not content_type.startswith("image/"):
+        raise HTTPException(detail={"error": {"message": "The content returned was not an image.", "type": "error", "param": None, "code": 500}}, status_code=500)
+    if download:
+        app.state.images.put(url, r.content)
+        return r.content
+    return None
+
+
+def get_fetcher() -> AsyncClient:
+    # One pooled client for every image check, connections to the image hosts are reused across requests.
+    # Created on first use, daphne does not run the ASGI lifespan
+    if app.state.fetcher == None:
+        app.state.fetcher = AsyncClient(http2=True, timeout=30, limits=Limits(max_connections=64, max_keepalive_connections=16))
+    return app.state.fetcher
+
+
+async def validate_images(urls: list, response_format: str) -> list:
+    download = response_format == "b64_json"
+    try:
+        contents = await asyncio.gather(*[check_image(get_fetcher(), url, download) for url in urls])
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(detail={"error": {"message": f"Failed to fetch the generated images. Error: {e}", "type": "error", "param": None, "code": 500}}, status_code=500) from e
+    if download:
+        return [{"b64_json": base64.b64encode(content).decode()} for content in contents]
+    return [{"url": url} for url in urls]
+
+
 async def create_completion_data(
     completion_id: str, created: int, model: str, chunk: str = None, 
     finish_reason: str = None, include_usage: bool=False,
@@ -327,47 +621,91 @@ async def create_completion_data(
     
 async def generate_chunks(
     client: AsyncPoeApi, response: dict, model: str, completion_id: str, 
-    prompt_tokens: int, image_urls: List[str], max_tokens: int, include_usage:bool, raw_tool_calls: list[dict[str, str]] = None
+    prompt_tokens: int, image_urls: List[str], max_tokens: int, include_usage:bool, raw_tool_calls: list[dict[str, str]] = None,
+    conversation: dict = None, ticket: Ticket = None
 ) -> AsyncGenerator[bytes, None]:
     
+    reader = None
     try:
         completion_timestamp = await helpers.__generate_timestamp()
         finish_reason = "stop"
         
         if not raw_tool_calls:
-            async for chunk in client.send_message(bot=response["bot"], message=response["message"], file_path=image_urls):
-                chunk_token = await helpers.__tokenize(chunk["text"])
+            counter = await helpers.__token_counter()
+            template = helpers.ChunkTemplate(completion_id, completion_timestamp, model, include_usage)
+            chunk_token = 0
+            # With the tools folded into the prompt the reply is held back until it can be told apart from prose,
+            # generation stops as soon as a tool call array is complete
+            scanner = helpers.ToolCallScanner() if response.get("tools") else None
+            coalescer = helpers.StreamCoalescer(**app.state.stream_policy)
+            chunk = None
+            reader = helpers.ChunkReader(client.send_message(bot=response["bot"], message=response["message"], chatId=response.get("chatId"), chatCode=response.get("chatCode"), file_path=image_urls))
+            while True:
+                try:
+                    # Wakes up when held back text is due even if the bot is slow to send more
+                    event = await reader.next(coalescer.due())
+                except StopAsyncIteration:
+                    break
+                if event == None:
+                    yield template.render(coalescer.flush())
+                    continue
+                chunk = event
+                chunk_token = counter.update(chunk["text"])
                 
                 if max_tokens and chunk_token >= max_tokens:
                     await client.cancel_message(chunk)
                     finish_reason = "length"
                     break
                 
-                content = await create_completion_data(
-                                                    completion_id=completion_id, 
-                                                    created=completion_timestamp,
-                                                    model=model, 
-                                                    chunk=chunk["response"], 
-                                                    include_usage=include_usage
-                                                    )
+                if scanner and scanner.verdict == None:
+                    verdict = scanner.feed(chunk["text"])
+                    if verdict == None:
+                        continue
+                    if verdict == "tool_calls":
+                        raw_tool_calls = await helpers.__parse_tool_calls(scanner.array(chunk["text"]))
+                        if raw_tool_calls:
+                            await client.cancel_message(chunk)
+                            finish_reason = "tool_calls"
+                            break
+                    delta = chunk["text"]
+                else:
+                    delta = chunk["response"]
                 
-                yield b"data: " + orjson.dumps(content) + b"\n\n"
-                await asyncio.sleep(0.001)
+                text = coalescer.add(delta)
+                if text != None:
+                    yield template.render(text)
+            
+            if coalescer.due() != None:
+                yield template.render(coalescer.flush())
+            
+            # A bot that sent nothing leaves an empty reply that is neither remembered nor cached
+            if chunk != None:
+                if scanner and scanner.verdict == None and chunk["text"]:
+                    # The reply ended before it could be told apart, it is sent as it is
+                    yield template.render(chunk["text"])
                 
-            end_completion_data = await create_completion_data(
-                                                            completion_id=completion_id, 
-                                                            created=completion_timestamp,
-                                                            model=model, 
-                                                            finish_reason=finish_reason, 
-                                                            include_usage=include_usage, 
-                                                            prompt_tokens=prompt_tokens, 
-                                                            completion_tokens=chunk_token
-                                                            )
+                if conversation and finish_reason == "stop":
+                    await remember_conversation(client, response, conversation, chunk)
+                if response.get("cache_key") and finish_reason in ("stop", "tool_calls"):
+                    app.state.responses.put(response["cache_key"], {"text": chunk["text"], "prompt_tokens": prompt_tokens, "raw_tool_calls": raw_tool_calls})
             
-            yield b"data: " +  orjson.dumps(end_completion_data) + b"\n\n"
+            if not raw_tool_calls:
+                end_completion_data = await create_completion_data(
+                                                                completion_id=completion_id, 
+                                                                created=completion_timestamp,
+                                                                model=model, 
+                                                                finish_reason=finish_reason, 
+                                                                include_usage=include_usage, 
+                                                                prompt_tokens=prompt_tokens, 
+                                                                completion_tokens=chunk_token
+                                                                )
+                
+                yield b"data: " +  orjson.dumps(end_completion_data) + b"\n\n"
             
         else:
             chunk_token = await helpers.__tokenize(''.join([str(tool_call["name"]) + str(tool_call["arguments"]) for tool_call in raw_tool_calls]))
+        
+        if raw_tool_calls:
             content = await create_completion_data(
                                                 completion_id=completion_id, 
                                                 created=completion_timestamp,
@@ -379,48 +717,91 @@ async def generate_chunks(
                                                 completion_tokens=chunk_token,
                                                 raw_tool_calls=raw_tool_calls)
             yield b"data: " + orjson.dumps(content) + b"\n\n"
-            await asyncio.sleep(0.01)
    
         yield b"data: [DONE]\n\n"
     except GeneratorExit:
         pass
     except Exception as e:
         raise HTTPException(detail={"error": {"message": f"Failed to stream response. Error: {e}", "type": "error", "param": None, "code": 500}}, status_code=500) from e
+    finally:
+        if reader:
+            reader.cancel()
+        if ticket:
+            ticket.release()
 
     
+class TicketStreamingResponse(StreamingResponse):
+    # The ticket is released however the response ends. A client that disconnects before the body
+    # starts never runs the generator, so its finally block alone would leak the slot
+    def __init__(self, *args, ticket: Ticket = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ticket = ticket
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            if self.ticket:
+                self.ticket.release()
+
+
 async def streaming_response(
     client: AsyncPoeApi, response: dict, model: str, completion_id: str, 
-    prompt_tokens: int, image_urls: List[str], max_tokens: int, include_usage: bool, raw_tool_calls: list[dict[str, str]] = None
+    prompt_tokens: int, image_urls: List[str], max_tokens: int, include_usage: bool, raw_tool_calls: list[dict[str, str]] = None,
+    conversation: dict = None, ticket: Ticket = None
 ) -> StreamingResponse:
     
-    return StreamingResponse(content=generate_chunks(client, response, model, completion_id, prompt_tokens, image_urls, max_tokens, include_usage, raw_tool_calls), status_code=200, 
-                             headers={"X-Request-ID": str(uuid.uuid4()), "Content-Type": "text/event-stream"})
+    return TicketStreamingResponse(content=generate_chunks(client, response, model, completion_id, prompt_tokens, image_urls, max_tokens, include_usage, raw_tool_calls, conversation, ticket), status_code=200, 
+                                   headers={"X-Request-ID": str(uuid.uuid4()), "Content-Type": "text/event-stream"}, ticket=ticket)
 
 
 async def non_streaming_response(
     client: AsyncPoeApi, response: dict, model: str, completion_id: str,
-    prompt_tokens: int, image_urls: List[str], max_tokens: int, raw_tool_calls: list[dict[str, str]] = None
+    prompt_tokens: int, image_urls: List[str], max_tokens: int, raw_tool_calls: list[dict[str, str]] = None,
+    conversation: dict = None, ticket: Ticket = None
 ) -> ORJSONResponse:
     
     if not raw_tool_calls:
         try:
             finish_reason = "stop"
-            async for chunk in client.send_message(bot=response["bot"], message=response["message"], file_path=image_urls):
-                if max_tokens and await helpers.__tokenize(chunk["text"]) >= max_tokens:
+            counter = await helpers.__token_counter()
+            scanner = helpers.ToolCallScanner() if response.get("tools") else None
+            chunk = None
+            async for chunk in client.send_message(bot=response["bot"], message=response["message"], chatId=response.get("chatId"), chatCode=response.get("chatCode"), file_path=image_urls):
+                completion_tokens = counter.update(chunk["text"])
+                if max_tokens and completion_tokens >= max_tokens:
                     await client.cancel_message(chunk)
                     finish_reason = "length"
                     break
-                pass
+                if scanner and scanner.verdict == None and scanner.feed(chunk["text"]) == "tool_calls":
+                    raw_tool_calls = await helpers.__parse_tool_calls(scanner.array(chunk["text"]))
+                    if raw_tool_calls:
+                        # Nothing after the array is used, the rest of the generation is stopped
+                        await client.cancel_message(chunk)
+                        finish_reason = "tool_calls"
+                        break
         except Exception as e:
             raise HTTPException(detail={"error": {"message": f"Failed to generate completion. Error: {e}", "type": "error", "param": None, "code": 500}}, status_code=500) from e
         
-        completion_tokens = await helpers.__tokenize(chunk["text"])
+        completion_tokens = counter.count()
+        
+        if chunk == None:
+            # A bot that sent nothing leaves an empty reply that is neither remembered nor cached
+            chunk = {"text": ""}
+        else:
+            if conversation and finish_reason == "stop":
+                await remember_conversation(client, response, conversation, chunk)
+            if response.get("cache_key") and finish_reason in ("stop", "tool_calls"):
+                app.state.responses.put(response["cache_key"], {"text": chunk["text"], "prompt_tokens": prompt_tokens, "raw_tool_calls": raw_tool_calls})
         
     else:
         completion_tokens = await helpers.__tokenize(''.join([str(tool_call["name"]) + str(tool_call["arguments"]) for tool_call in raw_tool_calls]))
         chunk = {"text": ""}
         finish_reason = "tool_calls"
         
+    if ticket:
+        ticket.release()
+    
     content = ChatCompletionResponse(
         id=f"chatcmpl-{completion_id}",
         object="chat.completion",
@@ -446,27 +827,127 @@ async def non_streaming_response(
     return ORJSONResponse(content.model_dump())
 
 
-async def rotate_token(tokens) -> Tuple[AsyncPoeApi, bool]:
-    if len(tokens) == 0:
+async def remember_conversation(client: AsyncPoeApi, response: dict, conversation: dict, chunk: dict):
+    if chunk.get("chatCode") == None:
+        return
+    app.state.conversations.store(conversation["model"], conversation["messages"], chunk["text"], client.tokens, response["bot"], chunk["chatCode"], chunk["chatId"])
+
+
+def overloaded(e: AdmissionRejected) -> HTTPException:
+    return HTTPException(detail={"error": {"message": str(e), "type": "error", "param": None, "code": 429}}, status_code=429, headers={"Retry-After": str(e.retry_after)})
+
+
+async def admit_request(model: str, preferred: dict = None) -> Ticket:
+    if app.state.admission == None:
+        return None
+    try:
+        ticket = await app.state.admission.acquire(model, app.state.tokens, preferred)
+    except AdmissionRejected as e:
+        raise overloaded(e) from e
+    if ticket == None:
+        raise HTTPException(detail={"error": {"message": "All tokens have been used. Please add more tokens.", "type": "error", "param": None, "code": 402}}, status_code=402)
+    return ticket
+
+
+async def rotate_token(tokens, preferred: dict = None, ticket: Ticket = None) -> Tuple[AsyncPoeApi, bool]:
+    # One snapshot, another worker may remove an account between two reads of the shared store
+    snapshot = list(tokens)
+    if len(snapshot) == 0:
         raise HTTPException(detail={"error": {"message": "All tokens have been used. Please add more tokens.", "type": "error", "param": None, "code": 402}}, status_code=402)
-    token = random.choice(tokens)
+    # A cached conversation can only be continued from the account that owns the chat
+    if ticket and not ticket.released:
+        token = ticket.token
+    else:
+        token = preferred if preferred in snapshot else random.choice(snapshot)
     client = await AsyncPoeApi(token).create()
     settings = await client.get_settings()
+    if tokens.balance_due(token):
+        await asyncio.get_running_loop().run_in_executor(None, tokens.update_balance, token, settings["messagePointInfo"]["messagePointBalance"])
     if settings["messagePointInfo"]["messagePointBalance"] <= 20:
         tokens.remove(token)
-        return await rotate_token(tokens)
+        if ticket and tokens:
+            try:
+                await ticket.renew(tokens)
+            except AdmissionRejected as e:
+                raise overloaded(e) from e
+        return await rotate_token(tokens, ticket=ticket)
     subscriptions = settings["subscription"]["isActive"]
     return client, subscriptions
 
 
+async def batch_request(url: str, body: dict) -> Tuple[int, dict, dict]:
+    # Each line of a batch goes through the same path as a regular non-streamed request
+    try:
+        response = await chat_completions(None, ChatData(**{**body, "stream": False}))
+    except HTTPException as e:
+        return e.status_code, e.detail, e.headers or {}
+    except ValueError as e:
+        return 400, {"error": {"message": f"Invalid request body. Error: {e}", "type": "error", "param": None, "code": 400}}, {}
+    return 200, orjson.loads(response.body), {}
+
+
+def on_startup():
+    # Scheduled on the event loop daphne runs, daphne does not run the ASGI lifespan.
+    # Only the first worker picks up the batches a previous run left unfinished
+    if os.environ.get("POE_WORKER", "0") == "0":
+        app.state.batches.resume()
+
+
+configure_server(**orjson.loads(os.environ.get("POE_SERVER_OPTIONS", "{}")))
+
+if "POE_TOKEN_STORE" in os.environ:
+    twisted_loop.call_soon(on_startup)
+
+
 if __name__ == "__main__":
     CommandLineInterface().run(["api:app", "--bind", "127.0.0.1", "--port", "8000"])
     
     
-def start_server(tokens: list, address: str="127.0.0.1", port: str="8000"):
+def start_server(tokens: list, address: str="127.0.0.1", port: str="8000", response_cache: bool=False, cache_size: int=1000, cache_ttl: int=3600, cache_path: str=None,
+                 model_concurrency: int=16, account_concurrency: int=3, queue_size: int=64, queue_timeout: float=30, workers: int=1, token_store: str=None,
+                 batch_dir: str="batches", batch_concurrency: int=8, batch_rate: float=2.0, single_pass_tools: bool=False,
+                 stream_flush_bytes: int=64, stream_flush_ms: float=50, stream_flush_sentences: bool=True):
     if not isinstance(tokens, list):
         raise TypeError("Tokens must be a list.")
     if not all(isinstance(token, dict) for token in tokens):
         raise TypeError("Tokens must be a list of dictionaries.")
-    app.state.tokens = tokens
-    CommandLineInterface().run(["poe_api_wrapper.openai.api:app", "--bind", f"{address}", "--port", f"{port}"])
\ No newline at end of file
+    options = {"response_cache": response_cache, "cache_size": cache_size, "cache_ttl": cache_ttl, "cache_path": cache_path,
+               "model_concurrency": model_concurrency, "account_concurrency": account_concurrency, "queue_size": queue_size, "queue_timeout": queue_timeout,
+               "batch_dir": os.path.abspath(batch_dir), "batch_concurrency": batch_concurrency, "batch_rate": batch_rate,
+               "single_pass_tools": single_pass_tools, "stream_flush_bytes": stream_flush_bytes, "stream_flush_ms": stream_flush_ms, "stream_flush_sentences": stream_flush_sentences}
+    if workers > 1:
+        return start_workers(tokens, address, port, workers, token_store, options)
+    app.state.tokens = TokenStore(tokens, token_store)
+    configure_server(**options)
+    # daphne does not run the ASGI lifespan, so the encoder is loaded here instead of on the first request
+    helpers.__get_encoder()
+    twisted_loop.call_soon(on_startup)
+    CommandLineInterface().run(["poe_api_wrapper.openai.api:app", "--bind", f"{address}", "--port", f"{port}"])
+
+
+def start_workers(tokens: list, address: str, port: str, workers: int, token_store: str, options: dict):
+    # Every worker is a daphne process accepting on one shared listening socket,
+    # the accounts and their health are shared through the token store
+    if os.name == "nt":
+        raise RuntimeError("Multiple workers are not supported on Windows.")
+    token_store = token_store or os.path.join(tempfile.gettempdir(), f"poe-api-wrapper-{port}.db")
+    TokenStore(tokens, token_store)
+    listener = socket.create_server((address, int(port)), backlog=1024)
+    listener.set_inheritable(True)
+    env = {**os.environ, "POE_TOKEN_STORE": token_store, "POE_WORKERS": str(workers), "POE_SERVER_OPTIONS": orjson.dumps(options).decode()}
+    processes = [
+        subprocess.Popen(
+            [sys.executable, "-m", "daphne", "--fd", str(listener.fileno()), "poe_api_wrapper.openai.api:app"],
+            pass_fds=(listener.fileno(),), env={**env, "POE_WORKER": str(worker)}
+        ) for worker in range(workers)
+    ]
+    # Stopping the parent stops the workers too
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        for process in processes:
+            process.wait()
+    finally:
+        for process in processes:
+            if process.poll() == None:
+                process.terminate()
+        listener.close()
@@ -0,0 +1,240 @@
+import asyncio, orjson, os, time
+from typing import Awaitable, Callable, Tuple
+from loguru import logger
+from poe_api_wrapper.utils import RateLimiter, generate_nonce
+
+BATCH_ENDPOINTS = ("/v1/chat/completions",)
+# A batch in one of these states was interrupted and is picked up again on startup
+UNFINISHED_STATES = ("validating", "in_progress", "finalizing", "cancelling")
+# Admission rejections and upstream errors usually pass, these are retried before a line is given up
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+class BatchStore:
+    # Uploaded files and batch jobs on disk. Metadata is replaced atomically so a crash never leaves a partial record
+    def __init__(self, path: str="batches"):
+        self.path = path
+
+    def _write(self, path: str, data: bytes):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f"{path}.tmp", 'wb') as f:
+            f.write(data)
+        os.replace(f"{path}.tmp", path)
+
+    def _read(self, path: str):
+        try:
+            with open(path, 'rb') as f:
+                return orjson.loads(f.read())
+        except (OSError, orjson.JSONDecodeError):
+            return None
+
+    def file_path(self, file_id: str) -> str:
+        return os.path.join(self.path, "files", f"{os.path.basename(file_id)}.jsonl")
+
+    def create_file(self, content: bytes, filename: str, purpose: str) -> dict:
+        file = {"id": f"file-{generate_nonce(24)}", "object": "file", "bytes": len(content), "created_at": int(time.time()), "filename": filename, "purpose": purpose}
+        self._write(self.file_path(file["id"]), content)
+        self.save_file(file)
+        return file
+
+    def save_file(self, file: dict):
+        self._write(os.path.join(self.path, "files", f"{file['id']}.json"), orjson.dumps(file))
+
+    def get_file(self, file_id: str):
+        return self._read(os.path.join(self.path, "files", f"{os.path.basename(file_id)}.json"))
+
+    def create_batch(self, input_file_id: str, endpoint: str, completion_window: str, metadata: dict=None) -> dict:
+        batch = {
+            "id": f"batch_{generate_nonce(24)}",
+            "object": "batch",
+            "endpoint": endpoint,
+            "errors": None,
+            "input_file_id": input_file_id,
+            "completion_window": completion_window,
+            "status": "validating",
+            # Reserved up front so a resumed batch keeps appending to the same files
+            "output_file_id": f"file-{generate_nonce(24)}",
+            "error_file_id": f"file-{generate_nonce(24)}",
+            "created_at": int(time.time()),
+            "in_progress_at": None,
+            "expires_at": int(time.time()) + 86400,
+            "finalizing_at": None,
+            "completed_at": None,
+            "failed_at": None,
+            "expired_at": None,
+            "cancelling_at": None,
+            "cancelled_at": None,
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+            "metadata": metadata,
+        }
+        self.save_batch(batch)
+        return batch
+
+    def save_batch(self, batch: dict):
+        self._write(os.path.join(self.path, "batches", f"{batch['id']}.json"), orjson.dumps(batch))
+
+    def get_batch(self, batch_id: str):
+        return self._read(os.path.join(self.path, "batches", f"{os.path.basename(batch_id)}.json"))
+
+    def list_batches(self) -> list:
+        directory = os.path.join(self.path, "batches")
+        if not os.path.exists(directory):
+            return []
+        batches = [self.get_batch(name[:-5]) for name in os.listdir(directory) if name.endswith(".json")]
+        return sorted([batch for batch in batches if batch], key=lambda batch: batch["created_at"], reverse=True)
+
+class BatchRunner:
+    # Runs the requests of a batch with bounded concurrency and a shared rate limit.
+    # Every result is appended to the output or error file as soon as it arrives, a restarted
+    # server skips the custom_ids already written and carries on with the rest.
+    # process returns the status code, body and headers of the response
+    def __init__(self, store: BatchStore, process: Callable[[str, dict], Awaitable[Tuple[int, dict, dict]]], concurrency: int=8, rate: float=2.0, retries: int=5, backoff: float=2.0, max_backoff: float=60):
+        self.store = store
+        self.process = process
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.limiter = RateLimiter(rate, concurrency)
+        self.tasks: dict[str, asyncio.Task] = {}
+
+    def start(self, batch_id: str):
+        if batch_id not in self.tasks:
+            self.tasks[batch_id] = asyncio.create_task(self.run(batch_id))
+            self.tasks[batch_id].add_done_callback(lambda _: self.tasks.pop(batch_id, None))
+
+    def resume(self):
+        for batch in self.store.list_batches():
+            if batch["status"] in UNFINISHED_STATES:
+                logger.info(f"Resuming batch {batch['id']}")
+                self.start(batch["id"])
+
+    def cancel(self, batch_id: str) -> dict:
+        batch = self.store.get_batch(batch_id)
+        if batch["status"] in ("validating", "in_progress"):
+            batch["status"] = "cancelling"
+            batch["cancelling_at"] = int(time.time())
+            self.store.save_batch(batch)
+        return batch
+
+    def _cancelled(self, batch_id: str) -> bool:
+        # Read from disk, the cancel request may have reached another worker process
+        batch = self.store.get_batch(batch_id)
+        return batch == None or batch["status"] == "cancelling"
+
+    def _save(self, batch: dict):
+        if self._cancelled(batch["id"]) and batch["status"] in ("validating", "in_progress"):
+            batch["status"] = "cancelling"
+            batch["cancelling_at"] = batch["cancelling_at"] or int(time.time())
+        self.store.save_batch(batch)
+
+    def _validate(self, batch: dict) -> Tuple[list, list]:
+        errors, requests, custom_ids = [], [], set()
+        file = self.store.get_file(batch["input_file_id"])
+        if file == None:
+            return [{"code": "invalid_file", "message": "The input file does not exist.", "param": "input_file_id", "line": None}], []
+        with open(self.store.file_path(file["id"]), 'rb') as f:
+            lines = f.read().splitlines()
+        for number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                request = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                errors.append({"code": "invalid_json_line", "message": "This line is not parseable as valid JSON.", "param": None, "line": number})
+                continue
+            if not isinstance(request, dict) or not isinstance(request.get("body"), dict) or request.get("method") != "POST":
+                errors.append({"code": "invalid_request", "message": "Each line needs a custom_id, method POST, url and a body object.", "param": None, "line": number})
+            elif request.get("url") != batch["endpoint"]:
+                errors.append({"code": "mismatched_endpoint", "message": f"The url must match the batch endpoint {batch['endpoint']}.", "param": "url", "line": number})
+            elif not isinstance(request.get("custom_id"), str) or request["custom_id"] in custom_ids:
+                errors.append({"code": "duplicate_custom_id", "message": "The custom_id must be a unique string.", "param": "custom_id", "line": number})
+            else:
+                custom_ids.add(request["custom_id"])
+                requests.append(request)
+        if not requests and not errors:
+            errors.append({"code": "empty_file", "message": "The input file has no requests.", "param": None, "line": None})
+        return errors, requests
+
+    def _written(self, file_id: str) -> set:
+        # A crash can leave a partial last line behind, it is cut off before appending again
+        path = self.store.file_path(file_id)
+        if not os.path.exists(path):
+            return set()
+        with open(path, 'rb') as f:
+            data = f.read()
+        end = data.rfind(b'\n') + 1
+        if end != len(data):
+            with open(path, 'r+b') as f:
+                f.truncate(end)
+        return {orjson.loads(line)["custom_id"] for line in data[:end].splitlines() if line.strip()}
+
+    def _delay(self, attempt: int, headers: dict) -> float:
+        # The server knows best when a slot frees up, otherwise the wait doubles with each attempt
+        try:
+            return float(headers.get("Retry-After"))
+        except (TypeError, ValueError):
+            return min(self.backoff * 2 ** attempt, self.max_backoff)
+
+    async def run(self, batch_id: str):
+        batch = self.store.get_batch(batch_id)
+        errors, requests = self._validate(batch)
+        if errors:
+            batch["status"], batch["failed_at"] = "failed", int(time.time())
+            batch["errors"] = {"object": "list", "data": errors}
+            self.store.save_batch(batch)
+            return
+
+        completed, failed = self._written(batch["output_file_id"]), self._written(batch["error_file_id"])
+        pending = [request for request in requests if request["custom_id"] not in completed and request["custom_id"] not in failed]
+        batch["request_counts"] = {"total": len(requests), "completed": len(completed), "failed": len(failed)}
+        if batch["status"] == "validating":
+            batch["status"], batch["in_progress_at"] = "in_progress", int(time.time())
+        self._save(batch)
+
+        semaphore, expired = asyncio.Semaphore(self.concurrency), 0
+        with open(self.store.file_path(batch["output_file_id"]), 'ab') as output, open(self.store.file_path(batch["error_file_id"]), 'ab') as error:
+            async def execute(request: dict):
+                nonlocal expired
+                async with semaphore:
+                    status_code = None
+                    for attempt in range(self.retries + 1):
+                        if batch["status"] == "cancelling":
+                            return
+                        if time.time() >= batch["expires_at"]:
+                            status_code = None
+                            break
+                        await self.limiter.wait_async()
+                        try:
+                            status_code, body, headers = await self.process(request["url"], request["body"])
+                        except Exception as e:
+                            status_code, body, headers = 500, {"error": {"message": f"Failed to process the request. Error: {e}", "type": "error", "param": None, "code": 500}}, {}
+                        if status_code not in RETRY_STATUS_CODES or attempt == self.retries:
+                            break
+                        await asyncio.sleep(max(0, min(self._delay(attempt, headers), batch["expires_at"] - time.time())))
+                    line = {"id": f"batch_req_{generate_nonce(24)}", "custom_id": request["custom_id"]}
+                    if status_code == None:
+                        # The completion window ran out before the request got an answer
+                        expired += 1
+                        line.update({"response": None, "error": {"code": "batch_expired", "message": "This request could not be executed before the completion window expired."}})
+                    else:
+                        line.update({"response": {"status_code": status_code, "request_id": generate_nonce(32), "body": body}, "error": None})
+                    target = output if status_code == 200 else error
+                    target.write(orjson.dumps(line) + b'\n')
+                    target.flush()
+                    batch["request_counts"]["completed" if status_code == 200 else "failed"] += 1
+                    self._save(batch)
+
+            await asyncio.gather(*[execute(request) for request in pending])
+
+        now = int(time.time())
+        if batch["status"] == "cancelling":
+            batch["status"], batch["cancelled_at"] = "cancelled", now
+        elif expired:
+            batch["status"], batch["expired_at"] = "expired", now
+        else:
+            batch["status"], batch["finalizing_at"], batch["completed_at"] = "completed", now, now
+        for file_id, kind in ((batch["output_file_id"], "output"), (batch["error_file_id"], "error")):
+            size = os.path.getsize(self.store.file_path(file_id))
+            self.store.save_file({"id": file_id, "object": "file", "bytes": size, "created_at": now, "filename": f"{batch['id']}_{kind}.jsonl", "purpose": "batch_output"})
+        self.store.save_batch(batch)
+        logger.info(f"Batch {batch['id']} {batch['status']}: {batch['request_counts']}")
@@ -0,0 +1,116 @@
+import hashlib, orjson, sqlite3, time
+from collections import OrderedDict
+
+class ConversationCache:
+    # Maps the hash of an OpenAI message history to the Poe chat that already holds it,
+    # so a follow-up request only has to send its newest user message.
+    # Kept per process, with several workers a follow-up only continues the chat when it lands on the same worker
+    def __init__(self, max_entries: int=10000, ttl: int=86400):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries: OrderedDict[str, dict] = OrderedDict()
+
+    @staticmethod
+    def cacheable(messages: list) -> bool:
+        return all(message["role"] in ("system", "user", "assistant") and isinstance(message.get("content"), str) and "tool_calls" not in message for message in messages)
+
+    @staticmethod
+    def digest(model: str, messages: list) -> str:
+        return hashlib.sha256(orjson.dumps([model, [[message["role"], message["content"]] for message in messages]])).hexdigest()
+
+    def lookup(self, model: str, messages: list):
+        # The entry is claimed by the request, two requests can never continue the same chat at once
+        if len(messages) < 2 or messages[-1]["role"] != "user" or messages[-2]["role"] != "assistant" or not self.cacheable(messages):
+            return None
+        entry = self.entries.pop(self.digest(model, messages[:-1]), None)
+        if entry == None or time.monotonic() - entry["time"] > self.ttl:
+            return None
+        return entry
+
+    def store(self, model: str, messages: list, reply: str, token: dict, bot: str, chatCode: str, chatId: int):
+        history = messages + [{"role": "assistant", "content": reply}]
+        key = self.digest(model, history)
+        self.entries[key] = {"token": token, "bot": bot, "chatCode": chatCode, "chatId": chatId, "time": time.monotonic()}
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+class ResponseCache:
+    # Completions of deterministic requests, kept in memory and optionally in a sqlite file shared across restarts
+    def __init__(self, max_entries: int=1000, ttl: int=3600, path: str=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries: OrderedDict[str, tuple] = OrderedDict()
+        self.db = None
+        if path:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value BLOB, created REAL)")
+            self.db.execute("DELETE FROM responses WHERE created < ?", (time.time() - ttl,))
+            self.db.commit()
+
+    @staticmethod
+    def key(data) -> str:
+        # Only requests at temperature 0 are expected to produce the same completion twice
+        if data.temperature != 0:
+            return None
+        request = {"model": data.model, "messages": data.messages, "tools": data.tools, "tool_choice": data.tool_choice, "max_tokens": data.max_tokens}
+        return hashlib.sha256(orjson.dumps(request, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+    def get(self, key: str):
+        entry = self.entries.get(key)
+        if entry == None and self.db != None:
+            row = self.db.execute("SELECT value, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row:
+                entry = (orjson.loads(row[0]), row[1])
+                self.entries[key] = entry
+        if entry == None:
+            return None
+        if time.time() - entry[1] > self.ttl:
+            self.entries.pop(key, None)
+            return None
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key: str, value: dict):
+        created = time.time()
+        self.entries[key] = (value, created)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        if self.db != None:
+            self.db.execute("INSERT OR REPLACE INTO responses (key, value, created) VALUES (?, ?, ?)", (key, orjson.dumps(value), created))
+            self.db.commit()
+
+class CachedReply:
+    # Stands in for AsyncPoeApi so a cached completion is replayed through the regular response path
+    def __init__(self, text: str):
+        self.text = text
+
+    async def send_message(self, **kwargs):
+        yield {"text": self.text, "response": self.text, "chatCode": None, "chatId": None}
+
+    async def cancel_message(self, chunk: dict):
+        pass
+
+class ImageCache:
+    # Downloaded images by url, bounded by their total size
+    def __init__(self, max_bytes: int=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries: OrderedDict[str, bytes] = OrderedDict()
+
+    def get(self, url: str):
+        content = self.entries.get(url)
+        if content != None:
+            self.entries.move_to_end(url)
+        return content
+
+    def put(self, url: str, content: bytes):
+        if len(content) > self.max_bytes:
+            return
+        if url in self.entries:
+            self.size -= len(self.entries.pop(url))
+        self.entries[url] = content
+        self.size += len(content)
+        while self.size > self.max_bytes:
+            self.size -= len(self.entries.popitem(last=False)[1])
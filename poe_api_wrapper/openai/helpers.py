@@ -1,61 +1,11 @@
-import random, string, time
-from heapq import nlargest
+import random, string, time, asyncio, orjson
+from functools import lru_cache
 from loguru import logger
 
-from nltk.data import find as resource_find
-from nltk import download as nltk_download
-
-try:
-    resource_find('corpora/stopwords')
-except LookupError:
-    logger.warning("NLTK stopwords not found. Downloading...")
-    nltk_download('stopwords')
-try:
-    resource_find('tokenizers/punkt')
-except LookupError:
-    logger.warning("NLTK punkt not found. Downloading...")
-    nltk_download('punkt')
-    
-from nltk.corpus import stopwords
-from nltk.probability import FreqDist
-from nltk.stem import PorterStemmer
-from nltk.tokenize import sent_tokenize, word_tokenize
-import tiktoken
+import tiktoken, regex
+import numpy as np
 from fastapi import HTTPException
 
-async def __progressive_summarize_text(text, max_length, initial_reduction_ratio=0.8, step=0.1):
-    current_tokens = await __tokenize(text)
-    if current_tokens < max_length:
-        return text
-    
-    stop_words = set(stopwords.words("english"))
-    ps = PorterStemmer()
-    sentences = sent_tokenize(text)
-
-    # Remove stopwords and apply stemming
-    words = [ps.stem(word) for word in word_tokenize(text.lower()) if word not in stop_words]
-    
-    # Calculate word frequencies
-    word_freqs = FreqDist(words)
-
-    # Score sentences based on word frequency
-    sentence_scores = {idx: sum(word_freqs.get(word, 0) for word in word_tokenize(sentence.lower())) for idx, sentence in enumerate(sentences)}
-    
-    reduction_ratio = initial_reduction_ratio
-
-    # Extract top N sentences based on their scores
-    while True:
-        num_sentences = max(1, round(len(sentences) * reduction_ratio))
-        selected_indexes = nlargest(num_sentences, sentence_scores, key=sentence_scores.get)
-        summary = '\n'.join(sentences[idx] for idx in sorted(selected_indexes))
-
-        if 0 < len(summary.strip()) <= max_length or reduction_ratio - step < 0:
-            break
-        else:
-            reduction_ratio -= step
-
-    return summary
-
 async def __validate_messages_format(messages):
     if not messages:
         return False
@@ -97,9 +47,120 @@ async def __generate_completion_id():
 async def __generate_timestamp():
     return int(time.time())
 
+# Texts up to this size are memoized, longer ones are counted in a worker thread since tiktoken releases the GIL
+TOKEN_CACHE_SIZE = 2048
+TOKEN_CACHE_MAX_CHARS = 32768
+TOKENIZE_OFFLOAD_CHARS = 65536
+
+ENCODER = None
+
+def __get_encoder():
+    global ENCODER
+    if ENCODER == None:
+        ENCODER = tiktoken.get_encoding("cl100k_base")
+    return ENCODER
+
+@lru_cache(maxsize=TOKEN_CACHE_SIZE)
+def __count_tokens_cached(text):
+    return len(__get_encoder().encode_ordinary(text))
+
+def __count_tokens(text):
+    if len(text) <= TOKEN_CACHE_MAX_CHARS:
+        return __count_tokens_cached(text)
+    return len(__get_encoder().encode_ordinary(text))
+
 async def __tokenize(text):
-    enconder = tiktoken.get_encoding("cl100k_base")
-    return len(enconder.encode(text))
+    if len(text) >= TOKENIZE_OFFLOAD_CHARS:
+        return await asyncio.get_running_loop().run_in_executor(None, __count_tokens, text)
+    return __count_tokens(text)
+
+class TokenCounter:
+    # Counts the tokens of a growing text in O(n) overall. BPE never merges across the pre-tokens produced
+    # by the encoder regex, so everything but the last two pre-tokens is final and only encoded once
+    def __init__(self, encoder):
+        self.encoder = encoder
+        self.pattern = regex.compile(encoder._pat_str)
+        self.committed = 0
+        self.length = 0
+        self.pending = ""
+
+    def update(self, text: str) -> int:
+        # Takes the whole text received so far, only the part after the previous call is processed
+        if len(text) < self.length:
+            self.committed, self.length, self.pending = 0, 0, ""
+        self.pending += text[self.length:]
+        self.length = len(text)
+        matches = list(self.pattern.finditer(self.pending))
+        if len(matches) > 2:
+            # Pre-tokens are encoded one by one, a joined slice could be split differently by the regex
+            self.committed += sum(len(self.encoder.encode_ordinary(match.group())) for match in matches[:-2])
+            self.pending = self.pending[matches[-2].start():]
+        return self.count()
+
+    def count(self) -> int:
+        return self.committed + len(self.encoder.encode_ordinary(self.pending))
+
+async def __token_counter():
+    return TokenCounter(__get_encoder())
+
+SENTENCE_PATTERN = regex.compile(r"[^\n.!?]*(?:[.!?]+|\n|$)")
+WORD_PATTERN = regex.compile(r"\w+")
+STOPWORDS = frozenset("""a about above after again against all am an and any are as at be because been before being below between both
+but by can could did do does doing down during each few for from further had has have having he her here hers herself him himself his
+how i if in into is it its itself just me more most my myself no nor not now of off on once only or other our ours ourselves out over own
+same she should so some such than that the their theirs them themselves then there these they this those through to too under until up
+very was we were what when where which while who whom why will with would you your yours yourself yourselves""".split())
+
+def __compress_text(text, max_tokens):
+    encoder = __get_encoder()
+    sentences = [sentence.strip() for sentence in SENTENCE_PATTERN.findall(text)]
+    sentences = [sentence for sentence in sentences if sentence]
+    if not sentences:
+        return ""
+    
+    # Term frequencies over the whole text, computed once and shared by every sentence
+    words = [WORD_PATTERN.findall(sentence.lower()) for sentence in sentences]
+    owners = np.repeat(np.arange(len(sentences)), [len(sentence_words) for sentence_words in words])
+    flat_words = [word for sentence_words in words for word in sentence_words]
+    if flat_words:
+        vocabulary, word_ids = np.unique(flat_words, return_inverse=True)
+        frequencies = np.bincount(word_ids).astype(np.float64)
+        frequencies[np.fromiter((word in STOPWORDS for word in vocabulary), dtype=bool, count=len(vocabulary))] = 0
+        scores = np.bincount(owners, weights=frequencies[word_ids], minlength=len(sentences))
+    else:
+        scores = np.zeros(len(sentences))
+    
+    # Each sentence costs its own tokens plus the newline joining it to the next one
+    costs = np.fromiter((len(tokens) + 1 for tokens in encoder.encode_ordinary_batch(sentences)), dtype=np.int64, count=len(sentences))
+    order = np.argsort(-(scores / costs), kind="stable")
+    prefix = np.cumsum(costs[order])
+    taken = int(np.searchsorted(prefix, max_tokens + 1, side="right"))
+    selected = list(order[:taken])
+    remaining = max_tokens + 1 - (int(prefix[taken - 1]) if taken else 0)
+    for index in order[taken:]:
+        if costs[index] <= remaining:
+            selected.append(index)
+            remaining -= costs[index]
+    
+    if not selected:
+        # Not even one sentence fits, keep the most recent part of the text
+        return encoder.decode(encoder.encode_ordinary(text)[-max_tokens:])
+    # Punctuation can merge with the joining newline, so the result is checked once against the exact count
+    summary = "\n".join(sentences[index] for index in sorted(selected))
+    while len(selected) > 1 and len(encoder.encode_ordinary(summary)) > max_tokens:
+        selected.pop()
+        summary = "\n".join(sentences[index] for index in sorted(selected))
+    return summary
+
+async def __summarize_text(text, max_tokens):
+    # Extractive compression into at most max_tokens tokens, keeping the best scoring sentences in their original order
+    if max_tokens <= 0:
+        return ""
+    if await __tokenize(text) <= max_tokens:
+        return text
+    if len(text) >= TOKENIZE_OFFLOAD_CHARS:
+        return await asyncio.get_running_loop().run_in_executor(None, __compress_text, text, max_tokens)
+    return __compress_text(text, max_tokens)
 
 async def __stringify_messages(messages):
     return '\n'.join(f"<{message['role'].capitalize()}>{message['content']}</{message['role'].capitalize()}>" for message in messages)
@@ -117,7 +178,7 @@ async def __add_tools_prompt(messages):
     return messages
 
 
-async def __convert_functions_format(input_data, tool_choice="auto"):
+async def __convert_functions_format(input_data, tool_choice="auto", fold=False):
     try:
         if isinstance(tool_choice, dict):
             if len(tool_choice) == 2 and ("type" in tool_choice and tool_choice["type"] == "function" and "function" in tool_choice and "name" in tool_choice["function"]):
@@ -188,7 +249,13 @@ Your response must consists and always be in the below format at any time using
 [{"name: <str>, "arguments": <dict>}, {<function-2>}, ... , {<function-n>}].
 // All keys and values in dictionary must be always in double quotes.
 // You must always follow the guidelines and rules of the tool function you are using.
-// If there is no need to use tool, then reply to user with None, ignore and do not mention/imply what I just told you in your next response.
+"""
+        if fold:
+            # The same reply either calls the tools or answers the user, so prose has to stay possible
+            output += """// If there is no need to use tool, then reply to the user's most recent message directly in plain text, do not start your reply with [ and do not mention/imply what I just told you in your next response.
+"""
+        else:
+            output += """// If there is no need to use tool, then reply to user with None, ignore and do not mention/imply what I just told you in your next response.
 """
         if tool_choice == "required":
             output += """// System Exception: You must also call at least one function in your next response at any cost."""
@@ -203,4 +270,158 @@ Your response must consists and always be in the below format at any time using
                                             "type": "error", 
                                             "param": None, 
                                             "code": 400}
-                                        }, status_code=400)
\ No newline at end of file
+                                        }, status_code=400)
+async def __parse_tool_calls(text):
+    # Returns the tool calls of a reply that is a [{"name": ..., "arguments": ...}] list, None for prose
+    text = text.strip()
+    if not text.startswith("["):
+        return None
+    for candidate in (text, text.replace("\n", "").replace("\\", "")):
+        try:
+            tool_calls = orjson.loads(candidate)
+        except orjson.JSONDecodeError:
+            continue
+        if tool_calls and isinstance(tool_calls, list) and all(isinstance(tool_call, dict) and "name" in tool_call for tool_call in tool_calls):
+            for tool_call in tool_calls:
+                tool_call.setdefault("arguments", {})
+            return tool_calls
+    return None
+
+TOOL_CALL_PREFIXES = ('[{"name"', '[{"arguments"')
+CODE_FENCE_PATTERN = regex.compile(r"```(?:json)?[ \t]*\r?\n")
+
+class ToolCallScanner:
+    # Follows a streamed reply and tells as early as possible whether it is a tool call array or prose.
+    # Only the text after the previous call is scanned, strings are tracked so brackets inside them are ignored
+    def __init__(self):
+        self.verdict = None
+        self.position = 0
+        self.start = None
+        self.end = None
+        self.prefix = ""
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+
+    def feed(self, text: str) -> str:
+        # Takes the whole text received so far, returns None until it is "prose" or a complete "tool_calls" array
+        if self.verdict != None:
+            return self.verdict
+        if self.start == None:
+            opening = text.lstrip()
+            if not opening:
+                return None
+            offset = len(text) - len(opening)
+            if opening.startswith("`"):
+                # A fenced array is accepted once the opening fence line is complete
+                fence = CODE_FENCE_PATTERN.match(opening)
+                if fence == None:
+                    if "\n" in opening or not "```json".startswith(opening.rstrip()[:7]):
+                        self.verdict = "prose"
+                    return self.verdict
+                rest = opening[fence.end():]
+                offset += fence.end() + len(rest) - len(rest.lstrip())
+                opening = rest.lstrip()
+                if not opening:
+                    return None
+            if not opening.startswith("["):
+                self.verdict = "prose"
+                return self.verdict
+            self.start = self.position = offset
+        for index in range(self.position, len(text)):
+            char = text[index]
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif char == "\\":
+                    self.escape = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char in "[{":
+                self.depth += 1
+            elif char in "]}":
+                self.depth -= 1
+                if self.depth == 0:
+                    self.end = index + 1
+                    self.verdict = "tool_calls"
+                    return self.verdict
+            if len(self.prefix) < 13 and (self.in_string or not char.isspace()):
+                self.prefix += char
+                if not any(prefix.startswith(self.prefix) or self.prefix.startswith(prefix) for prefix in TOOL_CALL_PREFIXES):
+                    self.verdict = "prose"
+                    return self.verdict
+        self.position = len(text)
+        return None
+
+    def array(self, text: str) -> str:
+        return text[self.start:self.end]
+
+class ChunkTemplate:
+    # Pre-rendered SSE frame of a content-only delta, byte for byte what create_completion_data and orjson produce for it.
+    # Only the content is encoded per chunk, tool call and usage frames still go through the pydantic models
+    def __init__(self, completion_id: str, created: int, model: str, include_usage: bool=False):
+        self.head = b'data: {"id":' + orjson.dumps(f"chatcmpl-{completion_id}") + b',"choices":[{"index":0,"delta":{"role":"assistant","content":'
+        self.tail = (b',"function_call":null,"tool_calls":null},"finish_reason":null}],"object":"chat.completion.chunk","created":'
+                     + orjson.dumps(created) + b',"model":' + orjson.dumps(model) + (b',"usage":null' if include_usage else b'') + b'}\n\n')
+
+    def render(self, content: str) -> bytes:
+        return self.head + orjson.dumps(content) + self.tail
+
+SENTENCE_ENDINGS = (".", "!", "?", "\n", "。", "！", "？")
+
+class StreamCoalescer:
+    # Groups streamed deltas into fewer frames, flushing once max_bytes are pending, max_delay seconds after
+    # the oldest pending delta, or at the end of a sentence. The first delta always goes out right away
+    def __init__(self, max_bytes: int=64, max_delay: float=0.05, sentences: bool=True):
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self.sentences = sentences
+        self.started = False
+        self.parts: list = []
+        self.size = 0
+        self.deadline: float = None
+
+    def add(self, text: str) -> str:
+        # Returns the text to send now, None while it is held back
+        if not text:
+            return None
+        self.parts.append(text)
+        self.size += len(text.encode())
+        if self.deadline == None:
+            self.deadline = time.monotonic() + self.max_delay
+        if (not self.started or self.size >= self.max_bytes or time.monotonic() >= self.deadline
+                or (self.sentences and text.rstrip(" ").endswith(SENTENCE_ENDINGS))):
+            self.started = True
+            return self.flush()
+        return None
+
+    def due(self) -> float:
+        # Seconds until the pending text has to go out, None when nothing is pending
+        return max(0.0, self.deadline - time.monotonic()) if self.parts else None
+
+    def flush(self) -> str:
+        text = "".join(self.parts)
+        self.parts, self.size, self.deadline = [], 0, None
+        return text
+
+class ChunkReader:
+    # Reads an async iterator with a timeout per item, without losing the item that arrives after the timeout
+    def __init__(self, chunks):
+        self.iterator = chunks.__aiter__()
+        self.pending = None
+
+    async def next(self, timeout: float=None):
+        # Returns the next item, None when the timeout passes first, raises StopAsyncIteration at the end
+        if self.pending == None:
+            self.pending = asyncio.ensure_future(self.iterator.__anext__())
+        done, _ = await asyncio.wait({self.pending}, timeout=timeout)
+        if not done:
+            return None
+        task, self.pending = self.pending, None
+        return task.result()
+
+    def cancel(self):
+        if self.pending != None:
+            self.pending.cancel()
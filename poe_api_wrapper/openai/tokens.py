@@ -0,0 +1,83 @@
+import orjson, sqlite3, threading, time
+
+TOKENS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tokens (
+    account TEXT PRIMARY KEY,
+    position INTEGER NOT NULL,
+    token BLOB NOT NULL,
+    balance INTEGER,
+    exhausted INTEGER NOT NULL DEFAULT 0,
+    updated REAL NOT NULL DEFAULT 0
+);
+"""
+
+class TokenStore:
+    # Account tokens and their health, shared by every worker process through one sqlite file.
+    # Each worker owns the accounts whose position falls in its shard and only borrows the
+    # other shards when all of its own accounts are exhausted.
+    # Behaves like the list of tokens rotate_token used to mutate, remove() marks an account exhausted
+    def __init__(self, tokens: list=None, path: str=None, shard: int=0, shards: int=1, refresh: float=1.0, balance_interval: float=60):
+        self.path = path
+        self.shard = shard
+        self.shards = shards
+        self.refresh = refresh
+        self.balance_interval = balance_interval
+        self.balancesAt: dict = {}
+        # Balances are written from an executor thread, the connection is used by one thread at a time
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path or ":memory:", check_same_thread=False, timeout=30)
+        if path:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(TOKENS_SCHEMA)
+        if tokens != None:
+            self.replace(tokens)
+        self.snapshot: list = []
+        self.loadedAt: float = 0
+
+    def replace(self, tokens: list):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM tokens")
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO tokens (account, position, token) VALUES (?, ?, ?)",
+                [(token['p-b'], position, orjson.dumps(token)) for position, token in enumerate(tokens)]
+            )
+        self.loadedAt = 0
+
+    def _tokens(self) -> list:
+        # Other workers write to the same file, so the snapshot is reloaded every refresh seconds
+        if time.monotonic() - self.loadedAt > self.refresh:
+            with self.lock:
+                rows = self.conn.execute("SELECT position, token FROM tokens WHERE exhausted = 0 ORDER BY position").fetchall()
+            owned = [orjson.loads(token) for position, token in rows if position % self.shards == self.shard]
+            self.snapshot = owned or [orjson.loads(token) for _, token in rows]
+            self.loadedAt = time.monotonic()
+        return self.snapshot
+
+    def __len__(self):
+        return len(self._tokens())
+
+    def __iter__(self):
+        return iter(list(self._tokens()))
+
+    def __getitem__(self, index: int) -> dict:
+        return self._tokens()[index]
+
+    def __contains__(self, token: dict):
+        return token in self._tokens()
+
+    def remove(self, token: dict):
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE tokens SET exhausted = 1, updated = ? WHERE account = ?", (time.time(), token['p-b']))
+        self.loadedAt = 0
+
+    def balance_due(self, token: dict) -> bool:
+        # Every request reports the balance of its account, it is written at most once per balance_interval
+        now = time.monotonic()
+        if now - self.balancesAt.get(token['p-b'], -self.balance_interval) < self.balance_interval:
+            return False
+        self.balancesAt[token['p-b']] = now
+        return True
+
+    def update_balance(self, token: dict, balance: int):
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE tokens SET balance = ?, updated = ? WHERE account = ?", (balance, time.time(), token['p-b']))
@@ -19,6 +19,7 @@ class ImagesGenData(BaseModel):
     model: Any
     n: Optional[int] = 1
     size: Optional[str] = '1024x1024'
+    response_format: Optional[str] = 'url'
     
 class ImagesEditData(BaseModel):
     image: Any
@@ -26,6 +27,13 @@ class ImagesEditData(BaseModel):
     model: Any
     n: Optional[int] = 1
     size: Optional[str] = '1024x1024'
+    response_format: Optional[str] = 'url'
+    
+class BatchData(BaseModel):
+    input_file_id: Any
+    endpoint: Any
+    completion_window: Optional[str] = '24h'
+    metadata: Optional[Dict[str, str]] = None
 
 
 # OpenAI typing
@@ -1,4 +1,6 @@
-import os, string, secrets, base64
+import os, string, secrets, base64, asyncio, threading
+from time import monotonic, sleep
+from functools import lru_cache
 from urllib.parse import urlparse
 from httpx import Client
 from loguru import logger
@@ -74,6 +76,8 @@ BOTS_LIST = {
 
 REVERSE_BOTS_LIST = {v: k for k, v in BOTS_LIST.items()}
 
+MESSAGE_FIELDS = ('author', 'text', 'messageId', 'contentType')
+
 EXTENSIONS = {
     '.md': 'application/octet-stream',
     '.lua': 'application/octet-stream',
@@ -106,11 +110,77 @@ MEDIA_EXTENSIONS = {
     '.wav': 'audio/wav',
 }
 
-def bot_map(bot):
-    if bot in BOTS_LIST:
-        return BOTS_LIST[bot]
+@lru_cache(maxsize=4096)
+def normalize_handle(bot: str) -> str:
     return bot.lower().replace(' ', '')
 
+class BotResolver:
+    # Resolves display names, handles and aliases to the bot name used by the API and back
+    def __init__(self, bots: dict=BOTS_LIST):
+        self.forward: dict[str, str] = {}
+        self.reverse: dict[str, str] = {}
+        self.aliases: dict[str, str] = {}
+        self.update(bots)
+
+    def update(self, bots: dict):
+        for name, model in bots.items():
+            self.forward[name] = model
+            # The first name registered for a model stays canonical, so live entries never shadow static ones
+            self.reverse.setdefault(model, name)
+            self.aliases.setdefault(normalize_handle(name), model)
+            self.aliases.setdefault(normalize_handle(model), model)
+
+    def update_from_catalog(self, nodes: list):
+        bots = {}
+        for node in nodes:
+            model = node.get('nickname') or normalize_handle(node['handle'])
+            for name in (node['handle'], node.get('displayName')):
+                if name and name not in self.forward:
+                    bots[name] = model
+        self.update(bots)
+
+    def resolve(self, bot: str) -> str:
+        model = self.forward.get(bot)
+        if model != None:
+            return model
+        normalized = normalize_handle(bot)
+        return self.aliases.get(normalized, normalized)
+
+    def handle(self, bot: str) -> str:
+        model = self.resolve(bot)
+        return self.reverse.get(model, model)
+
+RESOLVER = BotResolver()
+
+def bot_map(bot):
+    return RESOLVER.resolve(bot)
+
+class RateLimiter:
+    # Spaces requests out to `rate` per second after an initial burst, shared by threads and tasks alike
+    def __init__(self, rate: float=0.25, burst: int=1):
+        self.interval = 1 / rate if rate else 0
+        self.burst = burst
+        self.lock = threading.Lock()
+        self.next_slot = 0.0
+
+    def reserve(self) -> float:
+        # Claims the next slot and returns how long to wait for it
+        with self.lock:
+            now = monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+            return max(0.0, slot - (self.burst - 1) * self.interval - now)
+
+    def wait(self):
+        delay = self.reserve()
+        if delay:
+            sleep(delay)
+
+    async def wait_async(self):
+        delay = self.reserve()
+        if delay:
+            await asyncio.sleep(delay)
+
 def generate_nonce(length:int=16):
       return "".join(secrets.choice(string.ascii_letters + string.digits) for i in range(length))
 
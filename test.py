@@ -1,19 +1,842 @@
+from fastapi.testclient import TestClient
 from poe_api_wrapper import PoeApi
-import unittest, random, string, loguru
+from poe_api_wrapper.archive import ChatArchive
+from poe_api_wrapper.catalog import BotCatalog
+from poe_api_wrapper.openai import api as openai_api, helpers
+from poe_api_wrapper.openai.admission import AdmissionController, AdmissionRejected
+from poe_api_wrapper.openai.batches import BatchStore, BatchRunner
+from poe_api_wrapper.openai.cache import ResponseCache
+from poe_api_wrapper.openai.tokens import TokenStore
+from poe_api_wrapper.openai.type import ChatData
+from poe_api_wrapper.utils import BotResolver, RateLimiter
+import unittest, random, string, loguru, os, tempfile, threading, time, asyncio, orjson, tiktoken
 
 loguru.logger.disable('poe_api_wrapper')
 
-p_b = input("Enter your p-b cookie: ")
-p_lat = input("Enter your p-lat cookie: ")
-TOKEN = {'p-b': p_b, 'p-lat': p_lat}
+# The cookies are asked for when the live tests start, the offline tests run without them:
+# python test.py MessagePagesTest ArchiveTest BotResolverTest CatalogTest CrawlExploreTest GroupContextTest BatchResumeTest AdmissionTest ImageGenerationTest TokenStoreTest TokenCounterTest CompressTextTest ResponseCacheTest ToolCallScannerTest ModelsTest ChunkTemplateTest StreamCoalescerTest
+TOKEN = None
+OFFLINE_TOKEN = {'p-b': 'offline', 'p-lat': 'offline'}
 
 def testObjectGenerator(length):
        return ''.join(random.choice(string.ascii_letters) for _ in range(length))
+
+def offlineClient(send_request, catalog_path=None):
+    # A client that never connects, every request goes to send_request
+    client = PoeApi.__new__(PoeApi)
+    client.client = None
+    client.tokens = OFFLINE_TOKEN
+    client.categories = None
+    client.archive = None
+    client.catalog = BotCatalog(OFFLINE_TOKEN, catalog_path)
+    client.resolver = BotResolver()
+    client.send_request = lambda path, query_name, variables={}, *args, **kwargs: send_request(query_name, variables)
+    return client
+
+# The pre-tokenizer of cl100k_base with a small byte level vocabulary, tiktoken downloads the real one
+CL100K_PATTERN = r"""'(?i:[sdmt]|ll|ve|re)|[^\r\n\p{L}\p{N}]?+\p{L}++|\p{N}{1,3}+| ?[^\s\p{L}\p{N}]++[\r\n]*+|\s++$|\s*[\r\n]|\s+(?!\S)|\s"""
+OFFLINE_WORDS = ('The', ' the', ' moon', ' orbits', ' earth', ' tide', ' follows', ' sea', 'Café', ' au', ' lait', ' 中文', '中文', ' tokens', '👍🏽', '...', '.\n', '\n\n', '  ', '123')
+
+def offlineEncoder():
+    ranks = {bytes([byte]): byte for byte in range(256)}
+    # Every prefix of a word is a token too, so each word is reachable through merges
+    for word in OFFLINE_WORDS:
+        data = word.encode()
+        for end in range(2, len(data) + 1):
+            ranks.setdefault(data[:end], len(ranks))
+    return tiktoken.Encoding('offline', pat_str=CL100K_PATTERN, mergeable_ranks=ranks, special_tokens={})
+
+class MessagePagesTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.requests = []
+        
+    def send_request(self, query_name, variables):
+        # 250 messages, pages end at the cursor and go back page_size messages
+        self.requests.append(variables['cursor'])
+        end = 250 if variables['cursor'] == None else int(variables['cursor'])
+        start = max(0, end - variables['count'])
+        edges = [{'node': {'messageId': messageId, 'author': 'human', 'text': f'message {messageId}', 'contentType': 'text_markdown'}} for messageId in range(start + 1, end + 1)]
+        return {'data': {'node': {'messagesConnection': {'edges': edges, 'pageInfo': {'startCursor': str(start), 'hasPreviousPage': start > 0}}}}}
+        
+    def test_newest_first(self):
+        for prefetch in (True, False):
+            self.requests = []
+            client = offlineClient(self.send_request)
+            messageIds = [message['messageId'] for message in client._iter_messages('thread', page_size=100, prefetch=prefetch)]
+            self.assertEqual(messageIds, list(range(250, 0, -1)))
+            self.assertEqual(self.requests, [None, '150', '50'])
+            
+    def test_oldest_first(self):
+        client = offlineClient(self.send_request)
+        messageIds = [message['messageId'] for message in client._iter_messages('thread', oldest_first=True, page_size=100)]
+        self.assertEqual(messageIds, list(range(1, 251)))
+        # Only the middle page is requested twice
+        self.assertEqual(self.requests, [None, '150', '50', '150'])
+        
+    def test_early_stop(self):
+        client = offlineClient(self.send_request)
+        messages = client._iter_messages('thread', page_size=100, prefetch=False)
+        for _ in range(10):
+            next(messages)
+        messages.close()
+        self.assertEqual(self.requests, [None])
+        
+    def test_fields(self):
+        client = offlineClient(self.send_request)
+        message = next(client._iter_messages('thread', fields=('messageId',)))
+        self.assertEqual(message, {'messageId': 250})
+
+class ArchiveTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.archive = ChatArchive(os.path.join(self.directory.name, 'archive.db'), OFFLINE_TOKEN)
+        self.archive.save_threads('a2', [{'chatId': 1, 'chatCode': 'code1', 'id': 'thread1', 'title': 'Moon'}])
+        self.archive.save_threads('capybara', [{'chatId': 2, 'chatCode': 'code2', 'id': 'thread2', 'title': 'Sea'}])
+        self.archive.save_messages(1, [
+            {'messageId': 10, 'author': 'human', 'text': 'Tell me about the moon', 'creationTime': 1_000_000},
+            {'messageId': 11, 'author': 'a2', 'text': 'The moon orbits the earth', 'creationTime': 2_000_000},
+        ], 'a2')
+        self.archive.save_messages(2, [{'messageId': 20, 'author': 'human', 'text': 'Tell me about the sea', 'creationTime': 3_000_000}], 'capybara')
+        
+    def tearDown(self):
+        self.archive.close()
+        self.directory.cleanup()
+        
+    def test_messages(self):
+        self.assertEqual(self.archive.save_messages(1, [{'messageId': 11, 'author': 'a2', 'text': 'The moon orbits the earth'}], 'a2'), 0)
+        self.assertEqual([message['messageId'] for message in self.archive.get_messages(1)], [10, 11])
+        self.assertEqual([message['messageId'] for message in self.archive.get_messages(1, 1)], [11])
+        self.assertEqual(self.archive.get_thread(chatCode='code2')['chatId'], 2)
+        
+    def test_search(self):
+        self.assertEqual({row['messageId'] for row in self.archive.search('moon')}, {10, 11})
+        self.assertEqual([row['messageId'] for row in self.archive.search('tell me', bot='capybara')], [20])
+        self.assertEqual([row['messageId'] for row in self.archive.search('moon', author='a2')], [11])
+        self.assertEqual([row['messageId'] for row in self.archive.search('moon', since=1.5)], [11])
+        self.assertEqual(self.archive.search('moon', chatId=2), [])
+        self.assertEqual(self.archive.search('...'), [])
+        
+    def test_search_updated_text(self):
+        self.archive.save_messages(1, [{'messageId': 11, 'author': 'a2', 'text': 'The tide follows the moon'}], 'a2')
+        self.assertEqual([row['messageId'] for row in self.archive.search('tide')], [11])
+        self.assertEqual([row['messageId'] for row in self.archive.search('orbits')], [])
+        
+    def test_synced_through(self):
+        self.archive.set_synced_through(1, 11)
+        self.archive.set_synced_through(1, 10)
+        self.assertEqual(self.archive.get_synced_through(1), 11)
+        self.archive.delete_thread(1)
+        self.assertEqual(self.archive.get_synced_through(1), None)
+        self.assertEqual(self.archive.get_messages(1), [])
+
+class BotResolverTest(unittest.TestCase):
+    
+    def test_static(self):
+        resolver = BotResolver()
+        self.assertEqual(resolver.resolve('Assistant'), 'capybara')
+        self.assertEqual(resolver.resolve('assistant'), 'capybara')
+        self.assertEqual(resolver.resolve('Claude-instant'), 'a2')
+        self.assertEqual(resolver.resolve('a2'), 'a2')
+        self.assertEqual(resolver.handle('capybara'), 'Assistant')
+        self.assertEqual(resolver.resolve('Unknown Bot'), 'unknownbot')
+        
+    def test_catalog(self):
+        resolver = BotResolver()
+        resolver.update_from_catalog([
+            {'handle': 'Web-Search', 'displayName': 'Web Search', 'nickname': 'web_search'},
+            {'handle': 'Assistant', 'displayName': 'Assistant', 'nickname': 'other'},
+        ])
+        self.assertEqual(resolver.resolve('Web-Search'), 'web_search')
+        self.assertEqual(resolver.resolve('Web Search'), 'web_search')
+        self.assertEqual(resolver.handle('web_search'), 'Web-Search')
+        # Live entries never shadow the static ones
+        self.assertEqual(resolver.resolve('Assistant'), 'capybara')
+
+class CatalogTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'catalog.json')
+        self.bots = [f'Bot{index}' for index in range(25)]
+        self.requests = []
+        
+    def tearDown(self):
+        self.directory.cleanup()
+        
+    def send_request(self, query_name, variables):
+        # Pages of 10 bots, the cursor is the index of the next page
+        self.requests.append(variables.get('cursor'))
+        start = int(variables.get('cursor', 0))
+        edges = [{'node': {'handle': handle, 'displayName': handle, 'nickname': handle.lower()}} for handle in self.bots[start:start + 10]]
+        end = start + len(edges)
+        return {'data': {'viewer': {'availableBotsConnection': {'edges': edges, 'pageInfo': {'endCursor': str(end), 'hasNextPage': end < len(self.bots)}}}}}
+        
+    def test_refresh(self):
+        client = offlineClient(self.send_request, self.path)
+        self.assertEqual(client.refresh_bots(), 25)
+        self.assertEqual(self.requests, [None, '10', '20'])
+        self.assertTrue(client.catalog.complete)
+        
+        # Unchanged top page, the walk stops right away
+        self.requests = []
+        self.assertEqual(client.refresh_bots(), 0)
+        self.assertEqual(self.requests, [None])
+        
+        # A new bot on the top page, the walk stops at the first page without new bots
+        self.requests = []
+        self.bots.insert(0, 'NewBot')
+        self.assertEqual(client.refresh_bots(), 1)
+        self.assertEqual(client.resolver.resolve('NewBot'), 'newbot')
+        self.assertEqual(self.requests, [None, '10'])
+        
+    def test_full_refresh_prunes(self):
+        client = offlineClient(self.send_request, self.path)
+        client.refresh_bots()
+        self.bots.remove('Bot3')
+        client.refresh_bots(full=True)
+        self.assertEqual(len(client.catalog), 24)
+        self.assertEqual(client.catalog.get('Bot3'), None)
+        
+    def test_persisted(self):
+        offlineClient(self.send_request, self.path).refresh_bots()
+        self.requests = []
+        client = offlineClient(self.send_request, self.path)
+        self.assertEqual(len(client.catalog), 25)
+        self.assertFalse(client.catalog.is_stale())
+        self.assertEqual(len(client.get_available_bots(count=5)), 5)
+        self.assertEqual(self.requests, [])
+
+class CrawlExploreTest(unittest.TestCase):
+    
+    def test_dedup(self):
+        def send_request(query_name, variables):
+            # Both categories list the same bots
+            start = int(variables.get('cursor', 0))
+            edges = [{'node': {'handle': f'Bot{index}'}, 'cursor': str(start + 5)} for index in range(start, min(start + 5, 20))]
+            return {'data': {'exploreBotsConnection': {'edges': edges}}}
+        client = offlineClient(send_request)
+        client.categories = ['Popular', 'AI']
+        handles = list(client.crawl_explore(categories=['Popular', 'AI']))
+        self.assertEqual(sorted(handles), sorted(f'Bot{index}' for index in range(20)))
+        
+    def test_early_stop(self):
+        requests, finished = [], threading.Semaphore(0)
+        def iter_pages(categoryName, search, entity_type, page_size):
+            # Never runs out of pages, the walk ends only when its producer drops it
+            try:
+                while True:
+                    requests.append(categoryName)
+                    yield [f"{categoryName}{len(requests)}-{index}" for index in range(5)]
+            finally:
+                finished.release()
+        client = offlineClient(None)
+        client.categories = ['Popular', 'AI']
+        client._iter_explore_pages = iter_pages
+        handles = client.crawl_explore(categories=['Popular', 'AI'], concurrency=2)
+        for _ in range(7):
+            next(handles)
+        handles.close()
+        # Both producers stop with the consumer
+        for _ in range(2):
+            self.assertTrue(finished.acquire(timeout=5))
+        # 2 pages read, 4 in the bounded queue and one waiting in each producer at most
+        self.assertLessEqual(len(requests), 8)
+   
+class GroupContextTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.prompts, self.replies = [], 0
+        self.client = offlineClient(None)
+        self.client.groups, self.client.group_files, self.client.group_matchers, self.client.group_contexts = {}, {}, {}, {}
+        self.client.send_message = self.send_message
+        self.client.create_group('Story', [{'bot': 'capybara', 'name': 'Alice'}, {'bot': 'a2', 'name': 'Bob'}])
+        
+    def tearDown(self):
+        self.directory.cleanup()
+        
+    def send_message(self, bot, message, chatCode=None, **kwargs):
+        self.prompts.append(message)
+        self.replies += 1
+        text = f"reply {self.replies}"
+        yield {'response': text, 'text': text, 'chatCode': f"code-{bot}", 'chatId': 1}
+        
+    def send(self, message):
+        for _ in self.client.send_message_to_group('Story', message, rate_limiter=RateLimiter(0)):
+            pass
+        
+    def assertFollowsLog(self):
+        self.assertEqual(self.client.get_group_context('Story').window(), self.client.groups['Story']['conversation_log'])
+        
+    def test_new_round(self):
+        self.send('hello')
+        self.assertFollowsLog()
+        previous = self.client.groups['Story']['conversation_log']
+        self.prompts = []
+        self.send('again')
+        # Each round starts a new log, the context starts over with it
+        self.assertFollowsLog()
+        self.assertTrue(all(turn.strip() in self.prompts[0] for turn in previous))
+        self.assertFalse(set(previous) & set(self.client.get_group_context('Story').window()))
+        
+    def test_replaced_log(self):
+        self.send('hello')
+        self.client.groups['Story']['conversation_log'] = ['alice : from somewhere else\n']
+        self.assertFollowsLog()
+        self.prompts = []
+        self.send('again')
+        self.assertIn('alice : from somewhere else', self.prompts[0])
+        self.assertFollowsLog()
+        
+    def test_reload(self):
+        path = os.path.join(self.directory.name, 'Story.jsonl')
+        self.send('hello')
+        self.client.save_group_history('Story', path)
+        self.send('again')
+        self.client.save_group_history('Story', path)
+        self.client.load_group_history(path)
+        # The file holds every round, the reloaded context is rebuilt from it
+        self.assertEqual(len(self.client.groups['Story']['conversation_log']), len(self.client.get_group_context('Story')))
+        self.assertFollowsLog()
+   
+class BatchResumeTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = BatchStore(self.directory.name)
+        self.processed = []
+        
+    def tearDown(self):
+        self.directory.cleanup()
+        
+    async def process(self, url, body):
+        self.processed.append(body['messages'][0]['content'])
+        return 200, {'choices': [{'message': {'content': body['messages'][0]['content']}}]}, {}
+        
+    def create_batch(self, count):
+        lines = [{'custom_id': f'request-{index}', 'method': 'POST', 'url': '/v1/chat/completions', 'body': {'model': 'gpt-3.5-turbo', 'messages': [{'role': 'user', 'content': f'question {index}'}]}} for index in range(count)]
+        file = self.store.create_file(b'\n'.join(orjson.dumps(line) for line in lines), 'input.jsonl', 'batch')
+        return self.store.create_batch(file['id'], '/v1/chat/completions', '24h')
+        
+    def run_batch(self, batch, process, **kwargs):
+        runner = BatchRunner(self.store, process, rate=100, **kwargs)
+        asyncio.run(runner.run(batch['id']))
+        batch = self.store.get_batch(batch['id'])
+        with open(self.store.file_path(batch['error_file_id']), 'rb') as f:
+            errors = [orjson.loads(line) for line in f.read().splitlines()]
+        return batch, errors
+        
+    def test_resume(self):
+        batch = self.create_batch(4)
+        # The previous run answered the first request and crashed halfway through writing the second
+        batch['status'] = 'in_progress'
+        self.store.save_batch(batch)
+        with open(self.store.file_path(batch['output_file_id']), 'wb') as f:
+            f.write(orjson.dumps({'custom_id': 'request-0', 'response': {'status_code': 200}}) + b'\n{"custom_id": "request-1", "resp')
+        
+        async def restart():
+            runner = BatchRunner(self.store, self.process, concurrency=2, rate=100)
+            runner.resume()
+            await asyncio.gather(*runner.tasks.values())
+        asyncio.run(restart())
+        
+        batch = self.store.get_batch(batch['id'])
+        self.assertEqual(batch['status'], 'completed')
+        self.assertEqual(batch['request_counts'], {'total': 4, 'completed': 4, 'failed': 0})
+        self.assertEqual(sorted(self.processed), ['question 1', 'question 2', 'question 3'])
+        with open(self.store.file_path(batch['output_file_id']), 'rb') as f:
+            custom_ids = [orjson.loads(line)['custom_id'] for line in f.read().splitlines()]
+        self.assertEqual(sorted(custom_ids), [f'request-{index}' for index in range(4)])
+        
+    def test_retry(self):
+        attempts = []
+        async def process(url, body):
+            # Rejected by admission, then the provider fails once, then it goes through
+            attempts.append(body['messages'][0]['content'])
+            if attempts.count(body['messages'][0]['content']) == 1:
+                return 429, {'error': {'message': 'The server is overloaded. Please retry later.'}}, {'Retry-After': '0'}
+            if attempts.count(body['messages'][0]['content']) == 2:
+                raise RuntimeError('Bad gateway')
+            return await self.process(url, body)
+        batch, errors = self.run_batch(self.create_batch(2), process, backoff=0)
+        self.assertEqual(batch['status'], 'completed')
+        self.assertEqual(batch['request_counts'], {'total': 2, 'completed': 2, 'failed': 0})
+        self.assertEqual(len(attempts), 6)
+        self.assertEqual(errors, [])
+        
+    def test_retries_run_out(self):
+        attempts = []
+        async def process(url, body):
+            attempts.append(url)
+            return (503, {'error': {'message': 'Unavailable'}}, {}) if body['messages'][0]['content'] == 'question 0' else (400, {'error': {'message': 'Invalid'}}, {})
+        batch, errors = self.run_batch(self.create_batch(2), process, retries=2, backoff=0)
+        # Client errors are never retried
+        self.assertEqual(len(attempts), 4)
+        self.assertEqual(batch['request_counts'], {'total': 2, 'completed': 0, 'failed': 2})
+        self.assertEqual(sorted(line['response']['status_code'] for line in errors), [400, 503])
+        
+    def test_expired(self):
+        batch = self.create_batch(2)
+        batch['expires_at'] = int(time.time()) - 1
+        self.store.save_batch(batch)
+        batch, errors = self.run_batch(batch, self.process)
+        self.assertEqual(batch['status'], 'expired')
+        self.assertNotEqual(batch['expired_at'], None)
+        self.assertEqual(self.processed, [])
+        self.assertEqual([line['error']['code'] for line in errors], ['batch_expired', 'batch_expired'])
+        
+    def test_finished_batches_are_left_alone(self):
+        batch = self.store.create_batch('file-missing', '/v1/chat/completions', '24h')
+        batch['status'] = 'completed'
+        self.store.save_batch(batch)
+        runner = BatchRunner(self.store, self.process)
+        runner.resume()
+        self.assertEqual(runner.tasks, {})
+   
+class AdmissionTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tokens = [{'p-b': 'first'}, {'p-b': 'second'}]
+        
+    def test_limits(self):
+        async def main():
+            controller = AdmissionController(model_limit=2, account_limit=1)
+            first = await controller.acquire('a2', self.tokens)
+            second = await controller.acquire('a2', self.tokens)
+            # One request per account, spread over both
+            self.assertEqual({first.token['p-b'], second.token['p-b']}, {'first', 'second'})
+            waiter = asyncio.ensure_future(controller.acquire('a2', self.tokens))
+            await asyncio.sleep(0)
+            self.assertFalse(waiter.done())
+            first.release()
+            first.release()
+            third = await waiter
+            self.assertEqual(third.token, first.token)
+            self.assertEqual(controller.models['a2'], 2)
+        asyncio.run(main())
+        
+    def test_no_tokens(self):
+        async def main():
+            controller = AdmissionController()
+            self.assertEqual(await controller.acquire('a2', []), None)
+        asyncio.run(main())
+        
+    def test_queue_full(self):
+        async def main():
+            controller = AdmissionController(model_limit=1, queue_size=1, retry_after=7)
+            await controller.acquire('a2', self.tokens)
+            waiter = asyncio.ensure_future(controller.acquire('a2', self.tokens))
+            await asyncio.sleep(0)
+            with self.assertRaises(AdmissionRejected) as context:
+                await controller.acquire('a2', self.tokens)
+            self.assertEqual(context.exception.retry_after, 7)
+            waiter.cancel()
+        asyncio.run(main())
+        
+    def test_timeout(self):
+        async def main():
+            controller = AdmissionController(model_limit=1, timeout=0.01)
+            await controller.acquire('a2', self.tokens)
+            with self.assertRaises(AdmissionRejected):
+                await controller.acquire('a2', self.tokens)
+            self.assertEqual(len(controller.waiters), 0)
+        asyncio.run(main())
+        
+    def test_other_models_are_not_held_back(self):
+        async def main():
+            controller = AdmissionController(model_limit=1, timeout=1)
+            held = await controller.acquire('a2', self.tokens)
+            waiter = asyncio.ensure_future(controller.acquire('a2', self.tokens))
+            await asyncio.sleep(0)
+            # The waiter on the saturated model does not delay a model with free slots
+            ticket = await asyncio.wait_for(controller.acquire('capybara', self.tokens), 0.5)
+            self.assertEqual(ticket.model, 'capybara')
+            # But a new request on the saturated model queues behind it
+            later = asyncio.ensure_future(controller.acquire('a2', self.tokens))
+            await asyncio.sleep(0)
+            held.release()
+            self.assertEqual((await waiter).model, 'a2')
+            self.assertFalse(later.done())
+            later.cancel()
+        asyncio.run(main())
+        
+    def test_renew(self):
+        async def main():
+            controller = AdmissionController(account_limit=1)
+            ticket = await controller.acquire('a2', self.tokens, self.tokens[0])
+            self.assertEqual(ticket.token['p-b'], 'first')
+            # The account ran out of points and was removed
+            await ticket.renew(self.tokens[1:])
+            self.assertEqual((ticket.token['p-b'], ticket.released), ('second', False))
+            self.assertEqual(controller.accounts['first'], 0)
+            await ticket.renew([])
+            self.assertTrue(ticket.released)
+            self.assertEqual(sum(controller.accounts.values()), 0)
+            self.assertEqual(controller.models['a2'], 0)
+        asyncio.run(main())
+   
+class OfflineImageClient:
+    # Stands in for AsyncPoeApi, each generation answers with a new url
+    def __init__(self, generations, token):
+        self.generations, self.tokens, self.client = generations, token, None
+        
+    async def send_message(self, bot, message, file_path=[]):
+        self.generations.append(self.tokens['p-b'])
+        url = f"https://images/{len(self.generations)}"
+        await asyncio.sleep(0)
+        yield {'text': url}
+        
+    def disconnect_ws(self):
+        pass
+        
+class ImageGenerationTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.state = (openai_api.app.state.admission, openai_api.app.state.tokens, openai_api.rotate_token)
+        self.generations = []
+        openai_api.app.state.tokens = [{'p-b': f'account{index}'} for index in range(4)]
+        openai_api.rotate_token = self.rotate_token
+        
+    def tearDown(self):
+        openai_api.app.state.admission, openai_api.app.state.tokens, openai_api.rotate_token = self.state
+        
+    async def rotate_token(self, tokens, preferred=None, ticket=None):
+        return OfflineImageClient(self.generations, ticket.token), True
+        
+    async def request(self, n):
+        ticket = await openai_api.admit_request('dall-e-3')
+        try:
+            client = OfflineImageClient(self.generations, ticket.token)
+            return await openai_api.generate_images(client, {'bot': 'dalle3', 'message': 'a cat'}, 'dall-e-3', '', n, False)
+        finally:
+            ticket.release()
+        
+    def test_saturated(self):
+        async def main():
+            controller = openai_api.app.state.admission = AdmissionController(model_limit=2, account_limit=1, timeout=1)
+            # Both requests hold the only slots, their extra images run on their own accounts without waiting for more
+            urls = await asyncio.wait_for(asyncio.gather(self.request(3), self.request(3)), 0.5)
+            self.assertEqual([len(set(request)) for request in urls], [3, 3])
+            self.assertEqual(len(set(self.generations)), 2)
+            self.assertEqual(controller.models['dall-e-3'], 0)
+        asyncio.run(main())
+        
+    def test_free_slots(self):
+        async def main():
+            controller = openai_api.app.state.admission = AdmissionController(model_limit=4, account_limit=1)
+            urls = await self.request(3)
+            self.assertEqual(len(set(urls)), 3)
+            # Each extra image got an account of its own
+            self.assertEqual(len(set(self.generations)), 3)
+            self.assertEqual(sum(controller.accounts.values()), 0)
+        asyncio.run(main())
+   
+class TokenStoreTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'tokens.db')
+        self.tokens = [{'p-b': f'account{index}', 'p-lat': 'offline'} for index in range(4)]
+        
+    def tearDown(self):
+        self.directory.cleanup()
+        
+    def test_shards(self):
+        first = TokenStore(self.tokens, self.path, shard=0, shards=2, refresh=0)
+        second = TokenStore(path=self.path, shard=1, shards=2, refresh=0)
+        self.assertEqual([token['p-b'] for token in first], ['account0', 'account2'])
+        self.assertEqual([token['p-b'] for token in second], ['account1', 'account3'])
+        # A worker borrows the other shards once its own accounts are exhausted
+        second.remove(self.tokens[1])
+        first.remove(self.tokens[3])
+        self.assertEqual([token['p-b'] for token in second], ['account0', 'account2'])
+        
+    def test_balance(self):
+        store = TokenStore(self.tokens, self.path, balance_interval=60)
+        self.assertTrue(store.balance_due(self.tokens[0]))
+        store.update_balance(self.tokens[0], 100)
+        # Later requests on the same account skip the write until the interval is over
+        self.assertFalse(store.balance_due(self.tokens[0]))
+        self.assertTrue(store.balance_due(self.tokens[1]))
+        self.assertEqual(store.conn.execute("SELECT balance FROM tokens WHERE account = 'account0'").fetchone(), (100,))
+   
+class TokenCounterTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.encoder = offlineEncoder()
+        # Multibyte letters, an emoji with a skin tone modifier, runs of whitespace and digits
+        self.text = "The moon orbits the earth...  Café au lait, 中文 tokens 👍🏽 and 12345 numbers!\n\n  The tide follows the moon's pull.\nEnd"
+        
+    def count(self, text):
+        return len(self.encoder.encode_ordinary(text))
+        
+    def test_streamed(self):
+        # Deltas cut through words, whitespace runs and between the code points of the emoji
+        for step in (1, 2, 3, 5, 8):
+            counter = helpers.TokenCounter(self.encoder)
+            for end in range(step, len(self.text) + step, step):
+                self.assertEqual(counter.update(self.text[:end]), self.count(self.text[:end]), (step, end))
+            self.assertEqual(counter.count(), self.count(self.text))
+            
+    def test_every_split(self):
+        for split in range(len(self.text) + 1):
+            counter = helpers.TokenCounter(self.encoder)
+            counter.update(self.text[:split])
+            self.assertEqual(counter.update(self.text), self.count(self.text), split)
+            
+    def test_restart(self):
+        # A retried reply starts over with a shorter text
+        counter = helpers.TokenCounter(self.encoder)
+        counter.update(self.text)
+        self.assertEqual(counter.update("中文 tokens"), self.count("中文 tokens"))
+   
+class CompressTextTest(unittest.TestCase):
+    
+    def setUp(self):
+        # Module level names, a plain attribute access would be mangled inside the class
+        self.compress_text, self.summarize_text = getattr(helpers, '__compress_text'), getattr(helpers, '__summarize_text')
+        self.count_tokens_cached = getattr(helpers, '__count_tokens_cached')
+        self.encoder, helpers.ENCODER = helpers.ENCODER, offlineEncoder()
+        self.count_tokens_cached.cache_clear()
+        self.text = ' '.join([
+            "The moon orbits the earth. The tide follows the moon.", "Café au lait is served here!",
+            "中文 tokens are longer.", "Why does the sea rise?\nThe moon pulls the sea and the earth.", "👍🏽...", "The end"
+        ] * 3)
+        
+    def tearDown(self):
+        helpers.ENCODER = self.encoder
+        self.count_tokens_cached.cache_clear()
+        
+    def count(self, text):
+        return len(helpers.ENCODER.encode_ordinary(text))
+        
+    def test_budget(self):
+        total = self.count(self.text)
+        for max_tokens in range(1, total + 2):
+            summary = self.compress_text(self.text, max_tokens)
+            self.assertLessEqual(self.count(summary), max_tokens, max_tokens)
+            self.assertTrue(summary)
+            
+    def test_order(self):
+        sentences = [sentence.strip() for sentence in helpers.SENTENCE_PATTERN.findall(self.text) if sentence.strip()]
+        summary = self.compress_text(self.text, self.count(self.text) // 2)
+        # Whole sentences in their original order
+        remaining = iter(sentences)
+        self.assertTrue(all(line in remaining for line in summary.split('\n')))
+        self.assertLess(len(summary.split('\n')), len(sentences))
+        
+    def test_summarize(self):
+        self.assertEqual(asyncio.run(self.summarize_text(self.text, self.count(self.text))), self.text)
+        self.assertEqual(asyncio.run(self.summarize_text(self.text, 0)), "")
+        self.assertLessEqual(self.count(asyncio.run(self.summarize_text(self.text, 20))), 20)
+   
+class ResponseCacheTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'responses.db')
+        
+    def tearDown(self):
+        self.directory.cleanup()
+        
+    def request(self, **kwargs):
+        return ChatData(**{'model': 'gpt-3.5-turbo', 'messages': [{'role': 'user', 'content': 'Hello'}], 'temperature': 0, **kwargs})
+        
+    def test_key(self):
+        self.assertEqual(ResponseCache.key(self.request(temperature=0.7)), None)
+        self.assertEqual(ResponseCache.key(self.request()), ResponseCache.key(self.request(messages=[{'content': 'Hello', 'role': 'user'}])))
+        self.assertNotEqual(ResponseCache.key(self.request()), ResponseCache.key(self.request(max_tokens=10)))
+        # Streaming does not change the completion
+        self.assertEqual(ResponseCache.key(self.request()), ResponseCache.key(self.request(stream=True)))
+        
+    def test_eviction(self):
+        cache = ResponseCache(max_entries=2)
+        cache.put('first', {'text': '1'})
+        cache.put('second', {'text': '2'})
+        cache.get('first')
+        cache.put('third', {'text': '3'})
+        # The least recently used entry goes first
+        self.assertEqual(cache.get('second'), None)
+        self.assertEqual(cache.get('first'), {'text': '1'})
+        
+    def test_ttl(self):
+        cache = ResponseCache(ttl=60)
+        cache.put('first', {'text': '1'})
+        cache.entries['first'] = ({'text': '1'}, time.time() - 61)
+        self.assertEqual(cache.get('first'), None)
+        self.assertNotIn('first', cache.entries)
+        
+    def test_persisted(self):
+        ResponseCache(path=self.path).put('first', {'text': '1', 'prompt_tokens': 3, 'raw_tool_calls': None})
+        cache = ResponseCache(path=self.path)
+        self.assertEqual(cache.get('first'), {'text': '1', 'prompt_tokens': 3, 'raw_tool_calls': None})
+        # Expired rows are dropped when the file is opened again
+        cache.db.execute("UPDATE responses SET created = 0")
+        cache.db.commit()
+        self.assertEqual(ResponseCache(path=self.path).get('first'), None)
+   
+class ToolCallScannerTest(unittest.TestCase):
+    
+    def scan(self, text, step=1):
+        # Feeds the reply the way it streams in, returns the verdict and how much text it took
+        scanner = helpers.ToolCallScanner()
+        for end in range(step, len(text) + step, step):
+            verdict = scanner.feed(text[:end])
+            if verdict != None:
+                return verdict, min(end, len(text)), scanner
+        return None, len(text), scanner
+        
+    def test_tool_calls(self):
+        array = '[{"name": "get_weather", "arguments": {"city": "[Paris]", "note": "a } b \\" ] {"}}, {"name": "get_time"}]'
+        text = f'{array}\nThe weather in Paris is'
+        for step in (1, 4, 16, len(text)):
+            verdict, end, scanner = self.scan(text, step)
+            self.assertEqual(verdict, 'tool_calls')
+            self.assertEqual(scanner.array(text), array)
+            # Generation can stop right at the end of the array
+            self.assertLess(end, len(array) + step)
+        tool_calls = asyncio.run(getattr(helpers, '__parse_tool_calls')(array))
+        self.assertEqual(tool_calls, [{'name': 'get_weather', 'arguments': {'city': '[Paris]', 'note': 'a } b " ] {'}}, {'name': 'get_time', 'arguments': {}}])
+        
+    def test_fenced(self):
+        array = '[{"arguments": {"query": "moon"}, "name": "search"}]'
+        for fence in ('```json\n', '```\n', '  ```json \r\n  '):
+            verdict, _, scanner = self.scan(f'{fence}{array}\n```')
+            self.assertEqual(verdict, 'tool_calls', fence)
+            self.assertEqual(scanner.array(f'{fence}{array}\n```'), array)
+        self.assertEqual(self.scan('```python\nprint("[]")\n```')[0], 'prose')
+        
+    def test_prose(self):
+        for text in ('The moon orbits the earth.', '[1] The moon orbits the earth.', '[Note] see [1]', '["moon", "earth"]', '[{"title": "Moon"}]', '  \n[ 1, 2 ]'):
+            verdict, end, _ = self.scan(text)
+            self.assertEqual(verdict, 'prose', text)
+            # Known well before the end of the reply
+            self.assertLess(end, 16, text)
+        
+    def test_empty_array(self):
+        verdict, _, scanner = self.scan('[]')
+        self.assertEqual((verdict, scanner.array('[]')), ('tool_calls', '[]'))
+        # An empty array calls no tools
+        self.assertEqual(asyncio.run(getattr(helpers, '__parse_tool_calls')('[]')), None)
+        
+    def test_undecided(self):
+        scanner = helpers.ToolCallScanner()
+        self.assertEqual(scanner.feed('  '), None)
+        self.assertEqual(scanner.feed('  ``'), None)
+        self.assertEqual(scanner.feed('  ```js'), None)
+        self.assertEqual(scanner.feed('  ```json\n[{"na'), None)
+        self.assertEqual(scanner.feed('  ```json\n[{"name": "a"'), None)
+   
+class ModelsTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.client = TestClient(openai_api.app)
+        
+    def test_etag(self):
+        response = self.client.get('/v1/models')
+        etag = response.headers['etag']
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, openai_api.app.state.models_json[None][0])
+        self.assertIn('gpt-3.5-turbo', [model['id'] for model in response.json()['data']])
+        for tags in (etag, f'W/{etag}', f'"stale", {etag}'):
+            response = self.client.get('/v1/models', headers={'If-None-Match': tags})
+            self.assertEqual((response.status_code, response.content, response.headers['etag']), (304, b'', etag), tags)
+        self.assertEqual(self.client.get('/models', headers={'If-None-Match': '"stale"'}).status_code, 200)
+        
+    def test_model(self):
+        response = self.client.get('/v1/models/gpt-3.5-turbo')
+        self.assertEqual(response.json()['id'], 'gpt-3.5-turbo')
+        self.assertNotEqual(response.headers['etag'], self.client.get('/v1/models').headers['etag'])
+        self.assertEqual(self.client.get('/v1/models/gpt-3.5-turbo', headers={'If-None-Match': response.headers['etag']}).status_code, 304)
+        self.assertEqual(self.client.get('/v1/models/unknown').status_code, 400)
+        
+    def test_reload(self):
+        etag = self.client.get('/v1/models').headers['etag']
+        # An unchanged models.json keeps the responses and their tags
+        openai_api.app.state.models_checked = 0
+        self.assertEqual(self.client.get('/v1/models').headers['etag'], etag)
+   
+class ChunkTemplateTest(unittest.TestCase):
+    
+    def test_same_bytes(self):
+        async def main():
+            for include_usage in (False, True):
+                for model in ('gpt-3.5-turbo', 'model "quoted" \\ 中文'):
+                    template = helpers.ChunkTemplate('abc123', 1700000000, model, include_usage)
+                    for content in ('Hello', '', ' "quoted" \\ back\\slash', 'line\nbreak\ttab\r\x00\x1f', 'Café 中文 👍🏽', '  </script>'):
+                        data = await openai_api.create_completion_data(completion_id='abc123', created=1700000000, model=model, chunk=content, include_usage=include_usage)
+                        self.assertEqual(template.render(content), b"data: " + orjson.dumps(data) + b"\n\n", (include_usage, model, content))
+        asyncio.run(main())
+   
+class StreamCoalescerTest(unittest.TestCase):
+    
+    def test_policy(self):
+        coalescer = helpers.StreamCoalescer(max_bytes=8, max_delay=60)
+        self.assertEqual(coalescer.due(), None)
+        # The first delta goes out right away, the next ones wait for max_bytes or the end of a sentence
+        self.assertEqual(coalescer.add('The'), 'The')
+        self.assertEqual(coalescer.add(' moon'), None)
+        self.assertGreater(coalescer.due(), 0)
+        self.assertEqual(coalescer.add(' orb'), ' moon orb')
+        self.assertEqual(coalescer.add(' it.'), ' it.')
+        self.assertEqual(coalescer.add(''), None)
+        # Bytes are counted, not characters
+        self.assertEqual(coalescer.add('中'), None)
+        self.assertEqual(coalescer.add('文'), None)
+        self.assertEqual(coalescer.add('！'), '中文！')
+        self.assertEqual(coalescer.add('中文中'), '中文中')
+        self.assertEqual(coalescer.flush(), '')
+        
+    def test_without_sentences(self):
+        coalescer = helpers.StreamCoalescer(max_bytes=64, max_delay=60, sentences=False)
+        coalescer.add('The')
+        self.assertEqual(coalescer.add(' end.'), None)
+        self.assertEqual(coalescer.flush(), ' end.')
+        self.assertEqual(coalescer.due(), None)
+        
+    def test_delay(self):
+        coalescer = helpers.StreamCoalescer(max_bytes=64, max_delay=0)
+        coalescer.add('The')
+        # Past its deadline the pending text goes out with the next delta
+        self.assertEqual(coalescer.add(' moon'), ' moon')
+        
+    def test_reader(self):
+        async def main():
+            ready = asyncio.Event()
+            async def chunks():
+                yield 'first'
+                await ready.wait()
+                yield 'second'
+            reader = helpers.ChunkReader(chunks())
+            self.assertEqual(await reader.next(), 'first')
+            # The item still on its way is kept for the next call
+            self.assertEqual(await reader.next(0), None)
+            self.assertEqual(await reader.next(0), None)
+            ready.set()
+            self.assertEqual(await reader.next(), 'second')
+            with self.assertRaises(StopAsyncIteration):
+                await reader.next()
+            
+            ready.clear()
+            reader = helpers.ChunkReader(chunks())
+            await reader.next()
+            await reader.next(0)
+            pending = reader.pending
+            reader.cancel()
+            await asyncio.sleep(0)
+            self.assertTrue(pending.cancelled())
+        asyncio.run(main())
    
 class PoeApiTest(unittest.TestCase):
     
     @classmethod
     def setUpClass(cls):
+        global TOKEN
+        p_b = input("Enter your p-b cookie: ")
+        p_lat = input("Enter your p-lat cookie: ")
+        TOKEN = {'p-b': p_b, 'p-lat': p_lat}
         cls.botName = testObjectGenerator(20)
         cls.botName2 = testObjectGenerator(20)
         print("Initializing tests")
@@ -27,6 +850,12 @@ class PoeApiTest(unittest.TestCase):
         client = PoeApi(tokens=TOKEN)
         client.get_available_bots()
         
+    def test_refresh_bots(self):
+        client = PoeApi(tokens=TOKEN, catalog_path='test_catalog.json')
+        client.get_available_bots(get_all=True)
+        client.refresh_bots()
+        client.catalog.get('Assistant')
+        
     def test_get_available_categories(self):
         client = PoeApi(tokens=TOKEN)
         client.get_available_categories()
@@ -42,6 +871,11 @@ class PoeApiTest(unittest.TestCase):
         client.explore(categoryName="Popular", count=30)
         client.explore(search="Poe", entity_type='user', count=30)
         
+    def test_crawl_explore(self):
+        client = PoeApi(tokens=TOKEN)
+        for _, handle in zip(range(100), client.crawl_explore(categories=["Popular", "AI"], searches=["Midjourney"])):
+            pass
+        
     def test_get_chat_history(self):
         client = PoeApi(tokens=TOKEN)
         client.get_chat_history(count=200)
@@ -92,6 +926,24 @@ class PoeApiTest(unittest.TestCase):
         client = PoeApi(tokens=TOKEN)
         chatCode = client.get_chat_history("a2")['data']['a2'][0]['chatCode']
         client.get_previous_messages('a2', chatCode=chatCode, count=2)
+        
+    def test_iter_previous_messages(self):
+        client = PoeApi(tokens=TOKEN)
+        chatCode = client.get_chat_history("a2")['data']['a2'][0]['chatCode']
+        for _ in client.iter_previous_messages('a2', chatCode=chatCode, oldest_first=True):
+            pass
+            
+    def test_sync_messages(self):
+        client = PoeApi(tokens=TOKEN, archive_path='test_archive.db')
+        client.sync_chat_history()
+        chatCode = client.get_chat_history("a2")['data']['a2'][0]['chatCode']
+        client.sync_messages('a2', chatCode=chatCode)
+        client.get_previous_messages('a2', chatCode=chatCode, count=2)
+    
+    def test_search_messages(self):
+        client = PoeApi(tokens=TOKEN, archive_path='test_archive.db')
+        client.sync_chat_history()
+        client.search_messages('hello', bot='a2', limit=5)
     
     def test_upload_knowledge(self):
         client = PoeApi(tokens=TOKEN)